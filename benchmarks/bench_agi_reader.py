@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Micro-benchmark: legacy recv(1) AGI reader vs. buffered AGIConnection.
+
+Each round reads a full AGI environment block and 17 GET VARIABLE replies,
+which is what a single FastAGI invocation of slack_asterisk consumes.
+
+Usage: python benchmarks/bench_agi_reader.py [rounds]
+"""
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from slack_asterisk import agi_protocol  # noqa: E402
+
+ENV = b"".join(b"agi_%s: %s\n" % (k, v) for k, v in (
+    (b"network", b"yes"), (b"network_script", b""), (b"request", b"agi://127.0.0.1:4574/"),
+    (b"channel", b"SIP/provider-0000a1b2"), (b"language", b"de"), (b"type", b"SIP"),
+    (b"uniqueid", b"1700000000.1234"), (b"version", b"20.5.0"), (b"callerid", b"0301234567"),
+    (b"calleridname", b"Example Caller"), (b"callingpres", b"0"), (b"callingani2", b"0"),
+    (b"callington", b"0"), (b"callingtns", b"0"), (b"dnid", b"4930123456"),
+    (b"rdnis", b"unknown"), (b"context", b"incoming"), (b"extension", b"4930123456"),
+    (b"priority", b"2"), (b"enhanced", b"0.0"), (b"accountcode", b""), (b"threadid", b"140000000000"),
+)) + b"\n"
+REPLIES = b"".join([b"200 result=1 (0301234567)\n", b"200 result=1 (Example Caller)\n", b"200 result=1 (1700000000.1234)\n"]
+                   + [b"200 result=0\n"] * 14)
+VARS = 17
+
+
+def legacy_readline(sock):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = sock.recv(1)
+        if not chunk:
+            break
+        data += chunk
+    if not data:
+        return None
+    return data.decode(errors="ignore").rstrip("\r\n")
+
+
+def legacy_round(sock, _conn):
+    env = {}
+    while True:
+        line = legacy_readline(sock)
+        if not line:
+            break
+        parts = line.split(":", 1)
+        if len(parts) == 2:
+            env[parts[0].strip()] = parts[1].strip()
+    for _ in range(VARS):
+        legacy_readline(sock)
+
+
+def buffered_round(_sock, conn):
+    conn.read_env()
+    for _ in range(VARS):
+        agi_protocol.variable_value(conn.read_result())
+
+
+def run(name, round_fn, rounds):
+    a, b = socket.socketpair()
+    payload = ENV + REPLIES
+
+    def feeder():
+        for _ in range(rounds):
+            b.sendall(payload)
+
+    t = threading.Thread(target=feeder, daemon=True)
+    rfile = a.makefile("rb")
+    conn = agi_protocol.AGIConnection(rfile, None)
+    start = time.perf_counter()
+    t.start()
+    for _ in range(rounds):
+        round_fn(a, conn)
+    elapsed = time.perf_counter() - start
+    t.join()
+    a.close()
+    b.close()
+    print("%-10s %6d rounds  %8.3f s  %8.1f us/round" % (name, rounds, elapsed, elapsed / rounds * 1e6))
+    return elapsed
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    legacy = run("recv(1)", legacy_round, rounds)
+    buffered = run("buffered", buffered_round, rounds)
+    print("speedup    %.1fx" % (legacy / buffered))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Benchmark per-event overhead of the call state backends.
+
+Every call runs the store operations of a typical lifecycle: new call
+(get_or_create + save), post (save), dial macro (get + save) and hangup
+(get + pop). Compares the in-memory store, the SQLite store with grouped
+commits and the SQLite store committing after every event. Finally checks
+that unfinished calls survive a restart of the SQLite store, and that a call
+finished before the dispatcher recorded its post (submit, finish, on_posted)
+does not.
+
+Usage: python benchmarks/bench_call_store.py [calls]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from slack_asterisk import call_store, sqlite_store  # noqa: E402
+
+EVENTS_PER_CALL = 4
+
+
+def lifecycle(store, uniqueid, per_event=None):
+    state, _ = store.get_or_create(uniqueid)
+    state.from_num = "0301234567"
+    store.save(state)
+    if per_event:
+        per_event()
+    state.ts = "1700000000.000100"
+    store.save(state)
+    if per_event:
+        per_event()
+    state = store.get(uniqueid)
+    state.to_num = "200"
+    store.save(state)
+    if per_event:
+        per_event()
+    store.get(uniqueid)
+    store.pop(uniqueid)
+    if per_event:
+        per_event()
+
+
+def run(name, store, calls, per_event=None):
+    start = time.perf_counter()
+    for i in range(calls):
+        lifecycle(store, "1700000000.%d" % i, per_event)
+    elapsed = time.perf_counter() - start
+    if hasattr(store, "flush"):
+        store.flush()
+    print("%-22s %8.2f us/event" % (name, elapsed / (calls * EVENTS_PER_CALL) * 1e6))
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    with tempfile.TemporaryDirectory() as tmp:
+        run("memory", call_store.CallStore(), calls)
+        store = sqlite_store.SQLiteCallStore(os.path.join(tmp, "grouped.db"), commit_interval=0.5)
+        run("sqlite grouped commits", store, calls)
+        store.close()
+        store = sqlite_store.SQLiteCallStore(os.path.join(tmp, "single.db"), commit_interval=3600)
+        run("sqlite commit per event", store, calls // 10, per_event=store.flush)
+        store.close()
+
+        path = os.path.join(tmp, "restart.db")
+        store = sqlite_store.SQLiteCallStore(path)
+        for i in range(100):
+            state, _ = store.get_or_create("1700000001.%d" % i)
+            state.from_num = "030%d" % i
+            state.ts = "1700000001.%06d" % i
+            store.save(state)
+        for i in range(50):
+            store.pop("1700000001.%d" % i)
+        store.close()
+        store = sqlite_store.SQLiteCallStore(path)
+        restored = store.get("1700000001.99")
+        print("restart: %d calls restored, ts of last call %s" % (len(store), restored.ts if restored else None))
+        store.close()
+
+        # the AGI handler submits the final event and finishes the call, the dispatch worker saves the posted ts later
+        path = os.path.join(tmp, "finished.db")
+        store = sqlite_store.SQLiteCallStore(path)
+        state, _ = store.get_or_create("1700000002.1")
+        store.save(state)
+        store.pop("1700000002.1")
+        state.ts = "1700000002.000100"
+        store.save(state)
+        store.close()
+        store = sqlite_store.SQLiteCallStore(path)
+        resurrected = store.get("1700000002.1") is not None
+        print("post recorded after finish: call %s after restart" % ("restored (error)" if resurrected else "not restored"))
+        store.close()
+        if resurrected:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Benchmark channel variable retrieval per AGI invocation.
+
+Compares the legacy 17 serial GET VARIABLE calls with the context aware
+variable plan fetched serially, pipelined and via GET FULL VARIABLE. A fake
+Asterisk with configurable round trip latency answers the commands.
+
+Usage: python benchmarks/bench_get_vars.py [rounds] [latency_ms]
+"""
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from slack_asterisk import agi_protocol, agi_vars  # noqa: E402
+from fake_asterisk import FakeChannel  # noqa: E402
+
+CONTEXTS = {
+    "new call": (
+        {"agi_uniqueid": "1700000000.1", "agi_callerid": "0301234567", "agi_calleridname": "Example", "agi_extension": "100", "agi_context": "incoming"},
+        {"UNIQUEID": "1700000000.1", "CALLERID(num)": "0301234567", "CALLERID(name)": "Example", "EXTEN": "100"},
+    ),
+    "answered": (
+        {"agi_uniqueid": "1700000000.2", "agi_callerid": "200", "agi_calleridname": "Desk", "agi_extension": "s", "agi_context": "macro-slack-answered"},
+        {"UNIQUEID": "1700000000.2", "ARG1": "1700000000.1", "CALLERID(num)": "200", "CALLERID(name)": "Desk", "DIALEDPEERNUMBER": "SIP/200", "EXTEN": "s"},
+    ),
+    "hangup": (
+        {"agi_uniqueid": "1700000000.1", "agi_callerid": "0301234567", "agi_calleridname": "Example", "agi_extension": "h", "agi_context": "incoming"},
+        {"UNIQUEID": "1700000000.1", "DIALSTATUS": "ANSWER", "DIALEDTIME": "20", "ANSWEREDTIME": "12", "HANGUPCAUSE": "16", "EXTEN": "h"},
+    ),
+}
+
+
+def legacy_fetch(conn, _env):
+    names = list(agi_vars.CHANNEL_VARS.values()) + ["SLACK_ASTERISK_REFID"]
+    return {name: conn.get_variable(name) for name in names}
+
+
+def run(strategy, env, chan_vars, rounds, latency):
+    round_trips = commands = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        a, b = socket.socketpair()
+        channel = FakeChannel(chan_vars)
+        t = threading.Thread(target=channel.serve, args=(b, latency), daemon=True)
+        t.start()
+        conn = agi_protocol.AGIConnection(a.makefile("rb"), a.makefile("wb", buffering=0))
+        if strategy == "legacy":
+            legacy_fetch(conn, env)
+        else:
+            agi_vars.fetch(conn, env, strategy)
+        a.shutdown(socket.SHUT_RDWR)
+        t.join()
+        a.close()
+        b.close()
+        round_trips += channel.round_trips
+        commands += channel.commands
+    elapsed = time.perf_counter() - start
+    return round_trips / rounds, commands / rounds, elapsed / rounds * 1e3
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = float(sys.argv[2]) / 1e3 if len(sys.argv) > 2 else 0.0005
+    print("%-10s %-9s %12s %9s %10s" % ("context", "strategy", "round trips", "commands", "ms/invoke"))
+    for name, (env, chan_vars) in CONTEXTS.items():
+        for strategy in ("legacy",) + agi_vars.STRATEGIES:
+            rt, cmds, ms = run(strategy, env, chan_vars, rounds, latency)
+            print("%-10s %-9s %12.1f %9.1f %10.3f" % (name, strategy, rt, cmds, ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Benchmark the call history: recording finished calls and /calls queries.
+
+Fills a history of the given capacity with twice as many calls, so the
+ring buffer wraps and the index drops the oldest calls, from a few thousand
+callers to a few hundred extensions. Then times the queries of /calls and
+/calls/stats through the Flask test client: a number, a number prefix, the
+last hour and aggregations, and checks the results against a scan of all
+records.
+
+Usage: python benchmarks/bench_history.py [capacity]
+"""
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from slack_asterisk import call_store, history, http_server  # noqa: E402
+
+CALLERS = 5000
+EXTENSIONS = 300
+DIALSTATUS = ("ANSWER", "ANSWER", "ANSWER", "NOANSWER", "BUSY", "CANCEL", None)
+
+
+def fill(hist, calls, start):
+    """Record calls finished one per second from start, return the per call time"""
+    rnd = random.Random(42)
+    states = []
+    for i in range(calls):
+        state = call_store.CallState("%d.%d" % (start, i), from_num="+49 30 %07d" % rnd.randrange(CALLERS), from_name="Caller",
+                                     to_num="%d" % (200 + rnd.randrange(EXTENSIONS)), direction="in", ts="%d.%06d" % (start, i))
+        state.dialstatus = rnd.choice(DIALSTATUS)
+        state.dialedtime = rnd.randrange(60)
+        state.answeredtime = rnd.randrange(600) if state.dialstatus == "ANSWER" else None
+        state.ts_in = datetime.datetime.fromtimestamp(start + i)
+        states.append(state)
+    now = time.time
+    elapsed = 0.0
+    try:
+        for i, state in enumerate(states):
+            # finished one second after the other
+            history.time.time = lambda i=i: start + i
+            started = time.perf_counter()
+            hist.add(state)
+            elapsed += time.perf_counter() - started
+    finally:
+        history.time.time = now
+    return elapsed / calls
+
+
+def query(client, url, repeat=20):
+    """Median response time and the JSON of the last response"""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = client.get(url)
+        times.append(time.perf_counter() - started)
+    assert response.status_code == 200, (url, response.status_code)
+    times.sort()
+    return times[len(times) // 2], response.get_json()
+
+
+def main():
+    capacity = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    hist = history.HISTORY
+    hist.configure(capacity)
+    start = int(time.time()) - 2 * capacity
+    per_call = fill(hist, 2 * capacity, start)
+    print("recorded %d calls, %d kept, %.2f us per call" % (2 * capacity, len(hist), per_call * 1e6))
+    records = [r for r in hist._records]  # pylint:disable=protected-access
+
+    errors = []
+    client = http_server.app.test_client()
+    last_hour = start + 2 * capacity - 3600
+    number = records[-1].from_num
+    digits = history.normalize(number)
+    checks = [
+        ("/calls?number=%s&limit=1000" % digits, sum(1 for r in records if history.normalize(r.from_num) == digits)),
+        ("/calls?number=4930000001*&limit=100000", sum(1 for r in records if history.normalize(r.from_num).startswith("4930000001"))),
+        ("/calls?since=%d&limit=100000" % last_hour, sum(1 for r in records if r.end >= last_hour)),
+        ("/calls?number=200&dialstatus=BUSY&limit=100000", sum(1 for r in records if r.to_num == "200" and r.dialstatus == "BUSY")),
+        ("/calls?limit=100", 100),
+    ]
+    print("%-50s %8s %10s" % ("query", "results", "ms"))
+    for url, expected in checks:
+        elapsed, result = query(client, url)
+        print("%-50s %8d %10.2f" % (url, len(result), elapsed * 1000))
+        if len(result) != expected:
+            errors.append("%s returned %d calls, expected %d" % (url, len(result), expected))
+    for url in ("/calls/stats?number=%s" % digits, "/calls/stats?by=number&since=-3600", "/calls/stats?by=hour&since=-86400", "/calls/stats"):
+        elapsed, result = query(client, url, repeat=5)
+        print("%-50s %8d %10.2f" % (url, len(result), elapsed * 1000))
+    total = sum(g["calls"] for g in query(client, "/calls/stats", repeat=1)[1])
+    if total != len(records):
+        errors.append("/calls/stats counted %d calls, expected %d" % (total, len(records)))
+    for e in errors:
+        print("  " + e)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
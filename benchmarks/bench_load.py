@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""End-to-end load benchmark: fake Asterisk -> slack_asterisk -> mock Slack API.
+
+Starts the mock Slack Web API (see mock_slack.py) and a slack_asterisk
+server process configured with its ``base_url``, then drives complete call
+lifecycles over FastAGI at the given rate and concurrency:
+
+full (default)
+    new call, ``slack-answered`` macro with ARG1, dialstatus, h extension
+answered
+    new call, macro, h extension carrying DIALSTATUS (the dialplan of the README)
+
+Reports throughput, p50/p99 latency per lifecycle phase as seen by Asterisk,
+p50/p99 of the server side phases and Slack requests (from /metrics, so
+within the histogram bucket resolution), the peak thread count and RSS of
+the server process and the mock Slack counters.
+
+Note that with the full lifecycle the h invocation arrives after the call
+was finished by dialstatus and is taken for a new call, which shows up as
+extra posts and as calls left in the store.
+
+Usage: python benchmarks/bench_load.py --calls 2000 --rate 200 --concurrency 50 --slack-latency 0.1
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+from fake_asterisk import session  # noqa: E402
+from mock_slack import MockSlackServer  # noqa: E402
+
+PHASES = ("new", "answered", "dialstatus", "hangup")
+
+SERVER_CONFIG = """
+[general]
+ip = 127.0.0.1
+port = {port}
+engine = {engine}
+var_fetch = {var_fetch}
+processes = {processes}
+
+[store]
+path = {store_path}
+
+[dispatch]
+workers = {workers}
+
+[ratelimit]
+enabled = {ratelimit}
+
+[transport]
+type = {transport}
+
+[capture]
+enabled = {capture_enabled}
+path = {capture_path}
+
+[tracing]
+enabled = {tracing_enabled}
+sample_rate = {trace_rate}
+capacity = 100000
+
+[http]
+port = {http_port}
+
+[slack]
+base_url = {base_url}
+"""
+
+
+def add_stack_arguments(argp):
+    """Options of the server under test and the mock Slack API, shared with replay_agi.py"""
+    argp.add_argument("--serve", help=argparse.SUPPRESS)
+    argp.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    argp.add_argument("--processes", type=int, default=1, help="prefork worker processes of the threaded engine")
+    argp.add_argument("--var-fetch", choices=("serial", "pipeline", "full"), default="full")
+    argp.add_argument("--workers", type=int, default=4, help="dispatch workers, 0 for inline Slack calls")
+    argp.add_argument("--ratelimit", action="store_true", help="enable the Slack rate limiter")
+    argp.add_argument("--transport", choices=("pooled", "urllib"), default="pooled", help="Slack HTTP transport of the server")
+    argp.add_argument("--capture-file", default="", help="capture the AGI sessions of the server to this file")
+    argp.add_argument("--trace-rate", type=float, default=0.0, help="fraction of calls traced by the server, 0 disables tracing")
+    argp.add_argument("--slack-latency", type=float, default=0.05)
+    argp.add_argument("--slack-jitter", type=float, default=0.0)
+    argp.add_argument("--slack-429", type=float, default=0.0, help="fraction of Slack requests answered with 429")
+    argp.add_argument("--slack-retry-after", type=float, default=1)
+    argp.add_argument("--slack-errors", type=float, default=0.0, help="fraction of Slack requests answered with ok=false")
+
+
+def start_mock_slack(args):
+    return MockSlackServer(latency=args.slack_latency, jitter=args.slack_jitter, ratelimit_rate=args.slack_429, retry_after=args.slack_retry_after, error_rate=args.slack_errors).start()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve(config_file):
+    """Server process: slack_asterisk with HTTP metrics, configured from config_file"""
+    from slack_asterisk import agi_server, aio_server, config, http_server, prefork  # pylint:disable=import-outside-toplevel
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    c = config.SlackAsteriskConfig(config_file).get_configobj()
+    http_server.start_http_server(c)
+    if c["general"]["processes"] > 1:
+        prefork.prefork_server(c["general"]["ip"], c["general"]["port"], c)
+    elif c["general"]["engine"] == "asyncio":
+        aio_server.aio_agi_server(c["general"]["ip"], c["general"]["port"], c)
+    else:
+        agi_server.agi_server(c["general"]["ip"], c["general"]["port"], c)
+
+
+def wait_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("server did not open port %d" % port)
+
+
+class ServerProcess(object):
+    """slack_asterisk in a child process, talking to the mock Slack API at base_url"""
+
+    def __init__(self, args, base_url):
+        self.args = args
+        self.port, self.http_port = free_port(), free_port()
+        self.store_dir = tempfile.mkdtemp(prefix="bench-store-")
+        with tempfile.NamedTemporaryFile("w", suffix=".conf", delete=False) as f:
+            f.write(SERVER_CONFIG.format(port=self.port, http_port=self.http_port, engine=args.engine, var_fetch=args.var_fetch, processes=args.processes, store_path=os.path.join(self.store_dir, "calls.db"),
+                                         workers=args.workers, ratelimit=args.ratelimit, transport=args.transport,
+                                         capture_enabled=bool(args.capture_file), capture_path=os.path.abspath(args.capture_file or "capture.jsonl"),
+                                         tracing_enabled=args.trace_rate > 0, trace_rate=args.trace_rate, base_url=base_url))
+        self.config_file = f.name
+        self.proc = None
+
+    @property
+    def address(self):
+        return ("127.0.0.1", self.port)
+
+    def describe(self):
+        a = self.args
+        return "%s engine%s, %s fetch, %d dispatch workers, %s transport, ratelimit %s, tracing %.0f%%, Slack latency %.0f ms" % (a.engine, " (%d processes)" % a.processes if a.processes > 1 else "", a.var_fetch, a.workers, a.transport, "on" if a.ratelimit else "off", a.trace_rate * 100, a.slack_latency * 1000)
+
+    def start(self):
+        env = dict(os.environ, SLACK_TOKEN="xoxb-bench", LOG_LEVEL="ERROR", PYTHONPATH=os.path.join(BENCH_DIR, ".."))
+        self.proc = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "bench_load.py"), "--serve", self.config_file], env=env)
+        wait_port(self.http_port)
+        wait_port(self.port)
+        return self
+
+    def status(self):
+        return proc_status(self.proc.pid)
+
+    def scrape(self):
+        return scrape(self.http_port)
+
+    def traces(self):
+        """Call timelines kept by the server"""
+        return json.loads(urllib.request.urlopen("http://127.0.0.1:%d/traces?limit=1000000" % self.http_port, timeout=5).read())
+
+    def drain(self, timeout=30.0):
+        """Wait until all dispatched messages are sent, return the final /metrics samples"""
+        deadline = time.monotonic() + timeout
+        samples = self.scrape()
+        while time.monotonic() < deadline and self._pending(samples):
+            time.sleep(0.1)
+            samples = self.scrape()
+        return samples
+
+    @staticmethod
+    def _pending(samples):
+        events = {labels[0][1]: v for (n, labels), v in samples.items() if n == "slack_asterisk_dispatch_events_total"}
+        if not events:
+            return False
+        return events["submitted"] > events["sent"] + events["failed"] + events["dropped"] + events["coalesced"]
+
+    def stop(self):
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc.wait(10)
+        os.unlink(self.config_file)
+        shutil.rmtree(self.store_dir, ignore_errors=True)
+
+
+def report_server(samples, slack):
+    """Print server side phase and Slack latencies from /metrics and the mock Slack counters"""
+    print("%-22s %7s %9s %9s" % ("server phase", "count", "p50 ms", "p99 ms"))
+    phases = histogram_quantiles(samples, "slack_asterisk_agi_phase_seconds", "phase")
+    for phase in ("env", "vars", "process", "queue", "slack"):
+        if phase in phases:
+            count, (p50, p99) = phases[phase]
+            print("%-22s %7d %9.2f %9.2f" % (phase, count, p50 * 1000, p99 * 1000))
+    for method, (count, (p50, p99)) in sorted(histogram_quantiles(samples, "slack_asterisk_slack_request_seconds", "method").items()):
+        errors = samples.get(("slack_asterisk_slack_errors_total", (("method", method),)), 0)
+        print("%-22s %7d %9.2f %9.2f  %d errors" % (method, count, p50 * 1000, p99 * 1000, errors))
+    print()
+    print("calls left in store: %d; dispatch: %s; unchanged updates skipped: %d" % (samples.get(("slack_asterisk_calls_in_flight", ()), 0), ", ".join("%s %d" % (labels[0][1], v) for (n, labels), v in sorted(samples.items()) if n == "slack_asterisk_dispatch_events_total"),
+                                                                              samples.get(("slack_asterisk_slack_updates_skipped_total", ()), 0)))
+    transport = ", ".join("%s %d" % (labels[0][1], v) for (n, labels), v in sorted(samples.items()) if n == "slack_asterisk_slack_transport_total")
+    if transport:
+        print("Slack connections: %s" % transport)
+    print("mock Slack: %s" % ", ".join("%s %d" % kv for kv in slack.stats.items()))
+
+
+def proc_status(pid):
+    """Return (threads, rss in MiB) of a process from /proc"""
+    threads = rss = 0
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("Threads:"):
+                threads = int(line.split()[1])
+            elif line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) / 1024.0
+    return threads, rss
+
+
+def scrape(port):
+    """Parse /metrics into {(name, labels): value}"""
+    text = urllib.request.urlopen("http://127.0.0.1:%d/metrics" % port, timeout=5).read().decode()
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name, _, value = line.rpartition(" ")
+        labels = ()
+        if "{" in name:
+            name, _, rest = name.partition("{")
+            labels = tuple(tuple(p.split("=", 1)) for p in rest.rstrip("}").replace('"', "").split(","))
+        samples[(name, labels)] = float(value)
+    return samples
+
+
+def histogram_quantiles(samples, name, label, quantiles=(0.5, 0.99)):
+    """Quantiles per label value from cumulative Prometheus buckets, linearly interpolated"""
+    series = {}
+    for (n, labels), value in samples.items():
+        if n != name + "_bucket":
+            continue
+        labels = dict(labels)
+        le = float(labels.pop("le"))
+        series.setdefault(labels.get(label, ""), []).append((le, value))
+    result = {}
+    for key, buckets in series.items():
+        buckets.sort()
+        total = buckets[-1][1]
+        if not total:
+            continue
+        values = []
+        for q in quantiles:
+            rank = q * total
+            lower_bound, lower_count = 0.0, 0.0
+            for bound, count in buckets:
+                if count >= rank:
+                    if bound == float("inf"):
+                        values.append(lower_bound)
+                    else:
+                        values.append(lower_bound + (bound - lower_bound) * (rank - lower_count) / max(count - lower_count, 1e-9))
+                    break
+                lower_bound, lower_count = bound, count
+        result[key] = (int(total), values)
+    return result
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class LoadGenerator(object):  # pylint:disable=too-many-instance-attributes
+    """Drives call lifecycles at a fixed arrival rate with bounded concurrency"""
+
+    def __init__(self, address, calls, rate, concurrency, lifecycle="full", hold=0.0, agi_latency=0.0):  # pylint:disable=too-many-arguments
+        self.address = address
+        self.calls = calls
+        self.rate = rate
+        self.concurrency = concurrency
+        self.lifecycle = lifecycle
+        self.hold = hold
+        self.agi_latency = agi_latency
+        self.latencies = {p: [] for p in PHASES}
+        self.failed = 0
+        self.late = 0
+        self._next = iter(range(calls))
+        self._lock = threading.Lock()
+        self._base = int(time.time())
+
+    def invocations(self, i):
+        uid = "%d.%d" % (self._base, i)
+        caller = {"agi_uniqueid": uid, "agi_callerid": "030%07d" % i, "agi_calleridname": "Caller %d" % i, "agi_extension": "100"}
+        yield "new", caller, {}
+        yield "answered", {"agi_uniqueid": uid + "1", "agi_callerid": "200", "agi_extension": "s"}, {"ARG1": uid, "DIALEDPEERNUMBER": "SIP/200"}
+        final = {"DIALSTATUS": "ANSWER", "DIALEDTIME": "12", "ANSWEREDTIME": "5"}
+        hangup = dict(caller, agi_extension="h")
+        if self.lifecycle == "full":
+            yield "dialstatus", dict(caller), final
+            yield "hangup", hangup, {"HANGUPCAUSE": "16"}
+        else:
+            yield "hangup", hangup, dict(final, HANGUPCAUSE="16")
+
+    def run_call(self, i):
+        for n, (phase, env, chan_vars) in enumerate(self.invocations(i)):
+            if n and self.hold:
+                time.sleep(self.hold)
+            start = time.perf_counter()
+            try:
+                session(self.address, env, chan_vars, self.agi_latency)
+            except OSError:
+                with self._lock:
+                    self.failed += 1
+                return
+            with self._lock:
+                self.latencies[phase].append(time.perf_counter() - start)
+
+    def worker(self, start):
+        while True:
+            with self._lock:
+                i = next(self._next, None)
+            if i is None:
+                return
+            delay = start + i / self.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -0.01:
+                with self._lock:
+                    self.late += 1
+            self.run_call(i)
+
+    def run(self):
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self.worker, args=(start,), daemon=True) for _ in range(self.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return time.perf_counter() - start
+
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    argp.add_argument("--calls", type=int, default=1000)
+    argp.add_argument("--rate", type=float, default=100.0, help="new calls per second")
+    argp.add_argument("--concurrency", type=int, default=50, help="calls in progress at most")
+    argp.add_argument("--lifecycle", choices=("full", "answered"), default="full")
+    argp.add_argument("--hold", type=float, default=0.0, help="seconds between the invocations of a call")
+    argp.add_argument("--agi-latency", type=float, default=0.0, help="Asterisk round trip latency")
+    add_stack_arguments(argp)
+    args = argp.parse_args()
+    if args.serve:
+        serve(args.serve)
+        return
+
+    slack = start_mock_slack(args)
+    server = ServerProcess(args, slack.base_url)
+    peak = [0, 0.0]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.1):
+            threads, rss = server.status()
+            peak[0], peak[1] = max(peak[0], threads), max(peak[1], rss)
+
+    try:
+        server.start()
+        idle_threads, idle_rss = server.status()
+        threading.Thread(target=sample, daemon=True).start()
+        gen = LoadGenerator(server.address, args.calls, args.rate, args.concurrency, args.lifecycle, args.hold, args.agi_latency)
+        elapsed = gen.run()
+        # let the dispatch queue drain before reading the Slack side numbers
+        samples = server.drain()
+        traces = server.traces() if args.trace_rate else []
+    finally:
+        done.set()
+        server.stop()
+
+    sessions = sum(len(v) for v in gen.latencies.values())
+    print(server.describe())
+    print("%d calls (%d failed, %d started late) in %.2f s: %.1f calls/s, %.1f AGI sessions/s" % (args.calls, gen.failed, gen.late, elapsed, (args.calls - gen.failed) / elapsed, sessions / elapsed))
+    print()
+    print("%-22s %7s %9s %9s %9s" % ("AGI phase (client)", "count", "p50 ms", "p99 ms", "max ms"))
+    for phase in PHASES:
+        values = gen.latencies[phase]
+        if values:
+            print("%-22s %7d %9.2f %9.2f %9.2f" % (phase, len(values), percentile(values, 0.5) * 1000, percentile(values, 0.99) * 1000, max(values) * 1000))
+    print()
+    print("server threads: %d idle, %d peak; RSS: %.1f MiB idle, %.1f MiB peak" % (idle_threads, peak[0], idle_rss, peak[1]))
+    print()
+    report_server(samples, slack)
+    if traces:
+        print("traces: %d calls, %d slow, %d spans" % (len(traces), sum(t["slow"] for t in traces), sum(len(t["spans"]) for t in traces)))
+
+
+if __name__ == "__main__":
+    main()
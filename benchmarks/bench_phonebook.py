@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Benchmark the phone book: load time, memory and lookup latency.
+
+Writes a CSV phone book with the given number of entries (plus switchboard
+and country prefixes) to a temporary file, loads it and looks up exact
+numbers, numbers behind a prefix and unknown numbers, without and with the
+LRU cache. Lookups with the cache replay a skewed stream where a few
+numbers call often.
+
+Usage: python benchmarks/bench_phonebook.py [entries] [lookups]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from slack_asterisk import phonebook  # noqa: E402
+
+
+def write_csv(path, entries):
+    rnd = random.Random(entries)
+    numbers = set()
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("Name;Phone;Mobile\n")
+        while len(numbers) < entries:
+            number = "0%d %d" % (rnd.randint(30, 999), rnd.randint(100000, 9999999))
+            if number in numbers:
+                continue
+            numbers.add(number)
+            f.write("Contact %d;%s;+49 171 %07d\n" % (len(numbers), number, len(numbers)))
+        for i in range(1000):
+            f.write("Company %d Switchboard;0%d %d*;\n" % (i, 40 + i % 50, 500000 + i))
+        f.write("Germany;+49*;\nAustria;+43*;\n")
+    return sorted(numbers)
+
+
+def timed(func, numbers, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for number in numbers:
+            func(number)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(numbers) * 1e6
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    rnd = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "phonebook.csv")
+        numbers = write_csv(path, entries)
+        print("%d entries, file %.1f MiB" % (entries, os.path.getsize(path) / 2**20))
+        start = time.perf_counter()
+        book = phonebook.Phonebook(path, cache_size=10000)
+        elapsed = time.perf_counter() - start
+        # loaded again for the memory use, tracing slows loading down a lot
+        tracemalloc.start()
+        index = phonebook.read_phonebook(path)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del index
+        print("loaded %d numbers and prefixes in %.2f s, index %.1f MiB (%.0f bytes/entry), peak while loading %.1f MiB"
+              % (len(book), elapsed, current / 2**20, current / len(book), peak / 2**20))
+
+        exact = [rnd.choice(numbers) for _ in range(lookups)]
+        assert book.index.lookup(exact[0]) is not None
+        prefix = ["0%d%d%02d" % (40 + i % 50, 500000 + i, rnd.randint(0, 99)) for i in (rnd.randint(0, 999) for _ in range(lookups))]
+        assert book.index.lookup(prefix[0]).startswith("Company")
+        country = ["+4930%07d" % rnd.randint(0, 9999999) for _ in range(lookups)]
+        unknown = ["0999%07d" % rnd.randint(0, 9999999) for _ in range(lookups)]
+        print()
+        print("%-28s %10s" % ("index lookup", "us/lookup"))
+        for name, stream in (("exact number", exact), ("switchboard prefix", prefix), ("country prefix", country), ("unknown number", unknown)):
+            print("%-28s %10.2f" % (name, timed(book.index.lookup, stream)))
+
+        # a few hot numbers make up most calls
+        hot = numbers[:500]
+        skewed = [rnd.choice(hot) if rnd.random() < 0.8 else rnd.choice(numbers) for _ in range(lookups)]
+        print("%-28s %10.2f" % ("skewed, index", timed(book.index.lookup, skewed)))
+        print("%-28s %10.2f" % ("skewed, LRU cache", timed(book.lookup, skewed)))
+        hits, misses = book.cache_stats()
+        print("cache hit rate %.1f%%" % (100.0 * hits / (hits + misses)))
+
+
+if __name__ == "__main__":
+    main()
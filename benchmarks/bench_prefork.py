@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Prefork scaling benchmark: AGI throughput by number of worker processes.
+
+For every process count, starts slack_asterisk (as bench_load.py does, with
+``[general] processes``) against the mock Slack API and drives call
+lifecycles (new call, dial macro with ARG1, h extension with DIALSTATUS)
+from several client processes, so the load generator is not bound to one
+core either. Reports calls and AGI sessions per second, the AGI latency as
+seen by Asterisk and checks that every call was posted once and its message
+ends in the final state although its sessions were spread over the workers.
+
+Server and clients share the CPU cores of this machine, so throughput can
+only scale up to about nproc / 2 workers.
+
+Usage: python benchmarks/bench_prefork.py --process-counts 1 2 4 --calls 4000 --clients 4 --concurrency 32
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+from bench_load import LoadGenerator, ServerProcess, add_stack_arguments, percentile, serve, start_mock_slack  # noqa: E402
+
+FINAL_TEXT = "Call ended"
+
+
+def run_client(address, client, calls, rate, concurrency, agi_latency):  # pylint:disable=too-many-arguments
+    """Load generator process, returns (elapsed, AGI latencies, failed calls)"""
+    gen = LoadGenerator(tuple(address), calls, rate, concurrency, "answered", agi_latency=agi_latency)
+    # uniqueids distinct from the other clients
+    gen._base = int(time.time()) * 100 + client  # pylint:disable=protected-access
+    elapsed = gen.run()
+    return elapsed, [v for values in gen.latencies.values() for v in values], gen.failed
+
+
+def run(args, processes, pool):
+    """Benchmark one process count, return a result row and the list of errors"""
+    args.processes = processes
+    slack = start_mock_slack(args)
+    server = ServerProcess(args, slack.base_url)
+    try:
+        server.start()
+        # all workers listen once the master is ready, give the last ones a moment
+        time.sleep(0.5 + 0.2 * processes)
+        per_client = args.calls // args.clients
+        jobs = [(server.address, client, per_client, args.rate / args.clients, args.concurrency, args.agi_latency) for client in range(args.clients)]
+        start = time.perf_counter()
+        results = pool.starmap(run_client, jobs)
+        elapsed = time.perf_counter() - start
+        samples = server.drain()
+    finally:
+        server.stop()
+    calls = per_client * args.clients
+    latencies = [v for _, values, _ in results for v in values]
+    failed = sum(f for _, _, f in results)
+    unfinished = sum(1 for texts in slack.texts.values() if FINAL_TEXT not in (texts[-1] or ""))
+    dropped = samples.get(("slack_asterisk_dispatch_events_total", (("result", "dropped"),)), 0)
+    errors = []
+    if failed:
+        errors.append("%d calls failed" % failed)
+    if dropped:
+        # the dispatch queue overflowed, that is load shedding and not a lost event
+        errors.append("%d Slack messages dropped by the full dispatch queue, not checking the messages" % dropped)
+    elif slack.stats["posts"] != calls:
+        errors.append("%d posts for %d calls" % (slack.stats["posts"], calls))
+    if unfinished and not dropped:
+        errors.append("%d messages without final state" % unfinished)
+    slack.shutdown()
+    row = (processes, calls / elapsed, len(latencies) / elapsed, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, slack.stats["posts"], slack.stats["updates"])
+    return row, errors
+
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    argp.add_argument("--process-counts", type=int, nargs="+", default=[1, 2, 4], help="numbers of worker processes to compare")
+    argp.add_argument("--calls", type=int, default=4000)
+    argp.add_argument("--rate", type=float, default=100000.0, help="new calls per second over all clients, the default is as fast as possible")
+    argp.add_argument("--clients", type=int, default=4, help="load generator processes")
+    argp.add_argument("--concurrency", type=int, default=32, help="calls in progress at most per client")
+    argp.add_argument("--agi-latency", type=float, default=0.0, help="Asterisk round trip latency")
+    add_stack_arguments(argp)
+    # enough dispatch workers that the Slack side of the master keeps up with the workers
+    argp.set_defaults(slack_latency=0.01, workers=16)
+    args = argp.parse_args()
+    if args.serve:
+        serve(args.serve)
+        return
+    logging.getLogger("slack_asterisk").setLevel(logging.ERROR)
+
+    print("%d calls from %d clients (concurrency %d each), %d CPU cores" % (args.calls, args.clients, args.concurrency, os.cpu_count()))
+    print("%-10s %10s %12s %9s %9s %7s %8s" % ("processes", "calls/s", "sessions/s", "p50 ms", "p99 ms", "posts", "updates"))
+    failed = False
+    with multiprocessing.get_context("spawn").Pool(args.clients) as pool:
+        baseline = None
+        for processes in args.process_counts:
+            row, errors = run(args, processes, pool)
+            baseline = baseline or row[1]
+            print("%-10d %10.1f %12.1f %9.2f %9.2f %7d %8d   x%.2f" % (row + (row[1] / baseline,)))
+            for e in errors:
+                print("  " + e)
+            failed = failed or any("dropped" not in e for e in errors)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
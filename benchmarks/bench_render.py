@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Benchmark message rendering: compiled templates vs. the previous code path.
+
+The previous code path (string concatenation in ``get_formatting``, strftime
+and the dialstatus text lookup on every event) is kept below for comparison.
+Renders the events of a typical call (ringing, established, ended) and
+checks that the default templates produce the same attachments.
+
+Usage: python benchmarks/bench_render.py [calls]
+"""
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from slack_asterisk import call_store, templates  # noqa: E402
+
+CONFIG = {"channel": "telefon", "username": "User", "emoji": ":telephone_receiver:"}
+
+LEGACY_DIALSTATUS_TEXT = {
+    "ANSWER": ("✅ Call ended", "good"),
+    "BUSY": ("⭕ Busy", "warning"),
+}
+
+
+def legacy_formatting(msg, msg_data, config, color="good"):
+    actions = None
+    if msg_data.direction == "out":
+        title = "➡️ "
+    else:
+        title = "⬅️ "
+    title += "Call from "
+    title += msg_data.from_num
+    if msg_data.from_name and msg_data.from_name != "anonymous":
+        title += " (%s) " % msg_data.from_name
+    if msg_data.title_text is not None:
+        title += " - " + msg_data.title_text
+    footer = "Time: %s" % msg_data.ts_in.strftime("%A %d.%m.%Y %H:%M:%S")
+    if msg_data.dialedtime is not None:
+        footer += " - Dialed for %s" % str(datetime.timedelta(seconds=msg_data.dialedtime))
+    if msg_data.answeredtime is not None:
+        footer += " - Answered for %s" % str(datetime.timedelta(seconds=msg_data.answeredtime))
+    if msg_data.color is not None:
+        color = msg_data.color
+    if msg_data.type is not None:
+        msg = "%s: %s" % (msg_data.type, msg)
+    return dict(color=color, title=title, text=msg, fallback=title[2:], username=config["username"], icon_emoji=config["emoji"], actions=actions, footer=footer)
+
+
+def legacy_call(state):
+    state.dialedtime = state.answeredtime = None
+    text = "📞 Incoming call (ringing)"
+    if state.info_text is not None:
+        text += " (%s)" % state.info_text
+    yield legacy_formatting(text, state, CONFIG)
+    yield legacy_formatting("☑️ Call established with %s" % state.to_num, state, CONFIG)
+    state.dialedtime, state.answeredtime = 12, 5
+    text, color = LEGACY_DIALSTATUS_TEXT.get("ANSWER", ("Unknown", "#333333"))
+    yield legacy_formatting(text + " from %s" % state.to_num, state, CONFIG, color)
+
+
+def template_call(t, state):
+    state.dialedtime = state.answeredtime = None
+    yield t.payload(t.ringing(state.direction, "100", state.info_text), state)
+    yield t.payload(t.established(state.to_num), state)
+    state.dialedtime, state.answeredtime = 12, 5
+    text, color = t.finished("ANSWER", state.direction, state.to_num)
+    yield t.payload(text, state, color)
+
+
+def make_state(i):
+    return call_store.CallState("1700000000.%d" % i, from_num="030%07d" % i, from_name="Caller %d" % i, to_num="200", direction="in", info_text="Support" if i % 2 else None)
+
+
+def run(name, render, calls, repeat=5):
+    best = None
+    for _ in range(repeat):
+        states = [make_state(i) for i in range(calls)]
+        start = time.perf_counter()
+        for state in states:
+            for _ in render(state):
+                pass
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("%-20s %8.2f us/event" % (name, best / (calls * 3) * 1e6))
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    t = templates.MessageTemplates(slack_config=CONFIG)
+    for i in range(10):
+        for old, new in zip(legacy_call(make_state(i)), template_call(t, make_state(i))):
+            # the fallback of the previous code path started with a stray space and variation selector
+            old["fallback"] = old["fallback"].lstrip("️ ")
+            assert [old] == new["attachments"], (old, new)
+    run("previous code path", legacy_call, calls)
+    run("compiled templates", lambda state: template_call(t, state), calls)
+    blocks = templates.MessageTemplates({"format": "blocks"}, CONFIG)
+    run("templates, blocks", lambda state: template_call(blocks, state), calls)
+
+
+if __name__ == "__main__":
+    main()
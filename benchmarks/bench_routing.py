@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Benchmark channel routing: compiled rule index vs. a linear scan over the rules.
+
+Generates rule sets of growing size (DIDs as exact extensions, area code
+prefixes of the caller-ID, Asterisk patterns, type and time-of-day rules)
+and routes random calls with the compiled :class:`routing.Router` and with
+a straightforward loop testing every rule. Both must return the same
+channels; the cost of the index should stay flat as the rules grow.
+
+Usage: python benchmarks/bench_routing.py [lookups]
+"""
+import datetime
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from slack_asterisk import routing  # noqa: E402
+
+NOW = datetime.datetime(2026, 10, 19, 10, 30)
+
+
+def make_rules(n):
+    rules = {}
+    for i in range(n):
+        kind = i % 5
+        spec = {"channels": ["chan%d" % i]}
+        if kind == 0:
+            spec["exten"] = ["%d" % (1000 + i)]
+        elif kind == 1:
+            spec["callerid"] = ["0%d*" % (30 + i)]
+        elif kind == 2:
+            spec["exten"] = ["_%dXX" % (5 + i % 4)]
+            spec["direction"] = ["out"]
+        elif kind == 3:
+            spec["exten"] = ["%d" % (1000 + i), "%d" % (2000 + i)]
+            spec["type"] = ["VIP"]
+        else:
+            spec["callerid"] = ["0%d*" % (30 + i)]
+            spec["time"] = ["08:00-18:00"]
+            spec["days"] = ["mon-fri"]
+        rules["rule%d" % i] = spec
+    return rules
+
+
+class LinearRouter(object):  # pylint:disable=too-few-public-methods
+    """Every rule tested in turn, the obvious implementation"""
+
+    def __init__(self, rules, default_channel):
+        self.default = [default_channel]
+        self.rules = []
+        for spec in rules.values():
+            self.rules.append((spec["channels"], [self._matcher(v) for v in spec.get("exten", [])], [self._matcher(v) for v in spec.get("callerid", [])],
+                               spec.get("direction", []), spec.get("type", []), routing.parse_days(spec.get("days", [])), routing.parse_times(spec.get("time", []))))
+
+    @staticmethod
+    def _matcher(value):
+        if value.startswith("_"):
+            return re.compile(routing.pattern_regex(value)).fullmatch
+        if value.endswith("*"):
+            return lambda number, prefix=value[:-1]: number.startswith(prefix)
+        return lambda number: number == value
+
+    def route(self, exten=None, callerid=None, direction=None, type=None, now=None):  # pylint:disable=redefined-builtin
+        now = now or datetime.datetime.now()
+        channels = []
+        for chans, extens, callerids, directions, types, days, times in self.rules:
+            if extens and (exten is None or not any(m(exten) for m in extens)):
+                continue
+            if callerids and (callerid is None or not any(m(callerid) for m in callerids)):
+                continue
+            if directions and direction not in directions or types and type not in types:
+                continue
+            if (days or times) and not routing.Rule("", chans, days, times).active(now.weekday(), now.hour * 60 + now.minute):
+                continue
+            channels.extend(c for c in chans if c not in channels)
+        return channels or self.default
+
+
+def make_calls(n, rules):
+    rnd = random.Random(n)
+    return [(str(rnd.randint(1000, 1000 + 2 * rules)), "0%d%06d" % (rnd.randint(20, 30 + rules), rnd.randint(0, 999999)),
+             rnd.choice(("in", "out")), rnd.choice((None, "VIP")), NOW) for _ in range(n)]
+
+
+def run(router, calls, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for call in calls:
+            router.route(*call)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(calls) * 1e6
+
+
+def main():
+    lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print("%6s %12s %12s" % ("rules", "index us", "linear us"))
+    for n in (10, 100, 500, 1000):
+        rules = make_rules(n)
+        calls = make_calls(lookups, n)
+        router = routing.Router(rules, "telefon")
+        linear = LinearRouter(rules, "telefon")
+        for call in calls[:2000]:
+            assert router.route(*call) == linear.route(*call), call
+        print("%6d %12.2f %12.2f" % (n, run(router, calls), run(linear, calls)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Startup benchmark: time from exec of slack-asterisk to its first AGI session.
+
+Starts ``python -m slack_asterisk.main -c <config>`` against the mock Slack
+API, like systemd would start the service, while a fake Asterisk keeps
+trying to open a FastAGI session for a new call. Measures, from the exec of
+the process:
+
+listen
+    the first TCP connection accepted by the kernel, i.e. the FastAGI port
+    is bound and listening; connections before are refused and the AGI call
+    of Asterisk fails
+session
+    the end of the first AGI session, i.e. the server handles connections
+ready
+    READY=1 sent to NOTIFY_SOCKET
+post
+    the first Slack message of the call received by the mock Slack API
+
+With ``--phonebook N`` the server loads a CSV phone book of N entries (see
+bench_phonebook.py), which is read in the background and must not delay the
+first session.
+
+Usage: python benchmarks/bench_startup.py [--runs 10] [--engine threaded|asyncio] [--no-http] [--phonebook 0]
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+from bench_load import free_port  # noqa: E402
+from bench_phonebook import write_csv  # noqa: E402
+from fake_asterisk import FakeChannel, env_block  # noqa: E402
+from mock_slack import MockSlackServer  # noqa: E402
+
+SERVER_CONFIG = """
+[general]
+ip = 127.0.0.1
+port = {port}
+engine = {engine}
+
+[dispatch]
+workers = 4
+
+[http]
+enabled = {http}
+port = {http_port}
+
+[phonebook]
+path = "{phonebook}"
+
+[slack]
+base_url = {base_url}
+"""
+
+PHASES = ("listen", "session", "ready", "post")
+
+
+def first_session(address, started, times, stop):
+    """Retry a FastAGI session until one succeeds, record when the port listened and the session ended"""
+    env = {"agi_uniqueid": "1700000000.1", "agi_callerid": "0301234567", "agi_calleridname": "Caller", "agi_extension": "100"}
+    while not stop.is_set():
+        try:
+            sock = socket.create_connection(address)
+        except OSError:
+            time.sleep(0.001)
+            continue
+        times.setdefault("listen", time.perf_counter() - started)
+        try:
+            sock.sendall(env_block(env))
+            FakeChannel({}).serve(sock, 0.0)
+        except OSError:
+            # accepted by the kernel but closed by the server, try again
+            continue
+        finally:
+            sock.close()
+        times["session"] = time.perf_counter() - started
+        return
+
+
+def run(args, slack, tmp, phonebook):
+    """Start the server once, return the seconds from exec to each phase"""
+    port, http_port = free_port(), free_port()
+    config_file = os.path.join(tmp, "slack-asterisk.conf")
+    with open(config_file, "w") as f:
+        f.write(SERVER_CONFIG.format(port=port, engine=args.engine, http=not args.no_http, http_port=http_port, base_url=slack.base_url, phonebook=phonebook))
+    notify_path = os.path.join(tmp, "notify")
+    notify = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    notify.bind(notify_path)
+    notify.settimeout(10)
+    posts = slack.stats["posts"]
+    env = dict(os.environ, SLACK_TOKEN="xoxb-startup", LOG_LEVEL="ERROR", NOTIFY_SOCKET=notify_path, PYTHONPATH=os.path.join(BENCH_DIR, ".."))
+    times = {}
+    stop = threading.Event()
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-m", "slack_asterisk.main", "-c", config_file], env=env)
+    client = threading.Thread(target=first_session, args=(("127.0.0.1", port), started, times, stop), daemon=True)
+    client.start()
+    try:
+        while "ready" not in times:
+            if notify.recv(1024) == b"READY=1":
+                times["ready"] = time.perf_counter() - started
+        deadline = time.monotonic() + 10
+        while slack.stats["posts"] == posts and time.monotonic() < deadline:
+            time.sleep(0.001)
+        times["post"] = time.perf_counter() - started
+        client.join(10)
+    finally:
+        stop.set()
+        proc.terminate()
+        proc.wait(30)
+        notify.close()
+        os.unlink(notify_path)
+    return times
+
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    argp.add_argument("--runs", type=int, default=10)
+    argp.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    argp.add_argument("--no-http", action="store_true", help="disable the HTTP server (Flask)")
+    argp.add_argument("--phonebook", type=int, default=0, help="entries of a phone book loaded at startup, 0 for none")
+    args = argp.parse_args()
+
+    slack = MockSlackServer(latency=0.0).start()
+    results = []
+    with tempfile.TemporaryDirectory(prefix="bench-startup-") as tmp:
+        phonebook = ""
+        if args.phonebook:
+            phonebook = os.path.join(tmp, "phonebook.csv")
+            write_csv(phonebook, args.phonebook)
+        for _ in range(args.runs):
+            results.append(run(args, slack, tmp, phonebook))
+    slack.shutdown()
+    print("%s engine, HTTP server %s, %d phone book entries, %d runs, ms from exec" % (args.engine, "off" if args.no_http else "on", args.phonebook, args.runs))
+    print("%-8s %8s %8s %8s" % ("phase", "min", "median", "max"))
+    for phase in PHASES:
+        values = sorted(t[phase] * 1000 for t in results if phase in t)
+        if values:
+            print("%-8s %8.1f %8.1f %8.1f" % (phase, values[0], values[len(values) // 2], values[-1]))
+    failed = sum(1 for t in results if "session" not in t)
+    if failed:
+        print("  %d runs without a successful AGI session" % failed)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Stand-in Asterisk Manager Interface server replaying event scripts.
+
+A script is a text file of AMI events as Asterisk sends them, separated by
+blank lines. A ``Delay: <seconds>`` line in an event is not sent but waited
+before the event (relative to the previous one, divided by --speed)::
+
+    Event: Newchannel
+    Channel: SIP/provider-00000001
+    Uniqueid: 1700000000.1
+    Linkedid: 1700000000.1
+    ...
+
+    Delay: 2.5
+    Event: DialEnd
+    ...
+
+Every client that logs in gets the whole script. Without a script file,
+synthetic calls with all outcomes (answered, busy, not answered, canceled,
+answered in a queue) are generated.
+
+Run without --listen to check the AMI engine end to end: the engine runs
+in-process with the dispatch workers against the mock Slack API, and every
+call must be posted once and be finished when the script has been played.
+
+Usage: python benchmarks/fake_ami.py [--script calls.txt] [--calls 100] [--speed 0]
+       python benchmarks/fake_ami.py --listen 127.0.0.1:5038 --dump-script calls.txt
+"""
+import argparse
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from slack_asterisk import ami, config, dispatch, metrics, ratelimit, transport  # noqa: E402
+from mock_slack import MockSlackServer  # noqa: E402
+
+OUTCOMES = ("answered", "busy", "noanswer", "cancel", "queue")
+
+
+def read_script(path):
+    """Load a script file as a list of (delay, event lines)"""
+    events = []
+    block = []
+    with open(path, encoding="utf-8") as f:
+        for line in list(f) + [""]:
+            line = line.rstrip("\r\n")
+            if line:
+                block.append(line)
+                continue
+            if block:
+                delay = 0.0
+                if block[0].startswith("Delay:"):
+                    delay = float(block.pop(0).split(":", 1)[1])
+                events.append((delay, block))
+                block = []
+    return events
+
+
+def write_script(path, events):
+    with open(path, "w", encoding="utf-8") as f:
+        for delay, lines in events:
+            if delay:
+                f.write("Delay: %g\n" % delay)
+            f.write("\n".join(lines) + "\n\n")
+
+
+def _event(name, **headers):
+    return ["Event: %s" % name, "Privilege: call,all"] + ["%s: %s" % kv for kv in headers.items()]
+
+
+def call_events(i, outcome, ring=0.02, talk=0.05):
+    """AMI events of one synthetic incoming call, as (delay, lines)"""
+    uniqueid = "1700000000.%d" % (i * 10)
+    caller = dict(Channel="SIP/provider-%08x" % i, CallerIDNum="030%07d" % i, CallerIDName="Caller %d" % i,
+                  Context="from-provider", Exten="100", Uniqueid=uniqueid, Linkedid=uniqueid)
+    dest_uniqueid = "1700000000.%d" % (i * 10 + 1)
+    dest = dict(DestChannel="SIP/200-%08x" % i, DestCallerIDNum="200", DestCallerIDName="Reception", DestUniqueid=dest_uniqueid, DestLinkedid=uniqueid)
+    agent = dict(Channel=dest["DestChannel"], CallerIDNum="200", CallerIDName="Reception", Uniqueid=dest_uniqueid, Linkedid=uniqueid)
+    events = [
+        (0.0, _event("Newchannel", ChannelState="4", ChannelStateDesc="Ring", **caller)),
+        (0.0, _event("Newchannel", ChannelState="0", ChannelStateDesc="Down", **agent)),
+        (0.0, _event("DialBegin", DialString="200", **caller, **dest)),
+    ]
+    if outcome == "answered":
+        events += [(ring, _event("DialEnd", DialStatus="ANSWER", **caller, **dest)),
+                   (0.0, _event("BridgeEnter", BridgeUniqueid="b%d" % i, **caller)),
+                   (0.0, _event("BridgeEnter", BridgeUniqueid="b%d" % i, **agent)),
+                   (talk, _event("Hangup", Cause="16", **agent)),
+                   (0.0, _event("Hangup", Cause="16", **caller))]
+    elif outcome == "queue":
+        # answered by a queue member: the member channel enters the bridge, no DialEnd ANSWER for the caller
+        events += [(ring, _event("BridgeEnter", BridgeUniqueid="b%d" % i, **agent)),
+                   (0.0, _event("BridgeEnter", BridgeUniqueid="b%d" % i, **caller)),
+                   (talk, _event("Hangup", Cause="16", **caller))]
+    elif outcome == "cancel":
+        events += [(ring, _event("Hangup", Cause="16", **caller)),
+                   (0.0, _event("DialEnd", DialStatus="CANCEL", **caller, **dest)),
+                   (0.0, _event("Hangup", Cause="16", **agent))]
+    else:
+        events += [(ring, _event("DialEnd", DialStatus=outcome.upper(), **caller, **dest)),
+                   (0.0, _event("Hangup", Cause="17" if outcome == "busy" else "19", **agent)),
+                   (0.0, _event("Hangup", Cause="16", **caller))]
+    return events
+
+
+def synthetic_script(calls, interval=0.01):
+    """Interleaved events of calls started every interval seconds"""
+    timeline = []
+    for i in range(calls):
+        t = i * interval
+        for delay, lines in call_events(i, OUTCOMES[i % len(OUTCOMES)]):
+            t += delay
+            timeline.append((t, len(timeline), lines))
+    timeline.sort()
+    events = []
+    last = 0.0
+    for t, _, lines in timeline:
+        events.append((round(t - last, 6), lines))
+        last = t
+    return events
+
+
+class FakeAMIServer(socketserver.ThreadingTCPServer):
+    """Answers Login/Logoff and sends the script to every logged in client
+
+    :param events: list of (delay, event lines)
+    :param speed: delay divisor, 0 sends without delays
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, events, speed=1.0, username="slack", secret="secret"):  # pylint:disable=too-many-arguments
+        super().__init__(address, FakeAMIHandler)
+        self.events = events
+        self.speed = speed
+        self.username = username
+        self.secret = secret
+        self.done = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-ami", daemon=True).start()
+        return self
+
+
+class FakeAMIHandler(socketserver.StreamRequestHandler):
+
+    def _send(self, lines):
+        self.wfile.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+
+    def _action(self):
+        action = {}
+        for line in self.rfile:
+            line = line.decode().rstrip("\r\n")
+            if not line:
+                if action:
+                    return action
+                continue
+            key, _, value = line.partition(":")
+            action[key] = value.strip()
+        return None
+
+    def handle(self):
+        server = self.server
+        self.wfile.write(b"Asterisk Call Manager/9.0.0\r\n")
+        action = self._action()
+        if action is None or action.get("Action") != "Login":
+            return
+        if (action.get("Username"), action.get("Secret")) != (server.username, server.secret):
+            self._send(["Response: Error", "ActionID: %s" % action.get("ActionID"), "Message: Authentication failed"])
+            return
+        self._send(["Response: Success", "ActionID: %s" % action.get("ActionID"), "Message: Authentication accepted"])
+        self._send(["Event: FullyBooted", "Privilege: system,all", "Status: Fully Booted"])
+        for delay, lines in server.events:
+            if delay and server.speed:
+                time.sleep(delay / server.speed)
+            self._send(lines)
+        server.done.set()
+        # keep the connection open like Asterisk until the client logs off
+        self._action()
+
+
+CONFIG = """
+[general]
+engine = ami
+
+[ami]
+host = 127.0.0.1
+port = {port}
+username = slack
+secret = secret
+reconnect_interval = 0.5
+
+[dispatch]
+workers = {workers}
+
+[ratelimit]
+enabled = False
+
+[slack]
+base_url = {base_url}
+"""
+
+
+def check(args, events):
+    slack = MockSlackServer(latency=args.slack_latency).start()
+    server = FakeAMIServer(("127.0.0.1", 0), events, args.speed).start()
+    with tempfile.NamedTemporaryFile("w", suffix=".conf", delete=False) as f:
+        f.write(CONFIG.format(port=server.server_address[1], workers=args.workers, base_url=slack.base_url))
+    try:
+        c = config.SlackAsteriskConfig(f.name).get_configobj()
+    finally:
+        os.unlink(f.name)
+    client = transport.create_client(c, "xoxb-fake-ami")
+    sc = ratelimit.create_client(metrics.InstrumentedClient(client), c)
+    dispatcher = dispatch.create_dispatcher(sc, c)
+    service = ami.AMIService(c, sc, dispatcher)
+    start = time.perf_counter()
+    threading.Thread(target=service.run, daemon=True).start()
+    server.done.wait()
+    # the last events may still be in the socket buffer
+    while service.tracker.stats["events"] < sum(1 for _, lines in events if lines[0].split(": ", 1)[1] in ("Newchannel", "DialBegin", "DialEnd", "BridgeEnter", "Hangup")):
+        time.sleep(0.01)
+    played = time.perf_counter() - start
+    if dispatcher is not None:
+        dispatcher.stop(30)
+    service.stop()
+    calls = service.tracker.stats["calls"]
+    print("%d events, %d calls played in %.2f s" % (len(events), calls, played))
+    print("tracker: %s; calls left in store: %d, in tracker: %d" % (service.tracker.stats, len(service.call_store), len(service.tracker)))
+    if dispatcher is not None:
+        print("dispatch: %s" % ", ".join("%s %d" % (k, v) for k, v in dispatcher.stats.items() if k in ("submitted", "sent", "failed", "coalesced", "dropped")))
+    print("mock Slack: %s" % ", ".join("%s %d" % kv for kv in slack.stats.items()))
+    errors = []
+    if slack.stats["posts"] != calls:
+        errors.append("%d posts for %d calls" % (slack.stats["posts"], calls))
+    if len(service.call_store):
+        errors.append("%d calls not finished" % len(service.call_store))
+    if dispatcher is not None and dispatcher.stats["failed"]:
+        errors.append("%d Slack messages failed" % dispatcher.stats["failed"])
+    for e in errors:
+        print("  " + e)
+    return not errors
+
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    argp.add_argument("--script", help="AMI event script, synthetic calls if not given")
+    argp.add_argument("--calls", type=int, default=100, help="number of synthetic calls")
+    argp.add_argument("--interval", type=float, default=0.01, help="seconds between synthetic calls")
+    argp.add_argument("--speed", type=float, default=1.0, help="replay speed factor, 0 for as fast as possible")
+    argp.add_argument("--dump-script", help="write the script to this file")
+    argp.add_argument("--listen", help="ip:port to serve the script on until interrupted instead of the end-to-end check")
+    argp.add_argument("--workers", type=int, default=4, help="dispatch workers of the engine, 0 for inline Slack calls")
+    argp.add_argument("--slack-latency", type=float, default=0.01)
+    args = argp.parse_args()
+
+    events = read_script(args.script) if args.script else synthetic_script(args.calls, args.interval)
+    if args.dump_script:
+        write_script(args.dump_script, events)
+    if args.listen:
+        ip, _, port = args.listen.rpartition(":")
+        server = FakeAMIServer((ip, int(port)), events, args.speed)
+        print("Serving %d events on %s (user slack, secret secret)" % (len(events), args.listen))
+        server.serve_forever()
+        return
+    sys.exit(0 if check(args, events) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# coding=utf-8
+"""Minimal stand-in for the Asterisk side of a FastAGI session.
+
+Understands the commands slack_asterisk sends (GET VARIABLE, GET FULL VARIABLE,
+SET VARIABLE) and answers them from a dict of channel variables. An optional
+latency is added once per batch of commands received, which models the
+round trip between Asterisk and the FastAGI server.
+"""
+import re
+import socket
+import time
+
+_RE_EXPR = re.compile(r"\$\{([^}]+)\}")
+
+
+class FakeChannel(object):
+    """Channel variables and AGI command evaluation of a single AGI invocation"""
+
+    def __init__(self, chan_vars=None):
+        self.vars = dict(chan_vars or {})
+        self.commands = 0
+        self.set_commands = []
+        self.round_trips = 0
+
+    def _unquote(self, arg):
+        arg = arg.strip()
+        if len(arg) >= 2 and arg[0] == '"' and arg[-1] == '"':
+            arg = arg[1:-1].replace('\\"', '"')
+        return arg
+
+    def reply(self, cmd):
+        self.commands += 1
+        if cmd.startswith("GET VARIABLE "):
+            value = self.vars.get(cmd[13:].strip())
+            if value is None:
+                return "200 result=0"
+            return "200 result=1 (%s)" % value
+        if cmd.startswith("GET FULL VARIABLE "):
+            expr = self._unquote(cmd[18:])
+            return "200 result=1 (%s)" % _RE_EXPR.sub(lambda m: self.vars.get(m.group(1), ""), expr)
+        if cmd.startswith("SET VARIABLE "):
+            self.set_commands.append(cmd)
+            name, _, value = cmd[13:].partition(" ")
+            self.vars[name] = self._unquote(value)
+            return "200 result=1"
+        return "510 Invalid or unknown command"
+
+    def serve(self, sock, latency=0.0):
+        """Answer commands on sock until the FastAGI server closes the connection"""
+        buf = b""
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return
+            buf += chunk
+            *lines, buf = buf.split(b"\n")
+            if not lines:
+                continue
+            self.round_trips += 1
+            if latency:
+                time.sleep(latency)
+            sock.sendall(b"".join((self.reply(line.decode().strip()) + "\n").encode() for line in lines))
+
+
+def env_block(env):
+    return b"".join(("%s: %s\n" % (k, v)).encode() for k, v in env.items()) + b"\n"
+
+
+def session(address, env, chan_vars, latency=0.0):
+    """Run one complete AGI invocation against a FastAGI server.
+
+    :return: FakeChannel with command and round trip counters
+    """
+    channel = FakeChannel(chan_vars)
+    sock = socket.create_connection(address)
+    try:
+        sock.sendall(env_block(env))
+        channel.serve(sock, latency)
+    finally:
+        sock.close()
+    return channel
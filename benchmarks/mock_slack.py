@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Local stand-in for the Slack Web API.
+
+Answers ``chat.postMessage`` and ``chat.update`` (JSON or form encoded) like
+Slack does, after a configurable latency. A fraction of the requests can be
+answered with HTTP 429 and a ``Retry-After`` header, or with an API error.
+Point slack_sdk's WebClient at it with ``base_url="http://ip:port/api/"``
+(``base_url`` in the ``[slack]`` config section).
+
+Usage: python benchmarks/mock_slack.py [port] [latency] [ratelimit rate] [error rate]
+"""
+import http.server
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+CHANNEL_ID = "C0TELEFON"
+
+
+class MockSlackServer(http.server.ThreadingHTTPServer):
+    """Mock Slack Web API
+
+    :param latency: seconds before each answer
+    :param jitter: random additional latency up to this many seconds
+    :param ratelimit_rate: fraction of requests answered with HTTP 429
+    :param retry_after: Retry-After value sent with a 429
+    :param error_rate: fraction of requests answered with ok=false
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address=("127.0.0.1", 0), latency=0.0, jitter=0.0, ratelimit_rate=0.0, retry_after=1, error_rate=0.0):  # pylint:disable=too-many-arguments
+        super().__init__(address, MockSlackHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.ratelimit_rate = ratelimit_rate
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.counter = itertools.count(1)
+        self.stats = dict(requests=0, posts=0, updates=0, ratelimited=0, errors=0)
+        # ts -> texts of the post and the updates of a message
+        self.texts = {}
+
+    @property
+    def base_url(self):
+        return "http://%s:%d/api/" % self.server_address[:2]
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def record(self, ts, params):
+        attachments = params.get("attachments")
+        if isinstance(attachments, str):
+            attachments = json.loads(attachments)
+        text = attachments[0].get("text") or attachments[0].get("fallback") if attachments else params.get("text")
+        with self.lock:
+            self.texts.setdefault(ts, []).append(text)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="mock-slack", daemon=True).start()
+        return self
+
+
+class MockSlackHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # pylint:disable=redefined-builtin
+        pass
+
+    def _params(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(body or b"{}")
+        return {k: v[0] for k, v in urllib.parse.parse_qs(body.decode()).items()}
+
+    def _answer(self, status, data, headers=()):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):  # noqa: N802
+        server = self.server
+        params = self._params()
+        method = self.path.rsplit("/", 1)[-1]
+        server.count("requests")
+        delay = server.latency + (random.uniform(0, server.jitter) if server.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+        if server.ratelimit_rate and random.random() < server.ratelimit_rate:
+            server.count("ratelimited")
+            self._answer(429, {"ok": False, "error": "ratelimited"}, [("Retry-After", str(server.retry_after))])
+            return
+        if server.error_rate and random.random() < server.error_rate:
+            server.count("errors")
+            self._answer(200, {"ok": False, "error": "internal_error"})
+            return
+        if method == "chat.postMessage":
+            server.count("posts")
+            ts = "%d.%06d" % (time.time(), next(server.counter) % 1000000)
+            server.record(ts, params)
+            self._answer(200, {"ok": True, "channel": CHANNEL_ID, "ts": ts, "message": {"text": ""}})
+        elif method == "chat.update":
+            server.count("updates")
+            server.record(params.get("ts"), params)
+            self._answer(200, {"ok": True, "channel": params.get("channel", CHANNEL_ID), "ts": params.get("ts"), "text": ""})
+        elif method == "auth.test":
+            self._answer(200, {"ok": True, "url": "https://mock.slack.com/", "team": "mock", "user": "slack_asterisk", "team_id": "T0MOCK", "user_id": "U0MOCK"})
+        else:
+            self._answer(200, {"ok": False, "error": "unknown_method"})
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8099
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    ratelimit_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    error_rate = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+    server = MockSlackServer(("127.0.0.1", port), latency=latency, ratelimit_rate=ratelimit_rate, error_rate=error_rate)
+    print("Mock Slack API on %s" % server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(server.stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Replay a capture of AGI sessions (see slack_asterisk/capture.py).
+
+Every captured session is replayed with its original environment. The
+channel variables are reconstructed from the recorded GET VARIABLE / GET FULL
+VARIABLE replies, so the server under test may use a different var_fetch
+strategy than the one captured. Sessions start at their original offsets
+divided by --speed (1 for real time, 0 for as fast as possible); sessions of
+the same call are always replayed one after the other in captured order.
+
+The SET VARIABLE commands sent by the server are compared with the captured
+ones, a difference is reported as a regression (exit status 1).
+
+Without --target the mock Slack API and a server process are started as in
+bench_load.py, which also reports the server side latencies.
+
+Usage: python benchmarks/replay_agi.py capture.jsonl --speed 10
+       python benchmarks/replay_agi.py capture.jsonl --speed 0 --target 127.0.0.1:4574
+"""
+import argparse
+import os
+import re
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from slack_asterisk import agi_protocol, agi_vars, capture  # noqa: E402
+from bench_load import ServerProcess, add_stack_arguments, percentile, report_server, start_mock_slack  # noqa: E402
+from fake_asterisk import FakeChannel, env_block  # noqa: E402
+
+_RE_VAR = re.compile(r"^\$\{([^}]+)\}$")
+
+
+def channel_vars(io):
+    """Reconstruct the channel variables of a session from its command/reply pairs
+
+    :return: tuple (dict of Asterisk variables, list of SET VARIABLE commands)
+    """
+    variables = {}
+    sets = []
+    pending = []
+    usage = False
+    for _, direction, line in io:
+        if direction == ">":
+            pending.append(line)
+            continue
+        if usage:
+            # usage text of a 520 reply, ends with a "520 " line
+            usage = not line.startswith("520 ")
+            continue
+        if line == "HANGUP" or not pending:
+            continue
+        cmd = pending.pop(0)
+        if line.startswith("520-"):
+            usage = True
+            continue
+        res = agi_protocol.parse_reply(line.encode())
+        if cmd.startswith("SET VARIABLE "):
+            sets.append(cmd)
+        elif res is None or res.code != 200 or res.result != 1:
+            continue
+        elif cmd.startswith("GET VARIABLE "):
+            variables[cmd[13:].strip()] = res.data or ""
+        elif cmd.startswith("GET FULL VARIABLE "):
+            expressions = cmd[18:].strip().strip('"').split(agi_vars.DELIMITER)
+            values = (res.data or "").split(agi_vars.DELIMITER)
+            if len(expressions) == len(values):
+                for expr, value in zip(expressions, values):
+                    m = _RE_VAR.match(expr)
+                    if m and value:
+                        variables[m.group(1)] = value
+    return variables, sets
+
+
+class Session(object):  # pylint:disable=too-few-public-methods
+    __slots__ = ("offset", "env", "vars", "sets", "call")
+
+    def __init__(self, record, start):
+        self.offset = record["start"] - start
+        self.env = record["env"]
+        self.vars, self.sets = channel_vars(record["io"])
+        # same key as calls.call_key: the call reference of the dial macro, else the uniqueid
+        self.call = self.vars.get("ARG1") or self.env.get("agi_uniqueid")
+
+
+def load(path):
+    records = sorted((r for r in capture.read_capture(path) if r.get("env")), key=lambda r: r["start"])
+    if not records:
+        return []
+    start = records[0]["start"]
+    return [Session(r, start) for r in records]
+
+
+class Replayer(object):
+    """Replays sessions grouped per call with a pool of worker threads"""
+
+    def __init__(self, address, sessions, speed=1.0, concurrency=200):
+        self.address = address
+        self.speed = speed
+        calls = {}
+        for s in sessions:
+            calls.setdefault(s.call, []).append(s)
+        # calls in order of their first session
+        self.calls = sorted(calls.values(), key=lambda c: c[0].offset)
+        self.concurrency = concurrency
+        self.latencies = []
+        self.mismatches = []
+        self.failed = 0
+        self.late = 0
+        self._next = iter(self.calls)
+        self._lock = threading.Lock()
+
+    def replay(self, session):
+        channel = FakeChannel(session.vars)
+        start = time.perf_counter()
+        try:
+            with socket.create_connection(self.address) as sock:
+                sock.sendall(env_block(session.env))
+                channel.serve(sock)
+        except OSError:
+            with self._lock:
+                self.failed += 1
+            return
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.latencies.append(elapsed)
+            if channel.set_commands != session.sets:
+                self.mismatches.append((session, channel.set_commands))
+
+    def worker(self, start):
+        while True:
+            with self._lock:
+                call = next(self._next, None)
+            if call is None:
+                return
+            for session in call:
+                if self.speed:
+                    delay = start + session.offset / self.speed - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    elif delay < -0.01:
+                        with self._lock:
+                            self.late += 1
+                self.replay(session)
+
+    def run(self):
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self.worker, args=(start,), daemon=True) for _ in range(min(self.concurrency, len(self.calls)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return time.perf_counter() - start
+
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    argp.add_argument("capture", nargs="?")
+    argp.add_argument("--speed", type=float, default=1.0, help="replay speed factor, 0 for as fast as possible")
+    argp.add_argument("--concurrency", type=int, default=200, help="calls replayed at the same time at most")
+    argp.add_argument("--target", help="ip:port of a running server instead of starting one with the mock Slack API")
+    add_stack_arguments(argp)
+    args = argp.parse_args()
+    if not args.capture:
+        argp.error("the capture file is required")
+
+    sessions = load(args.capture)
+    if not sessions:
+        print("No sessions in %s" % args.capture)
+        return
+    slack = server = None
+    if args.target:
+        ip, _, port = args.target.rpartition(":")
+        address = (ip, int(port))
+    else:
+        slack = start_mock_slack(args)
+        server = ServerProcess(args, slack.base_url).start()
+        address = server.address
+    try:
+        replayer = Replayer(address, sessions, args.speed, args.concurrency)
+        elapsed = replayer.run()
+        samples = server.drain() if server is not None else None
+    finally:
+        if server is not None:
+            server.stop()
+
+    print("%d sessions of %d calls, captured over %.1f s, replayed at %s in %.2f s (%d failed, %d started late): %.1f sessions/s"
+          % (len(sessions), len(replayer.calls), sessions[-1].offset, "%gx" % args.speed if args.speed else "full speed", elapsed, replayer.failed, replayer.late, len(replayer.latencies) / elapsed))
+    print("session latency: p50 %.2f ms, p99 %.2f ms, max %.2f ms" % (percentile(replayer.latencies, 0.5) * 1000, percentile(replayer.latencies, 0.99) * 1000, max(replayer.latencies, default=0) * 1000))
+    if server is not None:
+        print(server.describe())
+        print()
+        report_server(samples, slack)
+    print()
+    print("%d sessions with SET VARIABLE commands differing from the capture" % len(replayer.mismatches))
+    for session, sets in replayer.mismatches[:10]:
+        print("  %s %s: captured %s, replayed %s" % (session.env.get("agi_uniqueid"), session.env.get("agi_extension"), session.sets, sets))
+    sys.exit(1 if replayer.mismatches or replayer.failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Stress test: overlapping AGI sessions of the same call.
+
+For every call the dial macro and the h extension are fired concurrently
+while the initial Slack post of the call is still in flight (the fake Slack
+client answers with random latency). Checks that no update is sent without
+the ts of the posted message, that every message starts with its post and
+that the last update of each call shows its final state.
+
+Runs with inline Slack calls and with the dispatch queue. Exits with status 1
+on any ordering violation.
+
+Usage: python benchmarks/stress_call_ordering.py [calls] [dispatch workers]
+"""
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from slack_asterisk import agi_server, dispatch  # noqa: E402
+from fake_asterisk import session  # noqa: E402
+
+logging.getLogger("slack_asterisk").setLevel(logging.ERROR)
+
+CONFIG = {"channel": "telefon", "username": "User", "emoji": ":telephone_receiver:"}
+
+
+class SlowSlack(object):
+    """Records all calls, answers after a random delay"""
+
+    def __init__(self, max_delay=0.05):
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.log = []
+        self.counter = 0
+
+    def chat_postMessage(self, **kwargs):  # noqa: N802
+        time.sleep(random.uniform(0, self.max_delay))
+        with self.lock:
+            self.counter += 1
+            ts = "1700000000.%06d" % self.counter
+            self.log.append(("post", ts, kwargs["attachments"][0]["text"]))
+        return {"ok": True, "ts": ts, "channel": "C0TELEFON"}
+
+    def chat_update(self, **kwargs):
+        time.sleep(random.uniform(0, self.max_delay))
+        with self.lock:
+            self.log.append(("update", kwargs["ts"], kwargs["attachments"][0]["text"]))
+        return {"ok": True, "ts": kwargs["ts"], "channel": kwargs["channel"]}
+
+
+def run_call(server, i):
+    addr = server.server_address
+    uniqueid = "1700000000.%d" % i
+    first = threading.Thread(target=session, args=(addr, {"agi_uniqueid": uniqueid, "agi_callerid": "030%07d" % i, "agi_extension": "100"}, {}))
+    first.start()
+    # wait until the call is known, then overlap with the still running post
+    while uniqueid not in server.call_store:
+        time.sleep(0.0005)
+    macro = threading.Thread(target=session, args=(addr, {"agi_uniqueid": uniqueid + "1", "agi_callerid": "200", "agi_extension": "s"}, {"ARG1": uniqueid, "DIALEDPEERNUMBER": "SIP/200"}))
+    hangup = threading.Thread(target=session, args=(addr, {"agi_uniqueid": uniqueid, "agi_extension": "h"}, {"DIALSTATUS": "ANSWER", "ANSWEREDTIME": "5", "HANGUPCAUSE": "16"}))
+    macro.start()
+    time.sleep(random.uniform(0, 0.005))
+    hangup.start()
+    for t in (first, macro, hangup):
+        t.join()
+
+
+def check(slack):
+    errors = []
+    messages = {}
+    for op, ts, text in slack.log:
+        if ts is None:
+            errors.append("%s without ts: %s" % (op, text))
+            continue
+        messages.setdefault(ts, []).append((op, text))
+    for ts, ops in messages.items():
+        if ops[0][0] != "post":
+            errors.append("message %s does not start with a post: %s" % (ts, ops))
+        if len(ops) < 2 or not ops[-1][1].startswith("✅ Call ended"):
+            errors.append("message %s does not end in its final state: %s" % (ts, ops))
+    return errors
+
+
+def run(calls, workers):
+    slack = SlowSlack()
+    server = agi_server.ThreadedTCPServer(("127.0.0.1", 0), agi_server.SlackAsterisk)
+    server.slack_client = slack
+    server.config = CONFIG
+    if workers:
+        server.dispatcher = dispatch.SlackDispatcher(slack, CONFIG, workers=workers)
+        server.dispatcher.start()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run_call, args=(server, i)) for i in range(calls)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if server.dispatcher is not None:
+        server.dispatcher.stop(30)
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    server.server_close()
+    errors = check(slack)
+    print("%-8s %4d calls  %6.2f s  %4d Slack calls  %d violations" % ("dispatch" if workers else "inline", calls, elapsed, len(slack.log), len(errors)))
+    for e in errors[:10]:
+        print("  " + e)
+    return not errors
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    ok = run(calls, 0)
+    ok = run(calls, workers) and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Stress test: restart under load with socket activation, drain and reload.
+
+Plays systemd: opens the FastAGI listening socket, starts slack_asterisk
+with it as fd 3 (LISTEN_FDS/LISTEN_PID) and a NOTIFY_SOCKET, and drives
+call lifecycles (new call, dial macro, h extension with DIALSTATUS) against
+it. While calls are in progress and Slack answers slowly, it
+
+1. sends SIGHUP after changing the ringing template in the config file,
+2. sends SIGTERM, waits for the process to exit and starts a new one on the
+   same socket, which picks up the calls in progress from the SQLite store.
+
+Checks that no AGI connection failed, that both processes exited cleanly
+after READY/RELOADING/STOPPING notifications, that every call was posted
+once and that the last text of every message is its final state, so no
+queued Slack update was lost by the restart.
+
+Usage: python benchmarks/stress_restart.py [--calls 200] [--rate 20] [--engine threaded|asyncio] [--processes 1]
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+from fake_asterisk import session  # noqa: E402
+from mock_slack import MockSlackServer  # noqa: E402
+
+FINAL_TEXT = "Call ended"
+
+SERVER_CONFIG = """
+[general]
+engine = {engine}
+drain_timeout = 20
+processes = {processes}
+
+[dispatch]
+workers = 4
+
+[store]
+backend = sqlite
+path = {store_path}
+
+[ratelimit]
+enabled = False
+
+[http]
+enabled = False
+
+[templates]
+ringing_in = {ringing}
+
+[slack]
+base_url = {base_url}
+"""
+
+
+def serve(config_file):
+    """Server process, started by Stack.start with the listening socket as fd 3"""
+    from slack_asterisk import agi_server, aio_server, config, prefork  # pylint:disable=import-outside-toplevel
+    # set by systemd between fork and exec
+    os.environ["LISTEN_PID"] = str(os.getpid())
+    c = config.SlackAsteriskConfig(config_file).get_configobj()
+    if c["general"]["processes"] > 1:
+        prefork.prefork_server(c["general"]["ip"], c["general"]["port"], c)
+    elif c["general"]["engine"] == "asyncio":
+        aio_server.aio_agi_server(c["general"]["ip"], c["general"]["port"], c)
+    else:
+        agi_server.agi_server(c["general"]["ip"], c["general"]["port"], c)
+
+
+class Stack(object):  # pylint:disable=too-many-instance-attributes
+    """Listening socket, notify socket and config file shared by the server processes"""
+
+    def __init__(self, args, base_url):
+        self.args = args
+        self.base_url = base_url
+        self.dir = tempfile.mkdtemp(prefix="stress-restart-")
+        self.config_file = os.path.join(self.dir, "slack-asterisk.conf")
+        self.write_config("Ringing")
+        self.listener = socket.create_server(("127.0.0.1", 0), backlog=1024)
+        self.notify = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.notify.bind(os.path.join(self.dir, "notify"))
+        self.states = []
+        threading.Thread(target=self._read_notifications, daemon=True).start()
+
+    @property
+    def address(self):
+        return self.listener.getsockname()
+
+    def write_config(self, ringing):
+        with open(self.config_file, "w") as f:
+            f.write(SERVER_CONFIG.format(engine=self.args.engine, processes=self.args.processes, store_path=os.path.join(self.dir, "calls.db"), ringing=ringing, base_url=self.base_url))
+
+    def _read_notifications(self):
+        while True:
+            self.states.append(self.notify.recv(1024).decode())
+
+    def wait_state(self, state, after=0, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if state in self.states[after:]:
+                return
+            time.sleep(0.01)
+        raise RuntimeError("no %s notification" % state)
+
+    def start(self):
+        fd = self.listener.fileno()
+        env = dict(os.environ, SLACK_TOKEN="xoxb-stress", LOG_LEVEL="INFO", LISTEN_FDS="1", NOTIFY_SOCKET=os.path.join(self.dir, "notify"), PYTHONPATH=os.path.join(BENCH_DIR, ".."))
+        after = len(self.states)
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", self.config_file], env=env, pass_fds=(3,),
+                                preexec_fn=lambda: os.dup2(fd, 3), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        self.wait_state("READY=1", after)
+        return proc
+
+
+class Calls(object):
+    """Call lifecycles at a fixed rate, each call spread over a second"""
+
+    def __init__(self, address, calls, rate):
+        self.address = address
+        self.calls = calls
+        self.rate = rate
+        self.failed = 0
+        self.done = 0
+        self._lock = threading.Lock()
+        self._base = int(time.time())
+
+    def run_call(self, i):
+        uid = "%d.%d" % (self._base, i)
+        caller = {"agi_uniqueid": uid, "agi_callerid": "030%07d" % i, "agi_calleridname": "Caller %d" % i, "agi_extension": "100"}
+        invocations = [
+            (caller, {}),
+            ({"agi_uniqueid": uid + "1", "agi_callerid": "200", "agi_extension": "s"}, {"ARG1": uid, "DIALEDPEERNUMBER": "SIP/200"}),
+            (dict(caller, agi_extension="h"), {"DIALSTATUS": "ANSWER", "DIALEDTIME": "12", "ANSWEREDTIME": "5", "HANGUPCAUSE": "16"}),
+        ]
+        for n, (env, chan_vars) in enumerate(invocations):
+            if n:
+                time.sleep(0.5)
+            try:
+                session(self.address, env, chan_vars)
+            except OSError:
+                with self._lock:
+                    self.failed += 1
+                return
+        with self._lock:
+            self.done += 1
+
+    def run(self):
+        threads = []
+        start = time.perf_counter()
+        for i in range(self.calls):
+            delay = start + i / self.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            t = threading.Thread(target=self.run_call, args=(i,), daemon=True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+
+def stop(proc, name):
+    proc.send_signal(signal.SIGTERM)
+    output, _ = proc.communicate(60)
+    print("%s exited with status %d" % (name, proc.returncode))
+    for line in output.splitlines():
+        if any(word in line for word in ("drain", "Drain", "flushed", "not sent", "reload", "Reload", "Traceback", "Error")):
+            print("  " + line.split("###")[-1])
+    return proc.returncode
+
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    argp.add_argument("--calls", type=int, default=200)
+    argp.add_argument("--rate", type=float, default=20.0, help="new calls per second")
+    argp.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    argp.add_argument("--processes", type=int, default=1, help="prefork worker processes of the threaded engine")
+    argp.add_argument("--slack-latency", type=float, default=0.1)
+    argp.add_argument("--serve", help=argparse.SUPPRESS)
+    args = argp.parse_args()
+    if args.serve:
+        serve(args.serve)
+        return
+    logging.getLogger("slack_asterisk").setLevel(logging.ERROR)
+
+    slack = MockSlackServer(latency=args.slack_latency).start()
+    stack = Stack(args, slack.base_url)
+    first = stack.start()
+    calls = Calls(stack.address, args.calls, args.rate)
+    load = threading.Thread(target=calls.run, daemon=True)
+    load.start()
+    duration = args.calls / args.rate
+
+    time.sleep(duration / 3)
+    stack.write_config("Ringing after reload")
+    after = len(stack.states)
+    first.send_signal(signal.SIGHUP)
+    stack.wait_state("RELOADING=1", after)
+    stack.wait_state("READY=1", after)
+
+    time.sleep(duration / 3)
+    started = time.perf_counter()
+    status = [stop(first, "first process")]
+    second = stack.start()
+    print("restarted in %.2f s, connections waited in the backlog meanwhile" % (time.perf_counter() - started))
+
+    load.join()
+    status.append(stop(second, "second process"))
+
+    texts = [(t[0] or "", t[-1] or "") for t in slack.texts.values()]
+    errors = []
+    if calls.failed:
+        errors.append("%d AGI connections failed" % calls.failed)
+    if any(status):
+        errors.append("exit status %s" % status)
+    if "STOPPING=1" not in stack.states:
+        errors.append("no STOPPING notification")
+    if slack.stats["posts"] != args.calls:
+        errors.append("%d posts for %d calls" % (slack.stats["posts"], args.calls))
+    unfinished = sum(1 for _, last in texts if FINAL_TEXT not in last)
+    if unfinished:
+        errors.append("%d messages without final state" % unfinished)
+    reloaded = sum(1 for first, _ in texts if "after reload" in first)
+    print("%d calls, %d AGI connections failed; notifications: %s" % (calls.done, calls.failed, ", ".join(stack.states)))
+    print("mock Slack: %s; %d messages finished, %d posted after the reload" % (", ".join("%s %d" % kv for kv in slack.stats.items()), len(texts) - unfinished, reloaded))
+    for e in errors:
+        print("  " + e)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
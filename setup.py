@@ -16,5 +16,6 @@ setup(
     license='Apache-2.0',
     entry_points={'console_scripts': ['slack-asterisk = slack_asterisk.main:main']},
     packages=find_packages(),
-    install_requires=['configobj', 'validate', 'Flask', 'slack_sdk']
+    install_requires=['configobj', 'validate', 'Flask', 'slack_sdk'],
+    extras_require={'async': ['aiohttp']}
 )
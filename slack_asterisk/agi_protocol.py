@@ -0,0 +1,230 @@
+# coding=utf-8
+"""FastAGI wire protocol.
+
+Buffered reader/writer for the line based AGI protocol spoken by Asterisk.
+Lines are read through a buffered file object (``StreamRequestHandler.rfile``)
+and replies are parsed on the raw bytes, so only the extracted value is ever
+decoded. Error codes are mapped onto the classes in :mod:`exceptions`.
+"""
+import logging
+import re
+from typing import NamedTuple
+
+from . import exceptions
+
+log = logging.getLogger("slack_asterisk")
+
+# Upper bound for a single protocol line, protects against a peer never sending LF
+MAX_LINE = 65536
+
+_RE_STATUS = re.compile(rb"^(\d{3})[ -](?:result=(-?\d+))?")
+
+
+class AGIResult(NamedTuple):
+    """Parsed AGI reply, e.g. ``200 result=1 (value)``"""
+    code: int
+    result: int
+    data: str | None
+
+
+def parse_reply(line: bytes) -> AGIResult:
+    """Parse a single AGI reply line (without line terminator).
+
+    The value in parentheses is sliced out of the line through a memoryview
+    and decoded once; nothing else is decoded or copied.
+    """
+    m = _RE_STATUS.match(line)
+    if m is None:
+        raise exceptions.AGIUnknownError("Unparsable AGI reply %r" % bytes(line[:80]))
+    code = int(m.group(1))
+    result = int(m.group(2)) if m.group(2) is not None else 0
+    data = None
+    lpar = line.find(b"(", m.end())
+    if lpar != -1:
+        rpar = line.rfind(b")")
+        if rpar > lpar:
+            data = str(memoryview(line)[lpar + 1:rpar], "utf-8", "ignore")
+    return AGIResult(code, result, data)
+
+
+def parse_env_line(line: bytes, env: dict) -> None:
+    """Add a single ``agi_key: value`` line to env"""
+    key, sep, value = line.partition(b":")
+    if sep:
+        env[key.strip().decode(errors="ignore")] = value.strip().decode(errors="ignore")
+
+
+def format_set_variable(name: str, value: str | None) -> str:
+    if value is None:
+        value = ""
+    safe = value.replace('"', '\\"')
+    return f'SET VARIABLE {name} "{safe}"'
+
+
+def variable_value(res: AGIResult) -> str | None:
+    """Return the value of a GET VARIABLE reply or None if the variable is not set"""
+    if res.result == 0:
+        return None
+    if res.data is None:
+        return ""
+    # Some asterisk versions wrap empty value as ""; normalize
+    if res.data == '""':
+        return ""
+    return res.data
+
+
+def check_reply(line: bytes | None, usage=()) -> AGIResult:
+    """Parse a reply line and map error codes onto AGI exceptions.
+
+    :param usage: usage lines following a multi-line 520 reply
+    :raises AGISIGPIPEHangup: connection closed by Asterisk (line is None)
+    :raises AGIResultHangup: command not permitted on a dead channel (511)
+    :raises AGIInvalidCommand: unknown command (510)
+    :raises AGIUsageError: invalid command syntax (520)
+    :raises AGIAppError: command returned result -1
+    :raises AGIUnknownError: any other reply code
+    """
+    if line is None:
+        raise exceptions.AGISIGPIPEHangup("Connection closed by Asterisk")
+    log.debug("AGI << %s", line)
+    res = parse_reply(line)
+    if res.code == 200:
+        if res.result == -1:
+            raise exceptions.AGIAppError("Error executing command, or hangup")
+        return res
+    if res.code == 510:
+        raise exceptions.AGIInvalidCommand(line.decode(errors="ignore"))
+    if res.code == 511:
+        raise exceptions.AGIResultHangup(line.decode(errors="ignore"))
+    if res.code == 520:
+        raise exceptions.AGIUsageError(b"\n".join([line, *usage]).decode(errors="ignore"))
+    raise exceptions.AGIUnknownError("Unexpected AGI reply code %d: %s" % (res.code, line.decode(errors="ignore")))
+
+
+class AGIConnection(object):
+    """Synchronous AGI session on top of buffered file objects.
+
+    :param rfile: buffered binary file object to read from (supports readline)
+    :param wfile: binary file object to write to
+    """
+
+    def __init__(self, rfile, wfile, max_line=MAX_LINE):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.max_line = max_line
+        self.hungup = False
+
+    def readline(self) -> bytes | None:
+        """Read a single line, return bytes without CRLF or None on EOF"""
+        line = self.rfile.readline(self.max_line)
+        if not line:
+            return None
+        return line.rstrip(b"\r\n")
+
+    def read_env(self) -> dict:
+        """Read AGI environment lines until a blank line, return dict."""
+        env = {}
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            parse_env_line(line, env)
+        log.debug("AGI env: %s", env)
+        return env
+
+    def send(self, *cmds: str) -> None:
+        """Write one or more commands in a single write without waiting for replies"""
+        log.debug("AGI >> %s", cmds)
+        self.wfile.write("".join(cmd + "\n" for cmd in cmds).encode())
+
+    def read_result(self) -> AGIResult:
+        """Read and check the reply of a previously sent command, see :func:`check_reply`"""
+        line = self.readline()
+        while line == b"HANGUP":
+            # Asynchronous hangup notification, the command reply follows
+            log.debug("AGI << HANGUP")
+            self.hungup = True
+            line = self.readline()
+        usage = []
+        if line is not None and line.startswith(b"520-"):
+            while True:
+                usage_line = self.readline()
+                if usage_line is None or usage_line.startswith(b"520 "):
+                    break
+                usage.append(usage_line)
+        return check_reply(line, usage)
+
+    def execute(self, cmd: str) -> AGIResult:
+        """Send a raw AGI command and return the parsed reply"""
+        self.send(cmd)
+        return self.read_result()
+
+    def get_variable(self, name: str) -> str | None:
+        """Get an Asterisk variable value, None if not set"""
+        return variable_value(self.execute(f"GET VARIABLE {name}"))
+
+    def set_variable(self, name: str, value: str | None) -> None:
+        self.execute(format_set_variable(name, value))
+
+
+class AsyncAGIConnection(object):
+    """AGI session on asyncio streams, same interface as AGIConnection with coroutines
+
+    :param reader: asyncio.StreamReader
+    :param writer: asyncio.StreamWriter
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.hungup = False
+
+    async def readline(self) -> bytes | None:
+        """Read a single line, return bytes without CRLF or None on EOF"""
+        line = await self.reader.readline()
+        if not line:
+            return None
+        return line.rstrip(b"\r\n")
+
+    async def read_env(self) -> dict:
+        """Read AGI environment lines until a blank line, return dict."""
+        env = {}
+        while True:
+            line = await self.readline()
+            if not line:
+                break
+            parse_env_line(line, env)
+        log.debug("AGI env: %s", env)
+        return env
+
+    async def send(self, *cmds: str) -> None:
+        """Write one or more commands in a single write without waiting for replies"""
+        log.debug("AGI >> %s", cmds)
+        self.writer.write("".join(cmd + "\n" for cmd in cmds).encode())
+        await self.writer.drain()
+
+    async def read_result(self) -> AGIResult:
+        """Read and check the reply of a previously sent command, see :func:`check_reply`"""
+        line = await self.readline()
+        while line == b"HANGUP":
+            log.debug("AGI << HANGUP")
+            self.hungup = True
+            line = await self.readline()
+        usage = []
+        if line is not None and line.startswith(b"520-"):
+            while True:
+                usage_line = await self.readline()
+                if usage_line is None or usage_line.startswith(b"520 "):
+                    break
+                usage.append(usage_line)
+        return check_reply(line, usage)
+
+    async def execute(self, cmd: str) -> AGIResult:
+        await self.send(cmd)
+        return await self.read_result()
+
+    async def get_variable(self, name: str) -> str | None:
+        return variable_value(await self.execute(f"GET VARIABLE {name}"))
+
+    async def set_variable(self, name: str, value: str | None) -> None:
+        await self.execute(format_set_variable(name, value))
@@ -1,402 +1,237 @@
 # coding=utf-8
 import socketserver
-import datetime
 import logging
 import os
 import sys
 import threading
-
-from slack_sdk import WebClient
+import time
+
+from . import agi_protocol
+from . import agi_vars
+from . import call_store
+from . import calls
+from . import capture
+from . import dispatch
+from . import exceptions
+from . import history
+from . import lifecycle
+from . import metrics
+from . import phonebook
+from . import ratelimit
+from . import routing
+from . import sequencer
+from . import summary
+from . import templates
+from . import tracing
+from . import transport
 
 log = logging.getLogger("slack_asterisk")
-LOG_SPEC = "%(name)s[%(process)s]: %(filename)s:%(lineno)d/%(funcName)s###%(message)s"
-
-
-def _configure_logging_from_env():
-    level_name = os.getenv("LOG_LEVEL", os.getenv("DEBUG_LEVEL", "INFO")).upper()
-    level = getattr(logging, level_name, logging.INFO)
-    fmt = logging.Formatter("%(asctime)s.%(msecs)06d" + " " + LOG_SPEC, datefmt='%Y-%m-%dT%T')
-    if not log.handlers:
-        h = logging.StreamHandler(sys.stdout)
-        h.setFormatter(fmt)
-        h.setLevel(level)
-        log.addHandler(h)
-    log.setLevel(level)
-
-
-_configure_logging_from_env()
 
 
 class SlackAsterisk(socketserver.StreamRequestHandler):
 
-    # --- Minimal built-in AGI helpers (replacing asterisk_agi) ---
-    def _readline(self):
-        """Read a single line from the socket, return str without CRLF or None."""
-        data = b""
+    def setup(self):
+        super().setup()
+        if self.server.capture is not None:
+            self.record = capture.SessionRecord(self.client_address)
+            self.agi = capture.RecordingAGIConnection(self.rfile, self.wfile, self.record)
+        else:
+            self.record = None
+            self.agi = agi_protocol.AGIConnection(self.rfile, self.wfile)
+
+    def finish(self):
         try:
-            while not data.endswith(b"\n"):
-                chunk = self.request.recv(1)
-                if not chunk:
-                    break
-                data += chunk
-        except Exception as e:  # pragma: no cover
-            log.debug("Error while reading line from socket: %s", e)
-        if not data:
-            return None
-        return data.decode(errors="ignore").rstrip("\r\n")
+            super().finish()
+        finally:
+            if self.record is not None:
+                self.server.capture.write(self.record)
 
     def _read_agi_env(self):
         """Read AGI environment lines until a blank line, return dict."""
-        env = {}
-        while True:
-            line = self._readline()
-            if line is None:
-                break
-            if line == "":
-                break
-            parts = line.split(":", 1)
-            if len(parts) == 2:
-                env[parts[0].strip()] = parts[1].strip()
-        log.debug("AGI env: %s", env)
-        return env
-
-    def _send_cmd(self, cmd: str) -> str:
-        """Send a raw AGI command and return the single-line reply."""
-        log.debug("AGI >> %s", cmd)
-        try:
-            self.request.sendall((cmd + "\n").encode())
-        except Exception as e:  # pragma: no cover
-            log.debug("Error sending AGI command: %s", e)
-        reply = self._readline() or ""
-        log.debug("AGI << %s", reply)
-        return reply
+        return self.agi.read_env()
 
     def _set_var(self, name: str, value: str | None) -> None:
-        if value is None:
-            value = ""
-        safe = value.replace('"', '\\"')
-        self._send_cmd(f'SET VARIABLE {name} "{safe}"')
+        self.agi.set_variable(name, value)
 
     def get_variable(self, name: str) -> str | None:
-        """Get an Asterisk variable value via AGI.
-
-        Parses typical responses like:
-          200 result=1 (foo)
-          200 result=0
-        Returns the string value or None if not set.
-        """
-        reply = self._send_cmd(f"GET VARIABLE {name}")
-        # Quick parse
-        # Find result=
-        result_pos = reply.find("result=")
-        if result_pos == -1:
-            return None
-        try:
-            after = reply[result_pos + len("result="):]
-            # result may be like 1 (value) or 0
-            # extract integer result
-            res_str = ""
-            i = 0
-            while i < len(after) and after[i].isdigit():
-                res_str += after[i]
-                i += 1
-            res = int(res_str) if res_str else 0
-            if res == 0:
-                return None
-            # try to extract value inside parentheses
-            lpar = reply.find("(")
-            rpar = reply.rfind(")")
-            if lpar != -1 and rpar != -1 and rpar > lpar:
-                val = reply[lpar + 1:rpar]
-                # Some asterisk versions wrap empty value as ""; normalize
-                if val == '""':
-                    return ""
-                return val
-            # sometimes value is quoted without parentheses in some impls
-            return ""
-        except Exception:  # pragma: no cover
-            return None
-
-    def get_vars(self):
-        chan_vars = dict()
-        chan_vars["callerid_num"] = self.get_variable('CALLERID(num)')
-        chan_vars["callerid_name"] = self.get_variable('CALLERID(name)')
-        chan_vars["uniqueid"] = self.get_variable('UNIQUEID')
-        chan_vars["arg1"] = self.get_variable('ARG1')
-        chan_vars["refid"] = self.get_variable('SLACK_ASTERISK_REFID')
-        chan_vars["info_text"] = self.get_variable('SLACK_ASTERISK_INFO_TEXT')
-        chan_vars["title_text"] = self.get_variable('SLACK_ASTERISK_TITLE_TEXT')
+        """Get an Asterisk variable value via AGI, None if not set."""
+        return self.agi.get_variable(name)
 
-        chan_vars["dialstatus"] = self.get_variable('DIALSTATUS')
-        chan_vars["dialedpeername"] = self.get_variable('DIALEDPEERNAME')
-        chan_vars["dialedpeernumber"] = self.get_variable('DIALEDPEERNUMBER')
-        chan_vars["dialedtime"] = self.get_variable("DIALEDTIME")
-        chan_vars["answeredtime"] = self.get_variable("ANSWEREDTIME")
-        chan_vars["exten"] = self.get_variable('EXTEN')
-        chan_vars["hangupcause"] = self.get_variable('HANGUPCAUSE')
-
-        chan_vars["type"] = self.get_variable('SLACK_ASTERISK_TYPE')
-        chan_vars["color"] = self.get_variable('SLACK_ASTERISK_COLOR')
-
-        chan_vars["direction"] = self.get_variable('SLACK_ASTERISK_DIRECTION')
-
-        to_delete = []
-        for k, v in chan_vars.items():
-            if not v:
-                to_delete.append(k)
-        for entry in to_delete:
-            del chan_vars[entry]
-        return chan_vars
+    def get_vars(self, env=None):
+        """Collect the channel vars relevant for this invocation, see :mod:`agi_vars`"""
+        return agi_vars.fetch(self.agi, env or {}, self.server.var_fetch)
 
     def get_formatting(self, msg, msg_data, color="good"):
-        actions = None
-        if msg_data["direction"] == "out":
-            title = "➡️ "
-        else:
-            title = "⬅️ "
-        title += "Call from "
-        title += msg_data["from_num"]
-        if msg_data["from_name"] and msg_data["from_name"] != "anonymous":
-            title += " (%s) " % msg_data["from_name"]
-
-        if msg_data["title_text"] is not None:
-            title += " - " + msg_data["title_text"]
-
-        footer = "Time: %s" % msg_data["ts_in"].strftime("%A %d.%m.%Y %H:%M:%S")
-        if msg_data["dialedtime"] is not None:
-            footer += " - Dialed for %s" % str(datetime.timedelta(seconds=msg_data["dialedtime"]))
-        if msg_data["answeredtime"] is not None:
-            footer += " - Answered for %s" % str(datetime.timedelta(seconds=msg_data["answeredtime"]))
-        if msg_data["color"] is not None:
-            color = msg_data["color"]
-        if msg_data["type"] is not None:
-            msg = "%s: %s" % (msg_data["type"], msg)
+        return self.server.templates.payload(msg, msg_data, color)
 
-        data = dict(color=color, title=title, text=msg, fallback=title[2:], username=self.server.config["username"], icon_emoji=self.server.config["emoji"], actions=actions, footer=footer)
-        return data
+    get_destination = staticmethod(calls.get_destination)
+    get_dialedpeernumber = staticmethod(calls.get_dialedpeernumber)
 
-    def update_message(self, msg, msg_data, color="good"):
-        data = self.get_formatting(msg, msg_data, color)
-        att = [data]
-        log.debug("Channel update called for channel #%s with attachment %s", self.server.config["channel"], att)
-        ret = self.server.slack_client.chat_update(channel=msg_data["channel"], attachments=att, ts=msg_data["ts"])
-        if ret["ok"] is not True:
-            raise RuntimeError("Cannot post message with error %s" % ret["error"])
-
-    def post_message(self, msg, msg_data, color="good"):
-        data = self.get_formatting(msg, msg_data, color)
-        att = [data]
-        log.debug("Channel post called for channel #%s with attachment %s", self.server.config["channel"], att)
-        ret = self.server.slack_client.chat_postMessage(channel=self.server.config["channel"], attachments=att)
-
-        if ret["ok"] is not True:
-            raise RuntimeError("Cannot post message with error %s" % ret["error"])
-        return ret["ts"], ret["channel"]
-
-    @staticmethod
-    def get_destination(msg_data):
-        log.debug("get_destination called with msg_data %s", msg_data)
-        dest = "Unknown"
-        if msg_data["to_num"] is not None:
-            dest = msg_data["to_num"]
-        if msg_data["to_name"] is not None:
-            dest = " (%s)" % msg_data["to_name"]
-        log.debug("Destination results in %s", dest)
-        return dest
-
-    @staticmethod
-    def get_dialedpeernumber(dp):
-        num = None
-        try:
-            num = dp.split("/")[1]
-        except Exception as e:
-            log.debug("Error in parsing dialedpeernumber by / with msg %s", e)
-        try:
-            num = dp.split("@")[0]
-        except Exception as e:
-            log.debug("Error in parsing dialedpeernumber by @ with msg %s", e)
-        log.debug("Dialed peer number %s leads to number %s", dp, num)
-        return num
-
-    def handle(self):  # pylint:disable=too-many-statements
+    def handle(self):
         log.debug("Received FastAGI request for client %s:%s", self.client_address[0], self.client_address[1])
-        try:  # pylint:disable=too-many-nested-blocks
+        started = t = metrics.session_started()
+        trace = None
+        try:
             # Read and log AGI environment
-            _env = self._read_agi_env()
-            # Collect channel vars using minimal GET VARIABLE calls
-            channel_vars = self.get_vars()
+            env = self._read_agi_env()
+            t_env = t = metrics.observe_phase("env", t)
+            # Collect channel vars needed in this context, batched into as few round trips as possible
+            channel_vars = self.get_vars(env)
+            t = metrics.observe_phase("vars", t)
             log.debug("FastAGI channel vars from %s:%s -> %s", self.client_address[0], self.client_address[1], channel_vars)
-
-            new_call = False
-            call_key = None
-            # Lock calls_dict for the check-and-create section to prevent race conditions
-            # between concurrent threads serving different AGI requests.
-            with self.server.calls_lock:
-                if "arg1" in channel_vars:
-                    # case Dial Macro, call completed
-                    call_key = channel_vars["arg1"]
-                    msg_data = self.server.calls_dict.get(call_key)
-                    if msg_data is None:
-                        log.warning("ARG1 references unknown call ID %s – ignoring request", call_key)
-                        return
-                else:
-                    # all other cases
-                    call_key = channel_vars.get("uniqueid")
-                    if not call_key:
-                        log.warning("No uniqueid in channel vars (broken connection?) – ignoring request")
-                        return
-                    if call_key not in self.server.calls_dict:
-                        self.server.calls_dict[call_key] = dict(ts=None, channel=None, from_num=None, from_name=None, to_num=None, to_name=None, ts_in=datetime.datetime.now(), ts_connected=None, dialedtime=None, answeredtime=None, title_text=None, info_text=None, color=None, type=None, direction=None)
-                        new_call = True
-                    msg_data = self.server.calls_dict[call_key]
-
-            if new_call:
-                    if msg_data["from_num"] is None:
-                        msg_data["from_num"] = channel_vars["callerid_num"]
-                    if msg_data["direction"] is None and "direction" in channel_vars:
-                        msg_data["direction"] = channel_vars["direction"]
-                    else:
-                        msg_data["direction"] = "in"
-                    if "callerid_name" in channel_vars:
-                        if channel_vars["callerid_name"] != channel_vars["callerid_num"]:
-                            msg_data["from_name"] = channel_vars["callerid_name"]
-                    else:
-                        msg_data["from_name"] = "anonymous"
-                    if msg_data["to_num"] is None:
-                        msg_data["to_num"] = channel_vars["exten"]
-                    self._set_var("SLACK_ASTERISK_REFID", channel_vars["uniqueid"])
-
-            if "info_text" in channel_vars:
-                msg_data["info_text"] = channel_vars["info_text"]
-            if "title_text" in channel_vars:
-                msg_data["title_text"] = channel_vars["title_text"]
-            if "color" in channel_vars:
-                msg_data["color"] = channel_vars["color"]
-            if "type" in channel_vars:
-                msg_data["type"] = channel_vars["type"]
-
-            if "dialedtime" in channel_vars:
-                msg_data["dialedtime"] = int(channel_vars["dialedtime"])
-            if "answeredtime" in channel_vars:
-                msg_data["answeredtime"] = int(channel_vars["answeredtime"])
-
-            if new_call is True:
-                # this is a new detected call which is not in a macro
-                log.debug("New call detected for uniqueid %s", channel_vars["uniqueid"])
-                if msg_data["direction"] == "in":
-                    text = "📞 Incoming call (ringing)"
-                else:
-                    text = "📞 Outgoing call (ringing) to %s" % channel_vars["exten"]
-                if msg_data["info_text"] is not None:
-                    text += " (%s)" % msg_data["info_text"]
-                (ts, channel) = self.post_message(text, msg_data)
-                msg_data["ts"] = ts
-                msg_data["channel"] = channel
-            elif "arg1" in channel_vars:
-                log.debug("Picked up call detected for uniqueid %s", channel_vars["uniqueid"])
-                # this is a picked up call in a dial M macro
-                if "dialedpeernumber" in channel_vars:
-                    log.debug("Found dp number in channel vars %s", channel_vars)
-                    msg_data["to_num"] = self.get_dialedpeernumber(channel_vars["dialedpeernumber"])
-                else:
-                    log.debug("No dialed peer number in channel vars %s", channel_vars)
-                    if "callerid_num" in channel_vars:
-                        msg_data["to_num"] = channel_vars["callerid_num"]
-                    if "callerid_name" in channel_vars:
-                        msg_data["to_name"] = channel_vars["callerid_name"]
-                dest = self.get_destination(msg_data)
-                self.update_message("☑️ Call established with %s" % dest, msg_data)
-            elif "dialstatus" in channel_vars:
-                log.debug("finished call detected for uniqueid %s", channel_vars["uniqueid"])
-                dest = self.get_destination(msg_data)
-                # set color to grey as default
-                color = "#333333"
-                # this is a finished call
-                if channel_vars["dialstatus"] == "ANSWER":
-                    text = "✅ Call ended"
-                    color = "good"
-                elif channel_vars["dialstatus"] == "BUSY":
-                    text = "⭕ Busy"
-                    color = "warning"
-                elif channel_vars["dialstatus"] == "NOANSWER":
-                    text = "❌️ Not answered"
-                    color = "warning"
-                elif channel_vars["dialstatus"] == "CANCEL":
-                    text = "❌ Canceled"
-                    color = "warning"
-                elif channel_vars["dialstatus"] == "CONGESTION":
-                    text = "❌ Congestion"
-                    color = "#9400D3"
-                elif channel_vars["dialstatus"] == "CHANUNAVAIL":
-                    text = "❌ Channel unavailable"
-                    color = "#9400D3"
-                elif channel_vars["dialstatus"] == "DONTCALL":
-                    text = "❌ Reject (don't call)"
-                    color = "#A9A9A9"
-                elif channel_vars["dialstatus"] == "TORTURE":
-                    text = "❌ Reject (torture)"
-                    color = "#A9A9A9"
+            key = calls.call_key(channel_vars)
+            trace = tracing.TRACER.trace(key, started)
+            if trace is not None:
+                trace.span("agi.env", started, t_env)
+                trace.span("agi.vars", t_env, t, strategy=self.server.var_fetch, vars=len(channel_vars))
+
+            # State transitions of one call are serialized until the Slack message is
+            # sent or queued, so an update never overtakes the initial post of its call
+            with self.server.sequencer.hold(key):
+                event = self.server.calls.process(channel_vars)
+                if event is None:
+                    return
+                if event.refid is not None:
+                    self._set_var("SLACK_ASTERISK_REFID", event.refid)
+                t = metrics.observe_phase("process", t)
+                if self.server.dispatcher is not None:
+                    # Slack is called in the background, Asterisk can continue right away
+                    self.server.dispatcher.submit(event)
+                    metrics.observe_phase("queue", t)
                 else:
-                    text = "Unknown"
-                if msg_data["direction"] == "in":
-                    text += " from %s" % dest
-                else:
-                    text += " to %s" % dest
-                self.update_message(text, msg_data, color=color)
-                # Call is finished – remove from memory to prevent unbounded growth
-                with self.server.calls_lock:
-                    self.server.calls_dict.pop(call_key, None)
-                    log.debug("Removed finished call %s (calls_dict size: %d)", call_key, len(self.server.calls_dict))
-            elif "hangupcause" in channel_vars and int(channel_vars["hangupcause"]) > 0:
-                dest = self.get_destination(msg_data)
-                self.update_message("Call hung up by %s" % dest, msg_data)
-                # Call is finished – remove from memory to prevent unbounded growth
-                with self.server.calls_lock:
-                    self.server.calls_dict.pop(call_key, None)
-                    log.debug("Removed hung-up call %s (calls_dict size: %d)", call_key, len(self.server.calls_dict))
-            elif "hangupcause" in channel_vars and int(channel_vars["hangupcause"]) <= 0:
-                self.update_message("Unknown call state (hangupcause %i)" % int(channel_vars["hangupcause"]), msg_data)
-            else:
-                self.update_message("Unknown call state", msg_data)
-
+                    dispatch.deliver(self.server.slack_client, self.server.config, event, self.server.templates)
+                    if event.new_call:
+                        self.server.calls.posted(event)
+                    metrics.observe_phase("slack", t)
+                if event.finished:
+                    self.server.calls.finish(event)
+
+        except exceptions.AGIHangup as e:
+            log.warning("AGI session from %s:%s ended early: %s", self.client_address[0], self.client_address[1], e)
         except Exception as e:
             log.exception("Exception occurred with message %s", e)
+        finally:
+            metrics.session_finished(started)
+            if trace is not None:
+                trace.span("agi.session", started, time.perf_counter(), peer="%s:%s" % self.client_address[:2])
 
 
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     daemon_threads = True
     allow_reuse_address = True
+    request_queue_size = 128
 
     def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True):  # noqa: N803 (keep arg names per base class)
         # Predefine instance attributes to satisfy linters and clarify intent.
         self.slack_client = None  # type: ignore[assignment]
+        self.dispatcher = None
         self.config = {}          # type: ignore[assignment]
-        self.calls_dict = {}
-        self.calls_lock = threading.Lock()
+        self.templates = templates.DEFAULT
+        self.call_store = call_store.CallStore()
+        self.calls = calls.CallStateMachine(self.call_store, self.templates)
+        self.sequencer = sequencer.KeyedLock()
+        self.var_fetch = "full"
+        self.capture = None
+        self.phonebook = None
+        self.sessions = lifecycle.ActiveSessions()
         super().__init__(server_address, RequestHandlerClass, bind_and_activate)
 
+    def process_request(self, request, client_address):
+        # counted before the handler thread starts, so a drain never misses an accepted session
+        self.sessions.enter()
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self.sessions.exit()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.sessions.exit()
+
+    def drain(self, timeout):
+        """Stop accepting, wait for the AGI sessions in progress and flush the dispatch queue within timeout seconds"""
+        deadline = lifecycle.Deadline(timeout)
+        lifecycle.notify("STOPPING=1")
+        # a socket passed by systemd stays open in systemd, new connections wait in its backlog for the next process
+        self.server_close()
+        log.info("Draining %d AGI sessions in progress", self.sessions.count)
+        if not self.sessions.wait(deadline.remaining()):
+            log.warning("%d AGI sessions still in progress after the drain timeout", self.sessions.count)
+        lifecycle.flush(self.dispatcher, deadline)
+
+    def send_stale(self, msg_data):
+        """Expiry handler of the call store: mark the Slack message of an abandoned call"""
+        if self.dispatcher is not None:
+            self.dispatcher.submit(self.calls.stale_event(msg_data))
+        elif dispatch.messages(msg_data):
+            dispatch.deliver(self.slack_client, self.config, self.calls.stale_event(msg_data), self.templates)
+        else:
+            # no message of its own to mark, e.g. summarized
+            dispatch.finished(msg_data.uniqueid, msg_data)
 
-def agi_server(ip, port, config):
+
+def agi_server(ip, port, config, sock=None):
+    """Serve FastAGI with the threaded engine until SIGTERM/SIGINT, then drain
+
+    :param sock: listening socket bound by main (see lifecycle.bind_socket), else the one passed by systemd or ip:port
+    """
     # SECURITY NOTE: The AGI TCP server has no built-in authentication.
     # Any process that can reach ip:port can trigger Slack messages.
     # The default bind address is 127.0.0.1 (localhost-only), which is
     # sufficient for local Asterisk deployments. Do NOT expose this port
     # to untrusted networks without adding a firewall rule or network ACL.
-    slack_token = os.environ["SLACK_TOKEN"]
-    sc = WebClient(slack_token)
+    lifecycle.setup_logging()
+    # listen first, connections wait in the backlog while the rest is set up
+    if sock is None:
+        sock = lifecycle.listen_socket() or lifecycle.bind_socket(ip, port)
+    server = ThreadedTCPServer((ip, port), SlackAsterisk, bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    server.server_address = sock.getsockname()
 
-    ThreadedTCPServer.allow_reuse_address = True
-    server = ThreadedTCPServer((ip, port), SlackAsterisk)
+    slack_token = os.environ["SLACK_TOKEN"]
+    client = transport.create_client(config, slack_token)
+    sc = ratelimit.create_client(metrics.InstrumentedClient(client), config)
+    transport.warm_up(client, config)
     server.slack_client = sc
+    server.running_config = config
     server.config = config["slack"]
-    server.calls_dict = dict()
-
+    server.var_fetch = config["general"]["var_fetch"]
+    server.capture = capture.create_capture(config)
+    server.templates = templates.create_templates(config)
+    server.phonebook = phonebook.create_phonebook(config)
+    server.call_store = call_store.create_store(config, server.send_stale)
+    server.calls = calls.CallStateMachine(server.call_store, server.templates, routing.create_router(config), server.phonebook)
+    server.dispatcher = dispatch.create_dispatcher(sc, config, on_posted=server.calls.posted, templates=server.templates)
+    tracing.configure(config)
+    history.configure(config)
+    summary.configure(config, sc)
+    metrics.watch(server.call_store, server.dispatcher, sc, server.phonebook, getattr(client, "pool", None))
+
+    def stop(signum):
+        log.info("Received signal %s, draining within %.1fs", signum, config["general"]["drain_timeout"])
+        # shutdown waits for serve_forever, which runs in this (the signal handling) thread
+        threading.Thread(target=server.shutdown, name="shutdown", daemon=True).start()
+
+    lifecycle.on_signals(stop, lambda: lifecycle.reload(server))
     try:
-        log.debug("Server FastAGI on %s:%s", ip, port)
+        log.debug("Server FastAGI on %s:%s", *server.server_address[:2])
+        lifecycle.notify("READY=1")
         server.serve_forever()
+        server.drain(config["general"]["drain_timeout"])
     except KeyboardInterrupt as e:  # pylint:disable=unused-variable
         log.info("Shutdown on ctrl-c")
         sys.exit(0)
     except Exception as e:
         log.exception("Unknown Exception %s occurred", e)
         sys.exit(1)
+    finally:
+        # flush journaled call state of a persistent store
+        server.call_store.close()
+        if server.capture is not None:
+            server.capture.close()
+        if server.phonebook is not None:
+            server.phonebook.close()
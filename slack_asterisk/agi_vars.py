@@ -0,0 +1,149 @@
+# coding=utf-8
+"""Channel variable retrieval for a FastAGI invocation.
+
+The variable set is derived from the invocation context: values already
+present in the AGI environment (uniqueid, caller id and extension) are
+taken from there, and variables that cannot matter in a given context are
+skipped. The remaining variables are then fetched with one of the
+strategies below:
+
+serial
+    one ``GET VARIABLE`` round trip per variable (legacy behavior)
+pipeline
+    all ``GET VARIABLE`` commands are written at once and the replies are
+    read afterwards, one round trip in total; experimental: Asterisk reads
+    AGI commands from a buffered stream and polls the socket between them,
+    commands already buffered may wait until the AGI timeout
+full (default)
+    all expressions are combined into a single ``GET FULL VARIABLE`` call
+    separated by :data:`DELIMITER`, one round trip and one reply; falls back
+    to serial if the reply cannot be split
+"""
+import logging
+
+from . import agi_protocol
+
+log = logging.getLogger("slack_asterisk")
+
+STRATEGIES = ("serial", "pipeline", "full")
+
+# Separator used to combine several expressions into one GET FULL VARIABLE call
+DELIMITER = "|^|"
+
+# channel_vars key -> Asterisk variable/function
+CHANNEL_VARS = {
+    "callerid_num": "CALLERID(num)",
+    "callerid_name": "CALLERID(name)",
+    "uniqueid": "UNIQUEID",
+    "arg1": "ARG1",
+    "info_text": "SLACK_ASTERISK_INFO_TEXT",
+    "title_text": "SLACK_ASTERISK_TITLE_TEXT",
+    "dialstatus": "DIALSTATUS",
+    "dialedpeername": "DIALEDPEERNAME",
+    "dialedpeernumber": "DIALEDPEERNUMBER",
+    "dialedtime": "DIALEDTIME",
+    "answeredtime": "ANSWEREDTIME",
+    "exten": "EXTEN",
+    "hangupcause": "HANGUPCAUSE",
+    "type": "SLACK_ASTERISK_TYPE",
+    "color": "SLACK_ASTERISK_COLOR",
+    "direction": "SLACK_ASTERISK_DIRECTION",
+}
+
+# AGI environment key -> channel_vars key
+ENV_VARS = {
+    "agi_uniqueid": "uniqueid",
+    "agi_callerid": "callerid_num",
+    "agi_calleridname": "callerid_name",
+    "agi_extension": "exten",
+}
+
+# Asterisk reports an empty caller id as "unknown" in the AGI environment
+_ENV_EMPTY = ("", "unknown")
+
+# Variables only evaluated by the dial macro (call established)
+_MACRO_ONLY = ("dialedpeername", "dialedpeernumber")
+
+
+def plan(env):
+    """Split the variable set for an invocation into known and to-be-fetched.
+
+    :param env: AGI environment as returned by ``AGIConnection.read_env``
+    :return: tuple (dict of values taken from env, list of channel_vars keys to fetch)
+    """
+    known = {}
+    for env_key, key in ENV_VARS.items():
+        value = env.get(env_key)
+        if value is not None and value not in _ENV_EMPTY:
+            known[key] = value
+    skip = set(known)
+    if env.get("agi_extension") == "h":
+        # hangup extension: the call can no longer be answered
+        skip.update(_MACRO_ONLY)
+    return known, [k for k in CHANNEL_VARS if k not in skip]
+
+
+def _fetch_serial(conn, keys):
+    return {k: conn.get_variable(CHANNEL_VARS[k]) for k in keys}
+
+
+def _fetch_pipeline(conn, keys):
+    conn.send(*("GET VARIABLE %s" % CHANNEL_VARS[k] for k in keys))
+    return {k: agi_protocol.variable_value(conn.read_result()) for k in keys}
+
+
+def _fetch_full(conn, keys):
+    expr = DELIMITER.join("${%s}" % CHANNEL_VARS[k] for k in keys)
+    value = agi_protocol.variable_value(conn.execute('GET FULL VARIABLE "%s"' % expr))
+    values = (value or "").split(DELIMITER)
+    if len(values) != len(keys):
+        log.warning("GET FULL VARIABLE returned %d instead of %d values, falling back to serial fetching", len(values), len(keys))
+        return _fetch_serial(conn, keys)
+    return dict(zip(keys, values))
+
+
+_FETCHERS = {"serial": _fetch_serial, "pipeline": _fetch_pipeline, "full": _fetch_full}
+
+
+def fetch(conn, env, strategy="full"):
+    """Collect channel vars for an AGI invocation, unset or empty vars are left out.
+
+    :param conn: AGIConnection of the invocation
+    :param env: AGI environment of the invocation
+    :param strategy: one of :data:`STRATEGIES`
+    :rtype: dict
+    """
+    known, keys = plan(env)
+    chan_vars = _FETCHERS[strategy](conn, keys) if keys else {}
+    chan_vars.update(known)
+    return {k: v for k, v in chan_vars.items() if v}
+
+
+async def _fetch_serial_async(conn, keys):
+    return {k: await conn.get_variable(CHANNEL_VARS[k]) for k in keys}
+
+
+async def _fetch_pipeline_async(conn, keys):
+    await conn.send(*("GET VARIABLE %s" % CHANNEL_VARS[k] for k in keys))
+    return {k: agi_protocol.variable_value(await conn.read_result()) for k in keys}
+
+
+async def _fetch_full_async(conn, keys):
+    expr = DELIMITER.join("${%s}" % CHANNEL_VARS[k] for k in keys)
+    value = agi_protocol.variable_value(await conn.execute('GET FULL VARIABLE "%s"' % expr))
+    values = (value or "").split(DELIMITER)
+    if len(values) != len(keys):
+        log.warning("GET FULL VARIABLE returned %d instead of %d values, falling back to serial fetching", len(values), len(keys))
+        return await _fetch_serial_async(conn, keys)
+    return dict(zip(keys, values))
+
+
+_ASYNC_FETCHERS = {"serial": _fetch_serial_async, "pipeline": _fetch_pipeline_async, "full": _fetch_full_async}
+
+
+async def fetch_async(conn, env, strategy="full"):
+    """Coroutine version of :func:`fetch` for an AsyncAGIConnection"""
+    known, keys = plan(env)
+    chan_vars = await _ASYNC_FETCHERS[strategy](conn, keys) if keys else {}
+    chan_vars.update(known)
+    return {k: v for k, v in chan_vars.items() if v}
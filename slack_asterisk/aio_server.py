@@ -0,0 +1,235 @@
+# coding=utf-8
+"""asyncio FastAGI server engine.
+
+Alternative to the ThreadedTCPServer in :mod:`agi_server`: all AGI sessions
+are served as coroutines on a single event loop and Slack is called through
+``slack_sdk``'s AsyncWebClient (requires aiohttp), or handed to the
+:mod:`dispatch` workers if enabled. The call state logic is
+the same :class:`calls.CallStateMachine` used by the threaded engine.
+
+Enable with ``engine = asyncio`` in the ``[general]`` section.
+"""
+import asyncio
+import logging
+import os
+import signal
+import sys
+import time
+
+from . import agi_protocol
+from . import agi_vars
+from . import call_store
+from . import calls
+from . import capture
+from . import dispatch
+from . import exceptions
+from . import history
+from . import lifecycle
+from . import metrics
+from . import phonebook
+from . import ratelimit
+from . import routing
+from . import sequencer
+from . import summary
+from . import templates
+from . import tracing
+from . import transport
+
+log = logging.getLogger("slack_asterisk")
+
+
+class AsyncAGIServer(object):
+    """FastAGI server on asyncio streams
+
+    :param config: full configuration (ConfigObj)
+    :param slack_client: AsyncWebClient, used when no dispatcher is given
+    :param dispatcher: optional dispatch.SlackDispatcher sending Slack messages in the background
+    """
+
+    def __init__(self, config, slack_client, dispatcher=None):
+        self.startup_config = config
+        # changed by reloads
+        self.running_config = config
+        self.slack_client = slack_client
+        self.dispatcher = dispatcher
+        self.config = config["slack"]
+        self.var_fetch = config["general"]["var_fetch"]
+        self.capture = capture.create_capture(config)
+        self.templates = templates.create_templates(config)
+        self.phonebook = phonebook.create_phonebook(config)
+        self.call_store = call_store.create_store(config, self.send_stale)
+        self.calls = calls.CallStateMachine(self.call_store, self.templates, routing.create_router(config), self.phonebook)
+        if dispatcher is not None:
+            dispatcher.on_posted = self.calls.posted
+            dispatcher.templates = self.templates
+        self.loop = None
+        self.sequencer = sequencer.AsyncKeyedLock()
+        tracing.configure(config)
+        history.configure(config)
+        # summaries are published with the synchronous client of the dispatch workers
+        summary.configure(config, dispatcher.slack_client if dispatcher is not None else None)
+        metrics.watch(call_store=self.call_store, phonebook=self.phonebook)
+        # Sessions beyond the limit wait before reading anything, which bounds buffers and call state work
+        self.sessions = asyncio.Semaphore(config["general"]["max_sessions"])
+        self.active = lifecycle.ActiveSessions()
+        self._stopping = None
+
+    def send_stale(self, msg_data):
+        """Expiry handler of the call store (runs in the reaper thread)"""
+        if self.dispatcher is not None:
+            self.dispatcher.submit(self.calls.stale_event(msg_data))
+        elif not dispatch.messages(msg_data):
+            # no message of its own to mark, e.g. summarized
+            dispatch.finished(msg_data.uniqueid, msg_data)
+        elif self.loop is not None:
+            asyncio.run_coroutine_threadsafe(dispatch.deliver_async(self.slack_client, self.config, self.calls.stale_event(msg_data), self.templates), self.loop)
+
+    async def handle(self, reader, writer):
+        self.active.enter()
+        try:
+            await self._handle(reader, writer)
+        finally:
+            self.active.exit()
+
+    async def _handle(self, reader, writer):
+        peer = writer.get_extra_info("peername") or ("unknown", 0)
+        async with self.sessions:
+            log.debug("Received FastAGI request for client %s:%s", peer[0], peer[1])
+            if self.capture is not None:
+                record = capture.SessionRecord(peer)
+                agi = capture.RecordingAsyncAGIConnection(reader, writer, record)
+            else:
+                agi = agi_protocol.AsyncAGIConnection(reader, writer)
+            started = t = metrics.session_started()
+            trace = None
+            try:
+                env = await agi.read_env()
+                t_env = t = metrics.observe_phase("env", t)
+                channel_vars = await agi_vars.fetch_async(agi, env, self.var_fetch)
+                t = metrics.observe_phase("vars", t)
+                log.debug("FastAGI channel vars from %s:%s -> %s", peer[0], peer[1], channel_vars)
+                key = calls.call_key(channel_vars)
+                trace = tracing.TRACER.trace(key, started)
+                if trace is not None:
+                    trace.span("agi.env", started, t_env)
+                    trace.span("agi.vars", t_env, t, strategy=self.var_fetch, vars=len(channel_vars))
+
+                async with self.sequencer.hold(key):
+                    event = self.calls.process(channel_vars)
+                    if event is None:
+                        return
+                    if event.refid is not None:
+                        await agi.set_variable("SLACK_ASTERISK_REFID", event.refid)
+                    t = metrics.observe_phase("process", t)
+                    if self.dispatcher is not None:
+                        if self.dispatcher.overflow == "block":
+                            # submit may wait for queue space, keep the event loop running meanwhile
+                            await asyncio.to_thread(self.dispatcher.submit, event)
+                        else:
+                            self.dispatcher.submit(event)
+                        metrics.observe_phase("queue", t)
+                    else:
+                        await dispatch.deliver_async(self.slack_client, self.config, event, self.templates)
+                        if event.new_call:
+                            self.calls.posted(event)
+                        metrics.observe_phase("slack", t)
+                    if event.finished:
+                        self.calls.finish(event)
+
+            except exceptions.AGIHangup as e:
+                log.warning("AGI session from %s:%s ended early: %s", peer[0], peer[1], e)
+            except Exception as e:
+                log.exception("Exception occurred with message %s", e)
+            finally:
+                metrics.session_finished(started)
+                if trace is not None:
+                    trace.span("agi.session", started, time.perf_counter(), peer="%s:%s" % tuple(peer[:2]))
+                if self.capture is not None:
+                    self.capture.write(record)
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except (ConnectionError, OSError):
+                    pass
+
+    def stop(self, signum=None):
+        """Start the drain, serve returns once it is done"""
+        log.info("Received signal %s, draining within %.1fs", signum, self.startup_config["general"]["drain_timeout"])
+        self._stopping.set()
+
+    async def drain(self, server, timeout):
+        """Stop accepting, wait for the AGI sessions in progress and flush the dispatch queue within timeout seconds"""
+        deadline = lifecycle.Deadline(timeout)
+        lifecycle.notify("STOPPING=1")
+        server.close()
+        log.info("Draining %d AGI sessions in progress", self.active.count)
+        while self.active.count and deadline.remaining():
+            await asyncio.sleep(0.05)
+        if self.active.count:
+            log.warning("%d AGI sessions still in progress after the drain timeout", self.active.count)
+        await asyncio.to_thread(lifecycle.flush, self.dispatcher, deadline)
+
+    async def serve(self, ip, port, sock=None):
+        """Serve on ip:port, or on sock if given, until SIGTERM/SIGINT, then drain"""
+        self.loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        if sock is not None:
+            server = await asyncio.start_server(self.handle, sock=sock, limit=agi_protocol.MAX_LINE)
+        else:
+            server = await asyncio.start_server(self.handle, ip, port, limit=agi_protocol.MAX_LINE, reuse_address=True)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(signum, self.stop, signum)
+        self.loop.add_signal_handler(signal.SIGHUP, lifecycle.reload_in_thread, lifecycle.reload, self)
+        log.debug("Server FastAGI (asyncio) on %s:%s", *server.sockets[0].getsockname()[:2])
+        lifecycle.notify("READY=1")
+        await self._stopping.wait()
+        await self.drain(server, self.startup_config["general"]["drain_timeout"])
+
+
+def aio_agi_server(ip, port, config, sock=None):
+    """Serve FastAGI with the asyncio engine until SIGTERM/SIGINT, then drain
+
+    :param sock: listening socket bound by main (see lifecycle.bind_socket), else the one passed by systemd or ip:port
+    """
+    # SECURITY NOTE: same as agi_server.agi_server, there is no authentication on ip:port.
+    lifecycle.setup_logging()
+    # listen first, connections wait in the backlog while the rest is set up
+    if sock is None:
+        sock = lifecycle.listen_socket() or lifecycle.bind_socket(ip, port)
+    slack_token = os.environ["SLACK_TOKEN"]
+    if config["dispatch"]["workers"] > 0:
+        # Slack messages are sent by the dispatch workers with the synchronous client
+        client = transport.create_client(config, slack_token)
+        sc = ratelimit.create_client(metrics.InstrumentedClient(client), config)
+        transport.warm_up(client, config)
+        dispatcher = dispatch.create_dispatcher(sc, config)
+        metrics.watch(dispatcher=dispatcher, slack_client=sc, transport=getattr(client, "pool", None))
+        sc = None
+    else:
+        try:
+            sc = ratelimit.create_client(transport.create_async_client(config, slack_token), config, ratelimit.AsyncRateLimitedClient)
+        except ImportError as e:
+            log.error("The asyncio engine without dispatch workers requires aiohttp (pip install slack-asterisk[async]): %s", e)
+            sys.exit(1)
+        dispatcher = None
+        metrics.watch(slack_client=sc)
+
+    async def run():
+        server = AsyncAGIServer(config, sc, dispatcher)
+        try:
+            await server.serve(ip, port, sock)
+        finally:
+            server.call_store.close()
+            if server.capture is not None:
+                server.capture.close()
+            if server.phonebook is not None:
+                server.phonebook.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        log.info("Shutdown on ctrl-c")
+        sys.exit(0)
+    except Exception as e:
+        log.exception("Unknown Exception %s occurred", e)
+        sys.exit(1)
@@ -0,0 +1,423 @@
+# coding=utf-8
+"""Asterisk Manager Interface engine.
+
+Alternative to FastAGI: one persistent AMI connection receives the call
+events of all channels, no AGI calls are needed in the dialplan. Enable
+with ``engine = ami`` and the ``[ami]`` section; the manager user needs
+read permission for the ``call`` class.
+
+The events are translated into the channel vars of the AGI invocations
+they replace and fed to the same :class:`calls.CallStateMachine`:
+
+Newchannel
+    a channel that starts a call (Uniqueid = Linkedid) is remembered
+DialBegin
+    the first dial of a call posts it (ringing), like the AGI before Dial()
+DialEnd, BridgeEnter
+    answered: the call is established with the answering channel, like the
+    dial macro; the status of the last DialEnd is kept
+Hangup
+    hangup of the first channel finishes the call with the last dial status
+    and the dialed/answered times, like the h extension; calls never dialed
+    are forgotten
+
+``SLACK_ASTERISK_*`` variables are read from the ``ChanVariable`` headers
+Asterisk adds to the events for the variables listed in ``channelvars`` of
+manager.conf. Without SLACK_ASTERISK_DIRECTION, calls starting in one of the
+``outbound_contexts`` are outgoing.
+
+Events are handled in order by a single thread; Slack messages should be
+sent by the dispatch workers so that slow Slack calls never hold up the
+event stream. On connection loss the engine reconnects after
+``reconnect_interval`` seconds. On SIGTERM the connection is closed after the
+event being handled and the dispatch queue is flushed, see :mod:`lifecycle`.
+"""
+import collections
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+from . import agi_vars
+from . import call_store
+from . import calls
+from . import dispatch
+from . import exceptions
+from . import history
+from . import lifecycle
+from . import metrics
+from . import phonebook
+from . import ratelimit
+from . import routing
+from . import summary
+from . import templates
+from . import tracing
+from . import transport
+
+log = logging.getLogger("slack_asterisk")
+
+# Asterisk variable -> channel_vars key of the SLACK_ASTERISK_* variables
+CHAN_VARIABLES = {name: key for key, name in agi_vars.CHANNEL_VARS.items() if name.startswith("SLACK_ASTERISK_")}
+
+
+def parse_message(lines):
+    """Parse the lines of an AMI message into a dict, ChanVariable headers into a dict under "ChanVariable" """
+    message = {}
+    chan_vars = {}
+    for line in lines:
+        key, sep, value = line.partition(":")
+        if not sep:
+            continue
+        value = value.strip()
+        if key == "ChanVariable" or key.startswith("ChanVariable("):
+            # "ChanVariable: NAME=value", Asterisk 11 "ChanVariable(<channel>): NAME=value"
+            name, _, value = value.partition("=")
+            chan_vars[name] = value
+        else:
+            message[key] = value
+    if chan_vars:
+        message["ChanVariable"] = chan_vars
+    return message
+
+
+class AMIConnection(object):
+    """Line based AMI client connection
+
+    :param host: manager host
+    :param port: manager port
+    :param timeout: seconds for connecting and logging in
+    """
+
+    def __init__(self, host, port=5038, timeout=10.0):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.rfile = self.sock.makefile("r", encoding="utf-8", errors="replace", newline="\r\n")
+        self.banner = self.rfile.readline().strip()
+        self._action_id = 0
+
+    def send(self, action, **headers):
+        self._action_id += 1
+        lines = ["Action: %s" % action, "ActionID: %d" % self._action_id]
+        lines.extend("%s: %s" % kv for kv in headers.items())
+        self.sock.sendall(("\r\n".join(lines) + "\r\n\r\n").encode())
+        return str(self._action_id)
+
+    def read_message(self):
+        """Next message (event or response) as dict, None on end of stream"""
+        lines = []
+        for line in self.rfile:
+            line = line.rstrip("\r\n")
+            if not line:
+                if lines:
+                    return parse_message(lines)
+                continue
+            lines.append(line)
+        return None
+
+    def login(self, username, secret):
+        """Log in and subscribe to call events
+
+        :raises exceptions.AMIError: if the login is rejected
+        """
+        action_id = self.send("Login", Username=username, Secret=secret, Events="call")
+        while True:
+            message = self.read_message()
+            if message is None:
+                raise exceptions.AMIError("AMI connection closed during login")
+            if message.get("ActionID") == action_id:
+                if message.get("Response") != "Success":
+                    raise exceptions.AMIError("AMI login failed: %s" % message.get("Message"))
+                break
+        # events are read without timeout, the stream may be quiet for a long time
+        self.sock.settimeout(None)
+
+    def messages(self):
+        while True:
+            message = self.read_message()
+            if message is None:
+                return
+            yield message
+
+    def close(self):
+        try:
+            self.send("Logoff")
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class _Call(object):  # pylint:disable=too-few-public-methods
+    """AMI side state of a call, until the hangup of its first channel"""
+    __slots__ = ("vars", "posted", "dialed", "answered", "dialstatus")
+
+    def __init__(self, chan_vars):
+        self.vars = chan_vars
+        self.posted = False
+        self.dialed = None
+        self.answered = None
+        self.dialstatus = None
+
+
+class AMICallTracker(object):
+    """Turns AMI events into the channel vars of CallStateMachine invocations
+
+    :param state_machine: calls.CallStateMachine
+    :param execute: callable(CallEvent) sending the Slack message of an event
+    :param outbound_contexts: dialplan contexts of outgoing calls
+    :param max_calls: calls tracked at most, the oldest are forgotten beyond
+    """
+
+    def __init__(self, state_machine, execute, outbound_contexts=(), max_calls=10000):
+        self.calls = state_machine
+        self.execute = execute
+        self.outbound_contexts = set(outbound_contexts)
+        self.max_calls = max_calls
+        self._calls = collections.OrderedDict()
+        self.stats = dict(events=0, calls=0, ignored=0)
+        self._handlers = {
+            "Newchannel": self._newchannel,
+            "DialBegin": self._dial_begin,
+            "DialEnd": self._dial_end,
+            "BridgeEnter": self._bridge_enter,
+            "Hangup": self._hangup,
+        }
+
+    def __len__(self):
+        return len(self._calls)
+
+    def handle(self, message, now=None):
+        """Process one AMI message, other messages than the handled events are ignored"""
+        handler = self._handlers.get(message.get("Event"))
+        if handler is None:
+            return
+        handler(message, time.monotonic() if now is None else now)
+        self.stats["events"] += 1
+
+    def _process(self, chan_vars):
+        event = self.calls.process(chan_vars)
+        if event is not None:
+            self.execute(event)
+
+    def _extra_vars(self, message, chan_vars):
+        for name, value in message.get("ChanVariable", {}).items():
+            key = CHAN_VARIABLES.get(name)
+            if key is not None and value:
+                chan_vars[key] = value
+
+    def _newchannel(self, message, now):  # pylint:disable=unused-argument
+        uniqueid = message.get("Uniqueid")
+        if not uniqueid or message.get("Linkedid", uniqueid) != uniqueid:
+            # a channel dialed by another one
+            return
+        chan_vars = {"uniqueid": uniqueid}
+        for key, header in (("callerid_num", "CallerIDNum"), ("callerid_name", "CallerIDName"), ("exten", "Exten")):
+            value = message.get(header)
+            if value and value not in ("<unknown>", "unknown"):
+                chan_vars[key] = value
+        chan_vars.setdefault("callerid_num", "unknown")
+        if message.get("Context") in self.outbound_contexts:
+            chan_vars["direction"] = "out"
+        self._extra_vars(message, chan_vars)
+        self._calls[uniqueid] = _Call(chan_vars)
+        if len(self._calls) > self.max_calls:
+            dropped, _ = self._calls.popitem(last=False)
+            log.warning("Too many calls tracked from AMI events, forgetting call %s", dropped)
+
+    def _call(self, message):
+        call = self._calls.get(message.get("Linkedid") or message.get("Uniqueid"))
+        if call is None:
+            self.stats["ignored"] += 1
+        return call
+
+    def _dial_begin(self, message, now):
+        call = self._call(message)
+        if call is None or call.posted:
+            return
+        call.posted = True
+        call.dialed = now
+        # the extension dialed may only be known now, e.g. after an IVR
+        if message.get("Exten") and message.get("Exten") != "s":
+            call.vars["exten"] = message["Exten"]
+        call.vars.setdefault("exten", message.get("DestExten") or "unknown")
+        self._extra_vars(message, call.vars)
+        self.stats["calls"] += 1
+        self._process(call.vars)
+
+    def _established(self, call, linkedid, uniqueid, num, name, now):  # pylint:disable=too-many-arguments
+        if call.answered is not None:
+            return
+        call.answered = now
+        chan_vars = {"arg1": linkedid, "uniqueid": uniqueid}
+        if num and num not in ("<unknown>", "unknown"):
+            chan_vars["callerid_num"] = num
+        if name and name not in ("<unknown>", "unknown") and name != num:
+            chan_vars["callerid_name"] = name
+        self._process(chan_vars)
+
+    def _dial_end(self, message, now):
+        call = self._call(message)
+        if call is None or not call.posted:
+            return
+        status = message.get("DialStatus")
+        if status:
+            if call.dialstatus != "ANSWER":
+                call.dialstatus = status
+        if status == "ANSWER":
+            self._established(call, message.get("Linkedid") or message.get("Uniqueid"), message.get("DestUniqueid"),
+                              message.get("DestCallerIDNum"), message.get("DestCallerIDName"), now)
+
+    def _bridge_enter(self, message, now):
+        linkedid = message.get("Linkedid")
+        call = self._calls.get(linkedid)
+        if call is None or not call.posted or message.get("Uniqueid") == linkedid:
+            return
+        # answered without DialEnd, e.g. by a queue member or after a transfer
+        self._established(call, linkedid, message.get("Uniqueid"), message.get("CallerIDNum"), message.get("CallerIDName"), now)
+
+    def _hangup(self, message, now):
+        uniqueid = message.get("Uniqueid")
+        if message.get("Linkedid", uniqueid) != uniqueid:
+            return
+        call = self._calls.pop(uniqueid, None)
+        if call is None or not call.posted:
+            return
+        chan_vars = {"uniqueid": uniqueid}
+        if call.dialstatus:
+            chan_vars["dialstatus"] = call.dialstatus
+            chan_vars["dialedtime"] = str(int(now - call.dialed))
+            if call.answered is not None:
+                chan_vars["answeredtime"] = str(int(now - call.answered))
+        else:
+            # hung up while ringing, before any DialEnd
+            chan_vars["hangupcause"] = message.get("Cause") or "16"
+        self._process(chan_vars)
+
+
+class AMIService(object):  # pylint:disable=too-many-instance-attributes
+    """AMI engine: connection with reconnect, call tracking and Slack output
+
+    :param config: full configuration (ConfigObj)
+    :param slack_client: Slack client for inline sending, used when no dispatcher is given
+    :param dispatcher: optional dispatch.SlackDispatcher
+    """
+
+    def __init__(self, config, slack_client, dispatcher=None):
+        ac = config["ami"]
+        self.host = ac["host"]
+        self.port = ac["port"]
+        self.username = ac["username"]
+        self.secret = ac["secret"]
+        self.reconnect_interval = ac["reconnect_interval"]
+        self.slack_client = slack_client
+        self.dispatcher = dispatcher
+        # changed by reloads
+        self.running_config = config
+        self.config = config["slack"]
+        self.templates = templates.create_templates(config)
+        self.phonebook = phonebook.create_phonebook(config)
+        self.call_store = call_store.create_store(config, self.send_stale)
+        self.calls = calls.CallStateMachine(self.call_store, self.templates, routing.create_router(config), self.phonebook)
+        if dispatcher is not None:
+            dispatcher.on_posted = self.calls.posted
+            dispatcher.templates = self.templates
+        self.tracker = AMICallTracker(self.calls, self.execute, ac["outbound_contexts"], config["store"]["max_calls"])
+        self.connection = None
+        self._stop = threading.Event()
+        tracing.configure(config)
+        history.configure(config)
+        summary.configure(config, slack_client)
+        metrics.watch(call_store=self.call_store, phonebook=self.phonebook)
+
+    def execute(self, event):
+        """Send the Slack message of a CallEvent, like SlackAsterisk.handle"""
+        try:
+            if self.dispatcher is not None:
+                self.dispatcher.submit(event)
+            else:
+                dispatch.deliver(self.slack_client, self.config, event, self.templates)
+                if event.new_call:
+                    self.calls.posted(event)
+        except Exception as e:
+            log.exception("Sending Slack message for call %s failed with message %s", event.call_key, e)
+        if event.finished:
+            self.calls.finish(event)
+
+    def send_stale(self, msg_data):
+        """Expiry handler of the call store"""
+        if self.dispatcher is not None:
+            self.dispatcher.submit(self.calls.stale_event(msg_data))
+        elif dispatch.messages(msg_data):
+            dispatch.deliver(self.slack_client, self.config, self.calls.stale_event(msg_data), self.templates)
+        else:
+            # no message of its own to mark, e.g. summarized
+            dispatch.finished(msg_data.uniqueid, msg_data)
+
+    def run_once(self):
+        """Connect, log in and process events until the connection ends"""
+        self.connection = AMIConnection(self.host, self.port)
+        try:
+            self.connection.login(self.username, self.secret)
+            log.info("Connected to AMI %s:%s (%s)", self.host, self.port, self.connection.banner)
+            for message in self.connection.messages():
+                self.tracker.handle(message)
+        finally:
+            self.connection.sock.close()
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+                if not self._stop.is_set():
+                    log.warning("AMI connection to %s:%s closed", self.host, self.port)
+            except exceptions.AMIError as e:
+                log.error("%s", e)
+            except OSError as e:
+                if not self._stop.is_set():
+                    log.warning("AMI connection to %s:%s failed: %s", self.host, self.port, e)
+            self._stop.wait(self.reconnect_interval)
+
+    def stop(self):
+        self._stop.set()
+        if self.connection is not None:
+            try:
+                self.connection.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        self.call_store.close()
+        if self.phonebook is not None:
+            self.phonebook.close()
+
+
+def ami_server(config):
+    lifecycle.setup_logging()
+    slack_token = os.environ["SLACK_TOKEN"]
+    client = transport.create_client(config, slack_token)
+    sc = ratelimit.create_client(metrics.InstrumentedClient(client), config)
+    transport.warm_up(client, config)
+    dispatcher = dispatch.create_dispatcher(sc, config)
+    if dispatcher is None:
+        log.warning("AMI engine without dispatch workers: slow Slack calls delay the processing of all AMI events")
+    metrics.watch(dispatcher=dispatcher, slack_client=sc, transport=getattr(client, "pool", None))
+    service = AMIService(config, sc, dispatcher)
+
+    def stop(signum):
+        log.info("Received signal %s, draining within %.1fs", signum, config["general"]["drain_timeout"])
+        service.stop()
+
+    lifecycle.on_signals(stop, lambda: lifecycle.reload(service))
+    try:
+        lifecycle.notify("READY=1")
+        service.run()
+        lifecycle.notify("STOPPING=1")
+        lifecycle.flush(dispatcher, lifecycle.Deadline(config["general"]["drain_timeout"]))
+    except KeyboardInterrupt:
+        log.info("Shutdown on ctrl-c")
+        sys.exit(0)
+    except Exception as e:
+        log.exception("Unknown Exception %s occurred", e)
+        sys.exit(1)
+    finally:
+        service.close()
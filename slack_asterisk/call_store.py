@@ -0,0 +1,207 @@
+# coding=utf-8
+"""Bounded store for the state of calls in progress.
+
+Calls are normally dropped when their final AGI event (dialstatus or a
+positive hangupcause) arrives. Calls whose final event never comes (lost
+connections, dialplan branches without the h extension) are evicted after
+``ttl`` seconds without events. Expiry is driven by a heap of deadlines, so
+reaping costs O(log n) per expired call instead of a scan over all calls.
+When the store is full, the call closest to expiry is evicted to make room.
+"""
+import dataclasses
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from . import dispatch
+
+log = logging.getLogger("slack_asterisk")
+
+
+@dataclasses.dataclass(slots=True)
+class CallState:  # pylint:disable=too-many-instance-attributes
+    """State of a call and its Slack message"""
+    uniqueid: str
+    # ts and channel ID of the first message posted for the call
+    ts: str | None = None
+    channel: str | None = None
+    from_num: str | None = None
+    from_name: str | None = None
+    to_num: str | None = None
+    to_name: str | None = None
+    ts_in: datetime.datetime = dataclasses.field(default_factory=datetime.datetime.now)
+    ts_connected: datetime.datetime | None = None
+    dialedtime: int | None = None
+    answeredtime: int | None = None
+    # DIALSTATUS of a call finished by the dialstatus invocation
+    dialstatus: str | None = None
+    title_text: str | None = None
+    info_text: str | None = None
+    color: str | None = None
+    type: str | None = None
+    direction: str | None = None
+    # channels the call is routed to, None for the channel of the [slack] section
+    channels: list | None = None
+    # channel ID -> ts of all messages posted for the call, replaced as a whole on every post
+    messages: dict | None = None
+    # channels the call is counted in instead of being posted, see summary
+    summary: list | None = None
+    # (channel ID, ts) -> digest of the payload last sent to the message, see dispatch.digest; not persisted
+    digests: dict | None = None
+    # number of events applied, orders the events of a call handled by different processes
+    version: int = 0
+    # monotonic deadline after which the call is considered stale
+    expires: float = 0.0
+
+
+class CallStore(object):
+    """Thread-safe uniqueid -> CallState mapping with size limit and idle TTL
+
+    :param max_size: maximum number of calls kept
+    :param ttl: seconds without events after which a call is evicted
+    :param on_expire: optional callable(CallState) invoked for calls evicted
+        by TTL or size limit, outside of the store lock
+    """
+
+    def __init__(self, max_size=10000, ttl=14400, on_expire=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_expire = on_expire
+        self.lock = threading.Lock()
+        self._calls = {}
+        # (deadline, seq, uniqueid); entries are stale if the call was touched or removed since
+        self._deadlines = []
+        self._seq = itertools.count()
+        self._reaper = None
+        self._stop = threading.Event()
+        self.stats = dict(created=0, finished=0, evicted_ttl=0, evicted_size=0)
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __contains__(self, uniqueid):
+        return uniqueid in self._calls
+
+    def _touch(self, state, now):
+        state.expires = now + self.ttl
+        heapq.heappush(self._deadlines, (state.expires, next(self._seq), state.uniqueid))
+
+    def _pop_due(self, now=None):
+        """Pop the next valid heap entry (due before now if given), return CallState or None"""
+        while self._deadlines:
+            deadline, _, uniqueid = self._deadlines[0]
+            if now is not None and deadline > now:
+                return None
+            heapq.heappop(self._deadlines)
+            state = self._calls.get(uniqueid)
+            if state is not None and state.expires == deadline:
+                del self._calls[uniqueid]
+                return state
+        return None
+
+    def get(self, uniqueid):
+        """Return the CallState of a known call or None"""
+        with self.lock:
+            state = self._calls.get(uniqueid)
+            if state is not None:
+                self._touch(state, time.monotonic())
+            return state
+
+    def get_or_create(self, uniqueid):
+        """Return (CallState, created) for a call, creating it if unknown"""
+        evicted = None
+        with self.lock:
+            now = time.monotonic()
+            state = self._calls.get(uniqueid)
+            created = state is None
+            if created:
+                if len(self._calls) >= self.max_size:
+                    evicted = self._pop_due()
+                    if evicted is not None:
+                        self.stats["evicted_size"] += 1
+                state = self._calls[uniqueid] = CallState(uniqueid)
+                self.stats["created"] += 1
+            self._touch(state, now)
+        if evicted is not None:
+            log.warning("Call store full (%d calls), evicted call %s", self.max_size, evicted.uniqueid)
+            self._expired(evicted)
+        return state, created
+
+    def save(self, state):
+        """Record a modified CallState, a no-op for the in-memory store"""
+
+    def pop(self, uniqueid):
+        """Remove a finished call, return its CallState or None"""
+        with self.lock:
+            state = self._calls.pop(uniqueid, None)
+            if state is not None:
+                self.stats["finished"] += 1
+            # keep the heap from growing with entries of finished calls
+            if len(self._deadlines) > 4 * len(self._calls) + 64:
+                self._deadlines = [e for e in self._deadlines if e[2] in self._calls and self._calls[e[2]].expires == e[0]]
+                heapq.heapify(self._deadlines)
+            return state
+
+    def expire(self):
+        """Evict all calls whose TTL has passed, return their number"""
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            while True:
+                state = self._pop_due(now)
+                if state is None:
+                    break
+                expired.append(state)
+            self.stats["evicted_ttl"] += len(expired)
+        for state in expired:
+            log.info("Call %s expired without final event", state.uniqueid)
+            self._expired(state)
+        return len(expired)
+
+    def _expired(self, state):
+        if self.on_expire is None:
+            return
+        try:
+            self.on_expire(state)
+        except Exception as e:
+            log.exception("Expiry handler for call %s failed with message %s", state.uniqueid, e)
+
+    def start_reaper(self, interval=30.0):
+        """Run :meth:`expire` every interval seconds in a daemon thread"""
+        def run():
+            while not self._stop.wait(interval):
+                self.expire()
+        self._reaper = threading.Thread(target=run, name="call-store-reaper", daemon=True)
+        self._reaper.start()
+
+    def stop_reaper(self):
+        self._stop.set()
+
+    def close(self):
+        self.stop_reaper()
+
+
+def _count_expired(state):
+    dispatch.finished(state.uniqueid, state)
+
+
+def create_store(config, on_expire=None):
+    """Create a CallStore from the [store] section and start its reaper
+
+    :param on_expire: callable(CallState) sending the stale update, used if stale_update is enabled;
+        otherwise expired calls are only counted as finished (see :func:`dispatch.finished`)
+    """
+    sc = config["store"]
+    if on_expire is None or not sc["stale_update"]:
+        on_expire = _count_expired
+    kwargs = dict(max_size=sc["max_calls"], ttl=sc["ttl"], on_expire=on_expire)
+    if sc["backend"] == "sqlite":
+        from . import sqlite_store  # pylint:disable=import-outside-toplevel
+        store = sqlite_store.SQLiteCallStore(sc["path"], commit_interval=sc["commit_interval"], **kwargs)
+    else:
+        store = CallStore(**kwargs)
+    store.start_reaper(sc["reap_interval"])
+    return store
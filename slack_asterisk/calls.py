@@ -0,0 +1,211 @@
+# coding=utf-8
+"""Call state machine shared by all server engines.
+
+:class:`CallStateMachine` turns the channel vars of one AGI invocation into
+a :class:`CallEvent` describing the Slack message to post or update. It does
+no I/O itself, so the threaded and the asyncio engine can execute the
+resulting events with their own AGI connection and Slack client.
+"""
+import logging
+import time
+
+from . import templates as message_templates
+from . import tracing
+
+log = logging.getLogger("slack_asterisk")
+
+
+class CallEvent(object):  # pylint:disable=too-few-public-methods,too-many-instance-attributes
+    """Outcome of a single AGI invocation for a call
+
+    :ivar call_key: uniqueid of the call
+    :ivar msg_data: call_store.CallState of the call
+    :ivar new_call: True if a new Slack message has to be posted, False for an update
+    :ivar text: message text
+    :ivar color: attachment color
+    :ivar refid: value for SLACK_ASTERISK_REFID to be set on the channel or None
+    :ivar finished: True if the call is finished and its state can be dropped after the update
+    """
+    __slots__ = ("call_key", "msg_data", "new_call", "text", "color", "refid", "finished")
+
+    def __init__(self, call_key, msg_data, new_call, text, color="good", refid=None, finished=False):  # pylint:disable=too-many-arguments
+        self.call_key = call_key
+        self.msg_data = msg_data
+        self.new_call = new_call
+        self.text = text
+        self.color = color
+        self.refid = refid
+        self.finished = finished
+
+
+def get_destination(msg_data):
+    log.debug("get_destination called with msg_data %s", msg_data)
+    dest = "Unknown"
+    if msg_data.to_num is not None:
+        dest = msg_data.to_num
+    if msg_data.to_name is not None:
+        dest = " (%s)" % msg_data.to_name
+    log.debug("Destination results in %s", dest)
+    return dest
+
+
+def get_dialedpeernumber(dp):
+    num = None
+    try:
+        num = dp.split("/")[1]
+    except Exception as e:
+        log.debug("Error in parsing dialedpeernumber by / with msg %s", e)
+    try:
+        num = dp.split("@")[0]
+    except Exception as e:
+        log.debug("Error in parsing dialedpeernumber by @ with msg %s", e)
+    log.debug("Dialed peer number %s leads to number %s", dp, num)
+    return num
+
+
+def call_key(channel_vars):
+    """Key of the call an invocation belongs to: ARG1 in the dial macro, else the uniqueid"""
+    if "arg1" in channel_vars:
+        return channel_vars["arg1"]
+    return channel_vars.get("uniqueid")
+
+
+class CallStateMachine(object):
+    """Tracks calls across AGI invocations
+
+    :param store: call_store.CallStore shared by all invocations
+    :param templates: templates.MessageTemplates for the event texts, defaults if None
+    :param router: routing.Router choosing the channels of new calls, None for the [slack] channel
+    :param phonebook: phonebook.Phonebook naming callers without caller name, or None
+
+    Invocations of the same call must be serialized by the caller, e.g. with a
+    :class:`sequencer.KeyedLock` on :func:`call_key`, until their CallEvent is
+    delivered or queued.
+    """
+
+    def __init__(self, store, templates=None, router=None, phonebook=None):
+        self.store = store
+        self.templates = templates or message_templates.DEFAULT
+        self.router = router
+        self.phonebook = phonebook
+
+    def _lookup(self, channel_vars):
+        """Find or create the call state, return (call_key, msg_data, new_call) or None"""
+        if "arg1" in channel_vars:
+            # case Dial Macro, call completed
+            call_key = channel_vars["arg1"]
+            msg_data = self.store.get(call_key)
+            if msg_data is None:
+                log.warning("ARG1 references unknown call ID %s – ignoring request", call_key)
+                return None
+            return call_key, msg_data, False
+        # all other cases
+        call_key = channel_vars.get("uniqueid")
+        if not call_key:
+            log.warning("No uniqueid in channel vars (broken connection?) – ignoring request")
+            return None
+        msg_data, new_call = self.store.get_or_create(call_key)
+        return call_key, msg_data, new_call
+
+    def process(self, channel_vars):
+        """Apply the channel vars of an AGI invocation to the call state
+
+        :return: CallEvent or None if the invocation is ignored
+        """
+        started = time.perf_counter()
+        event = self._apply(channel_vars)
+        if event is None:
+            return None
+        event.msg_data.version += 1
+        if not event.finished:
+            self.store.save(event.msg_data)
+        state = "ringing" if event.new_call else "finished" if event.finished else "update"
+        tracing.TRACER.span(event.call_key, "state", started, time.perf_counter(), state=state, text=event.text)
+        return event
+
+    def _apply(self, channel_vars):  # pylint:disable=too-many-branches
+        found = self._lookup(channel_vars)
+        if found is None:
+            return None
+        call_key, msg_data, new_call = found
+        t = self.templates
+        color = t.colors["default"]
+
+        if new_call:
+            if msg_data.from_num is None:
+                msg_data.from_num = channel_vars["callerid_num"]
+            if msg_data.direction is None and "direction" in channel_vars:
+                msg_data.direction = channel_vars["direction"]
+            else:
+                msg_data.direction = "in"
+            if "callerid_name" in channel_vars:
+                if channel_vars["callerid_name"] != channel_vars["callerid_num"]:
+                    msg_data.from_name = channel_vars["callerid_name"]
+            else:
+                msg_data.from_name = "anonymous"
+            if msg_data.to_num is None:
+                msg_data.to_num = channel_vars["exten"]
+            if self.phonebook is not None and msg_data.from_name in (None, "anonymous"):
+                name = self.phonebook.lookup(msg_data.from_num)
+                if name is not None:
+                    msg_data.from_name = name
+
+        if "info_text" in channel_vars:
+            msg_data.info_text = channel_vars["info_text"]
+        if "title_text" in channel_vars:
+            msg_data.title_text = channel_vars["title_text"]
+        if "color" in channel_vars:
+            msg_data.color = channel_vars["color"]
+        if "type" in channel_vars:
+            msg_data.type = channel_vars["type"]
+
+        if "dialedtime" in channel_vars:
+            msg_data.dialedtime = int(channel_vars["dialedtime"])
+        if "answeredtime" in channel_vars:
+            msg_data.answeredtime = int(channel_vars["answeredtime"])
+
+        if new_call is True:
+            # this is a new detected call which is not in a macro
+            log.debug("New call detected for uniqueid %s", call_key)
+            if self.router is not None:
+                msg_data.channels = self.router.route(channel_vars.get("exten"), msg_data.from_num, msg_data.direction, msg_data.type)
+                log.debug("Call %s routed to channels %s", call_key, msg_data.channels)
+            text = t.ringing(msg_data.direction, channel_vars.get("exten"), msg_data.info_text)
+            return CallEvent(call_key, msg_data, True, text, color=color, refid=call_key)
+        if "arg1" in channel_vars:
+            log.debug("Picked up call detected for uniqueid %s", channel_vars.get("uniqueid"))
+            # this is a picked up call in a dial M macro
+            if "dialedpeernumber" in channel_vars:
+                log.debug("Found dp number in channel vars %s", channel_vars)
+                msg_data.to_num = get_dialedpeernumber(channel_vars["dialedpeernumber"])
+            else:
+                log.debug("No dialed peer number in channel vars %s", channel_vars)
+                if "callerid_num" in channel_vars:
+                    msg_data.to_num = channel_vars["callerid_num"]
+                if "callerid_name" in channel_vars:
+                    msg_data.to_name = channel_vars["callerid_name"]
+            return CallEvent(call_key, msg_data, False, t.established(get_destination(msg_data)), color=color)
+        if "dialstatus" in channel_vars:
+            log.debug("finished call detected for uniqueid %s", call_key)
+            msg_data.dialstatus = channel_vars["dialstatus"]
+            text, color = t.finished(channel_vars["dialstatus"], msg_data.direction, get_destination(msg_data))
+            return CallEvent(call_key, msg_data, False, text, color=color, finished=True)
+        if "hangupcause" in channel_vars and int(channel_vars["hangupcause"]) > 0:
+            return CallEvent(call_key, msg_data, False, t.hangup(get_destination(msg_data)), color=color, finished=True)
+        if "hangupcause" in channel_vars and int(channel_vars["hangupcause"]) <= 0:
+            return CallEvent(call_key, msg_data, False, t.hangup_unknown(int(channel_vars["hangupcause"])), color=color)
+        return CallEvent(call_key, msg_data, False, t.unknown(), color=color)
+
+    def stale_event(self, msg_data):
+        """Final update for a call evicted from the call store without a final AGI event"""
+        text, color = self.templates.stale()
+        return CallEvent(msg_data.uniqueid, msg_data, False, text, color=color, finished=True)
+
+    def posted(self, event):
+        """Record the ts and channel of the Slack messages posted for a new call"""
+        self.store.save(event.msg_data)
+
+    def finish(self, event):
+        """Drop the state of a finished call"""
+        self.store.pop(event.call_key)
+        log.debug("Removed finished call %s (call store size: %d)", event.call_key, len(self.store))
@@ -0,0 +1,143 @@
+# coding=utf-8
+"""Capture of FastAGI sessions for later replay.
+
+With ``[capture] enabled = true`` every AGI session is appended to the
+capture file as one JSON line once it ends::
+
+    {"start": 1700000000.123, "peer": "127.0.0.1:51234", "env": {...},
+     "io": [[0.4, ">", "GET VARIABLE DIALSTATUS"], [0.9, "<", "200 result=1 (ANSWER)"], ...],
+     "end": 1.3}
+
+``start`` is the wall clock time the session was accepted, the offsets in
+``io`` and ``end`` are milliseconds since then, ``>`` marks commands sent to
+Asterisk and ``<`` the lines received after the environment block.
+Sessions are written whole, so concurrent sessions never interleave, and
+in the order they end. See ``benchmarks/replay_agi.py`` for replaying a
+capture against a server.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from . import agi_protocol
+
+log = logging.getLogger("slack_asterisk")
+
+
+class SessionRecord(object):
+    """Environment and command/reply lines of one AGI session"""
+    __slots__ = ("start", "peer", "env", "io", "_t0")
+
+    def __init__(self, peer):
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        self.peer = "%s:%s" % tuple(peer[:2])
+        self.env = None
+        self.io = []
+
+    def _offset(self):
+        return round((time.perf_counter() - self._t0) * 1000, 3)
+
+    def sent(self, cmds):
+        offset = self._offset()
+        self.io.extend([offset, ">", cmd] for cmd in cmds)
+
+    def received(self, line):
+        self.io.append([self._offset(), "<", line.decode(errors="replace")])
+
+    def as_dict(self):
+        return {"start": round(self.start, 6), "peer": self.peer, "env": self.env, "io": self.io, "end": self._offset()}
+
+
+class CaptureLog(object):
+    """Append-only capture file, safe to use from several handler threads
+
+    :param path: file to append JSON lines to
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")  # pylint:disable=consider-using-with
+        self._lock = threading.Lock()
+        self.sessions = 0
+
+    def write(self, record):
+        line = json.dumps(record.as_dict(), separators=(",", ":"), ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            # one flush per session, a crash loses at most the sessions in progress
+            self._file.flush()
+            self.sessions += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def create_capture(config):
+    """CaptureLog for the [capture] section, None if capturing is disabled"""
+    cc = config["capture"]
+    if not cc["enabled"]:
+        return None
+    log.info("Capturing AGI sessions to %s", cc["path"])
+    return CaptureLog(cc["path"])
+
+
+def read_capture(path):
+    """Yield the sessions of a capture file as dicts, skipping a truncated last line"""
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            try:
+                yield json.loads(line)
+            except ValueError:
+                log.warning("Skipping unreadable line %d of capture %s", n, path)
+
+
+class RecordingAGIConnection(agi_protocol.AGIConnection):
+    """AGIConnection writing all traffic of the session to a SessionRecord"""
+
+    def __init__(self, rfile, wfile, record, max_line=agi_protocol.MAX_LINE):
+        super().__init__(rfile, wfile, max_line)
+        self.record = record
+
+    def readline(self):
+        line = super().readline()
+        if line is not None and self.record.env is not None:
+            self.record.received(line)
+        return line
+
+    def read_env(self):
+        env = super().read_env()
+        self.record.env = env
+        return env
+
+    def send(self, *cmds):
+        self.record.sent(cmds)
+        super().send(*cmds)
+
+
+class RecordingAsyncAGIConnection(agi_protocol.AsyncAGIConnection):
+    """AsyncAGIConnection writing all traffic of the session to a SessionRecord"""
+
+    def __init__(self, reader, writer, record):
+        super().__init__(reader, writer)
+        self.record = record
+
+    async def readline(self):
+        line = await super().readline()
+        if line is not None and self.record.env is not None:
+            self.record.received(line)
+        return line
+
+    async def read_env(self):
+        env = await super().read_env()
+        self.record.env = env
+        return env
+
+    async def send(self, *cmds):
+        self.record.sent(cmds)
+        await super().send(*cmds)
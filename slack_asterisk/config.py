@@ -5,11 +5,148 @@ CONFIG_SPEC_SOURCE = """
 [general]
 ip = string(default="127.0.0.1")
 port = integer(min=1024,max=65535,default=4574)
+var_fetch = option("serial", "pipeline", "full", default="full")
+engine = option("threaded", "asyncio", "ami", default="threaded")
+max_sessions = integer(min=1, default=10000)
+drain_timeout = float(min=0, default=30.0)
+processes = integer(min=1, default=1)
+
+[ami]
+host = string(default="127.0.0.1")
+port = integer(min=1,max=65535,default=5038)
+username = string(default="")
+secret = string(default="")
+outbound_contexts = force_list(default=list())
+reconnect_interval = float(min=0.1, default=5.0)
+
+[dispatch]
+workers = integer(min=0, default=4)
+queue_size = integer(min=1, default=1000)
+overflow = option("block", "drop_oldest", "drop_newest", default="block")
+block_timeout = float(min=0, default=1.0)
+coalesce = boolean(default=True)
+
+[store]
+max_calls = integer(min=1, default=10000)
+ttl = integer(min=1, default=14400)
+reap_interval = integer(min=1, default=30)
+stale_update = boolean(default=False)
+backend = option("memory", "sqlite", default="memory")
+path = string(default="/var/lib/slack-asterisk/calls.db")
+commit_interval = float(min=0.01, default=0.5)
+
+[ratelimit]
+enabled = boolean(default=True)
+post_rate = float(min=0.01, default=5.0)
+post_burst = integer(min=1, default=20)
+update_rate = float(min=0.01, default=0.8)
+update_burst = integer(min=1, default=20)
+channel_rate = float(min=0.01, default=1.0)
+channel_burst = integer(min=1, default=5)
+max_retries = integer(min=0, default=3)
+
+[transport]
+type = option("pooled", "urllib", default="pooled")
+pool_size = integer(min=0, default=0)
+connect_timeout = float(min=0.1, default=3.0)
+read_timeout = float(min=0.1, default=10.0)
+idle_timeout = float(min=1, default=50.0)
+proxy = string(default="")
+warm_up = boolean(default=True)
+
+[capture]
+enabled = boolean(default=False)
+path = string(default="/var/lib/slack-asterisk/agi-capture.jsonl")
+
+[templates]
+format = option("attachments", "blocks", default="attachments")
+time_format = string(default="%A %d.%m.%Y %H:%M:%S")
+ringing_in = string(default="📞 Incoming call (ringing)$info")
+ringing_out = string(default="📞 Outgoing call (ringing) to $exten$info")
+info = string(default=" ($info_text)")
+established = string(default="☑️ Call established with $dest")
+finished_in = string(default="$status from $dest")
+finished_out = string(default="$status to $dest")
+hangup = string(default="Call hung up by $dest")
+hangup_unknown = string(default="Unknown call state (hangupcause $hangupcause)")
+unknown = string(default="Unknown call state")
+stale = string(default="⚠️ Call state unknown (no final event received)")
+typed = string(default="$type: $text")
+title_in = string(default="⬅️ Call from $from_num$from_name$title_text")
+title_out = string(default="➡️ Call from $from_num$from_name$title_text")
+fallback = string(default="Call from $from_num$from_name$title_text")
+from_name = string(default=" ($from_name) ")
+title_text = string(default=" - $title_text")
+footer = string(default="Time: $time$dialed$answered")
+dialed = string(default=" - Dialed for $duration")
+answered = string(default=" - Answered for $duration")
+status_answer = string(default="✅ Call ended")
+status_busy = string(default="⭕ Busy")
+status_noanswer = string(default="❌️ Not answered")
+status_cancel = string(default="❌ Canceled")
+status_congestion = string(default="❌ Congestion")
+status_chanunavail = string(default="❌ Channel unavailable")
+status_dontcall = string(default="❌ Reject (don't call)")
+status_torture = string(default="❌ Reject (torture)")
+status_other = string(default="Unknown")
+color_answer = string(default="good")
+color_busy = string(default="warning")
+color_noanswer = string(default="warning")
+color_cancel = string(default="warning")
+color_congestion = string(default="")
+color_chanunavail = string(default="")
+color_dontcall = string(default="")
+color_torture = string(default="")
+color_other = string(default="")
+color_default = string(default="good")
+color_stale = string(default="")
+
+[routing]
+[[__many__]]
+channels = force_list(min=1)
+exten = force_list(default=list())
+callerid = force_list(default=list())
+direction = force_list(default=list())
+type = force_list(default=list())
+time = force_list(default=list())
+days = force_list(default=list())
+
+[phonebook]
+path = string(default="")
+format = option("auto", "csv", "vcard", default="auto")
+cache_size = integer(min=0, default=10000)
+reload_interval = integer(min=0, default=60)
+
+[tracing]
+enabled = boolean(default=False)
+sample_rate = float(min=0, max=1, default=1.0)
+capacity = integer(min=1, default=1000)
+slow_threshold = float(min=0, default=5.0)
+
+[history]
+enabled = boolean(default=False)
+capacity = integer(min=1, default=100000)
+
+[summary]
+enabled = boolean(default=False)
+threshold = float(min=0.1, default=30.0)
+interval = float(min=1, default=60.0)
+
+[profiler]
+enabled = boolean(default=False)
+max_duration = float(min=1, default=60.0)
+max_rate = integer(min=1, max=1000, default=100)
+
+[http]
+enabled = boolean(default=True)
+ip = string(default="127.0.0.1")
+port = integer(min=1024,max=65535,default=4575)
 
 [slack]
 client_id = string(default="")
 client_secret = string(default="")
 channel = string(min=1, default="telefon")
+base_url = string(default="https://slack.com/api/")
 
 username = string(default="User")
 emoji  = string(default=":telephone_receiver:")
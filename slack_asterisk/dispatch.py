@@ -0,0 +1,458 @@
+# coding=utf-8
+"""Background dispatch of Slack messages.
+
+AGI handlers hand the :class:`calls.CallEvent` of an invocation to
+:class:`SlackDispatcher` and return to Asterisk immediately. A pool of
+worker threads renders the message and calls ``chat_postMessage`` /
+``chat_update``. Events are kept in an ordered mailbox per call and a
+call is only handed to one worker at a time, so the initial post of a call
+is always sent before its updates while different calls are sent fully in
+parallel.
+
+Queued events are sent by priority: posts of new calls first, then
+intermediate updates, then final-state updates. This never reorders the
+events of one call, whose post always comes first and which is finished by
+its final update.
+
+Updates are coalesced per call: while an update of a call is still queued,
+a newer update of the same call replaces it in place, so only the latest
+state is sent once the call's previous request has finished. Attachments
+are rendered at send time, superseded updates are never rendered at all.
+An update rendering the same payload as the one last sent to a message
+(e.g. a repeated unknown state or hangup cause) is not sent, see
+:func:`digest`.
+
+The queue is bounded. When it is full the overflow policy decides:
+
+block
+    wait up to ``block_timeout`` seconds for space, then drop the new event
+drop_oldest
+    drop the oldest queued event of the least important priority level
+    (the new event if all queued events belong to calls currently being sent)
+drop_newest
+    drop the new event
+"""
+import collections
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from . import history
+from . import metrics
+from . import summary
+from . import templates as message_templates
+from . import tracing
+
+log = logging.getLogger("slack_asterisk")
+
+OVERFLOW_POLICIES = ("block", "drop_oldest", "drop_newest")
+
+# priority levels, lower is sent first
+PRIO_POST = 0
+PRIO_UPDATE = 1
+PRIO_FINAL = 2
+
+
+def priority(event):
+    if event.new_call:
+        return PRIO_POST
+    return PRIO_FINAL if event.finished else PRIO_UPDATE
+
+
+class _Mailboxes(object):
+    """Ordered per-call mailboxes of entries [event, enqueued], guarded by the dispatcher's condition
+
+    A call is ready when its mailbox is not empty and no worker is sending one of
+    its events. Ready calls are kept per priority level of their oldest entry.
+    """
+    __slots__ = ("boxes", "ready", "active", "size")
+
+    def __init__(self):
+        self.boxes = {}
+        self.ready = (collections.deque(), collections.deque(), collections.deque())
+        self.active = set()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def has_ready(self):
+        return any(self.ready)
+
+    def _mark_ready(self, key, box):
+        self.ready[priority(box[0][0])].append(key)
+
+    def tail(self, key):
+        """Last queued entry of a call or None"""
+        box = self.boxes.get(key)
+        return box[-1] if box else None
+
+    def replace_tail(self, event):
+        """Put event in place of the last queued entry of its call, rescheduled at the level of event if it is ready"""
+        key = event.call_key
+        box = self.boxes[key]
+        level = priority(box[-1][0])
+        box[-1][0] = event
+        if len(box) == 1 and key not in self.active and level != priority(event):
+            self.ready[level].remove(key)
+            self._mark_ready(key, box)
+
+    def push(self, entry):
+        key = entry[0].call_key
+        box = self.boxes.get(key)
+        if box is None:
+            box = self.boxes[key] = collections.deque()
+        box.append(entry)
+        self.size += 1
+        if len(box) == 1 and key not in self.active:
+            self._mark_ready(key, box)
+
+    def take(self):
+        """Take the oldest entry of the most important ready call and mark the call active"""
+        for level in self.ready:
+            if level:
+                key = level.popleft()
+                self.active.add(key)
+                self.size -= 1
+                return self.boxes[key].popleft()
+        raise IndexError("no ready call")
+
+    def done(self, key):
+        """Call is no longer active, make it ready again if more entries are waiting"""
+        self.active.discard(key)
+        box = self.boxes.get(key)
+        if box:
+            self._mark_ready(key, box)
+        elif box is not None:
+            del self.boxes[key]
+
+    def drop_oldest(self):
+        """Drop the oldest entry of the least important ready call, None if no call is ready"""
+        for level in reversed(self.ready):
+            if level:
+                key = level.popleft()
+                box = self.boxes[key]
+                entry = box.popleft()
+                self.size -= 1
+                if box:
+                    self._mark_ready(key, box)
+                else:
+                    del self.boxes[key]
+                return entry
+        return None
+
+
+def targets(config, msg_data):
+    """Channels a new call is posted to: its routed channels, else the configured channel"""
+    return msg_data.channels or [config["channel"]]
+
+
+def messages(msg_data):
+    """(channel ID, ts) of the Slack messages posted for a call"""
+    if msg_data.messages:
+        return list(msg_data.messages.items())
+    if msg_data.ts is not None:
+        # state journaled before messages were tracked per channel
+        return [(msg_data.channel, msg_data.ts)]
+    return []
+
+
+def _check(ret):
+    if ret["ok"] is not True:
+        raise RuntimeError("Cannot post message with error %s" % ret["error"])
+    return ret
+
+
+def digest(payload):
+    """Compact fingerprint of a rendered payload"""
+    return hashlib.blake2b(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode(), digest_size=8).digest()
+
+
+def _posted(msg_data, ret, sent):
+    """Record a posted message and the digest of its payload, ts and channel keep the first one"""
+    if msg_data.ts is None:
+        msg_data.ts = ret["ts"]
+        msg_data.channel = ret["channel"]
+    # replaced, not modified, as the call store may serialize the state concurrently
+    msg_data.messages = {**(msg_data.messages or {}), ret["channel"]: ret["ts"]}
+    _sent(msg_data, ret["channel"], ret["ts"], sent)
+
+
+def _sent(msg_data, channel, ts, sent):
+    msg_data.digests = {**(msg_data.digests or {}), (channel, ts): sent}
+
+
+def _unchanged(msg_data, channel, ts, sent):
+    """True if the message already shows the payload with digest sent, the update is skipped"""
+    if msg_data.digests is None or msg_data.digests.get((channel, ts)) != sent:
+        return False
+    log.debug("Slack message %s in channel %s is up to date, skipping update", ts, channel)
+    metrics.SLACK_UPDATES_SKIPPED.inc()
+    return True
+
+
+def _failed(error, e, channel, count):
+    """Remember the first error of a fan-out, the other channels are still sent"""
+    if count > 1:
+        log.warning("Slack message to channel %s failed with message %s", channel, e)
+    return error or e
+
+
+def _traced(trace, method, channel, started, e=None):
+    """Record a Slack request in the trace of its call"""
+    if trace is None:
+        return
+    if e is None:
+        trace.span("slack." + method, started, time.perf_counter(), channel=channel)
+    else:
+        trace.span("slack." + method, started, time.perf_counter(), channel=channel, error=str(e))
+
+
+def deliver(slack_client, config, event, templates=message_templates.DEFAULT):
+    """Render and send the Slack messages for a CallEvent
+
+    A new call is posted to each of its channels (see :func:`targets`) that is
+    not in digest mode (see :mod:`summary`), the ts and channel of the posted
+    messages are stored in the call state. Updates
+    are sent to all messages of the call. If sending to a channel fails the
+    others are still sent, then the first error is raised.
+
+    :param templates: templates.MessageTemplates rendering the message
+    """
+    msg_data = event.msg_data
+    payload = templates.payload(event.text, msg_data, event.color)
+    sent = digest(payload)
+    trace = tracing.TRACER.trace(event.call_key)
+    error = None
+    if event.new_call:
+        channels = summary.SUMMARIZER.route(msg_data, targets(config, msg_data))
+        for channel in channels:
+            log.debug("Channel post called for channel #%s with message %s", channel, payload)
+            started = time.perf_counter()
+            try:
+                _posted(msg_data, _check(slack_client.chat_postMessage(channel=channel, **payload)), sent)
+                _traced(trace, "chat.postMessage", channel, started)
+            except Exception as e:
+                _traced(trace, "chat.postMessage", channel, started, e)
+                error = _failed(error, e, channel, len(channels))
+    else:
+        posts = messages(msg_data)
+        if not posts:
+            log.debug("No Slack message to update for call %s", event.call_key)
+        for channel, ts in posts:
+            if _unchanged(msg_data, channel, ts, sent):
+                continue
+            log.debug("Channel update called for channel #%s with message %s", channel, payload)
+            started = time.perf_counter()
+            try:
+                _check(slack_client.chat_update(channel=channel, ts=ts, **payload))
+                _sent(msg_data, channel, ts, sent)
+                _traced(trace, "chat.update", channel, started)
+            except Exception as e:
+                _traced(trace, "chat.update", channel, started, e)
+                error = _failed(error, e, channel, len(posts))
+    if event.finished:
+        finished(event.call_key, msg_data)
+    if error is not None:
+        raise error
+
+
+def finished(call_key, msg_data):
+    """Count a finished call in the summaries and the history and end its trace, also for calls expired without Slack update"""
+    summary.SUMMARIZER.finish(msg_data)
+    history.HISTORY.add(msg_data)
+    tracing.TRACER.finish(call_key)
+
+
+async def deliver_async(slack_client, config, event, templates=message_templates.DEFAULT):
+    """:func:`deliver` with an AsyncWebClient"""
+    msg_data = event.msg_data
+    payload = templates.payload(event.text, msg_data, event.color)
+    sent = digest(payload)
+    trace = tracing.TRACER.trace(event.call_key)
+    error = None
+    if event.new_call:
+        channels = summary.SUMMARIZER.route(msg_data, targets(config, msg_data))
+        for channel in channels:
+            log.debug("Channel post called for channel #%s with message %s", channel, payload)
+            started = time.perf_counter()
+            try:
+                _posted(msg_data, _check(await metrics.observe_request("chat.postMessage", slack_client.chat_postMessage(channel=channel, **payload))), sent)
+                _traced(trace, "chat.postMessage", channel, started)
+            except Exception as e:
+                _traced(trace, "chat.postMessage", channel, started, e)
+                error = _failed(error, e, channel, len(channels))
+    else:
+        posts = messages(msg_data)
+        if not posts:
+            log.debug("No Slack message to update for call %s", event.call_key)
+        for channel, ts in posts:
+            if _unchanged(msg_data, channel, ts, sent):
+                continue
+            log.debug("Channel update called for channel #%s with message %s", channel, payload)
+            started = time.perf_counter()
+            try:
+                _check(await metrics.observe_request("chat.update", slack_client.chat_update(channel=channel, ts=ts, **payload)))
+                _sent(msg_data, channel, ts, sent)
+                _traced(trace, "chat.update", channel, started)
+            except Exception as e:
+                _traced(trace, "chat.update", channel, started, e)
+                error = _failed(error, e, channel, len(posts))
+    if event.finished:
+        finished(event.call_key, msg_data)
+    if error is not None:
+        raise error
+
+
+class SlackDispatcher(object):  # pylint:disable=too-many-instance-attributes
+    """Bounded queue of CallEvents drained by a pool of worker threads
+
+    :param slack_client: WebClient shared by all workers
+    :param config: slack section of the configuration
+    :param workers: number of worker threads
+    :param queue_size: maximum number of queued events
+    :param overflow: one of :data:`OVERFLOW_POLICIES`
+    :param block_timeout: maximum wait in seconds for the block policy
+    :param coalesce: replace queued updates of a call by newer ones
+    :param on_posted: optional callable(CallEvent) invoked after the post of a new call was sent
+    :param templates: templates.MessageTemplates rendering the messages, defaults if None
+    """
+
+    def __init__(self, slack_client, config, workers=4, queue_size=1000, overflow="block", block_timeout=1.0, coalesce=True, on_posted=None, templates=None):  # pylint:disable=too-many-arguments
+        if workers < 1:
+            raise ValueError("SlackDispatcher needs at least one worker")
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %s" % overflow)
+        self.slack_client = slack_client
+        self.config = config
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.coalesce = coalesce
+        self.on_posted = on_posted
+        self.templates = templates or message_templates.DEFAULT
+        self.capacity = queue_size
+        self.workers = workers
+        self._queue = _Mailboxes()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._running = False
+        self._stats_lock = threading.Lock()
+        self.stats = dict(submitted=0, sent=0, failed=0, dropped=0, coalesced=0, wait_seconds_sum=0.0, wait_seconds_max=0.0)
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def _waited(self, seconds):
+        with self._stats_lock:
+            self.stats["wait_seconds_sum"] += seconds
+            if seconds > self.stats["wait_seconds_max"]:
+                self.stats["wait_seconds_max"] = seconds
+
+    def start(self):
+        self._running = True
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name="slack-dispatch-%d" % i, daemon=True)
+            t.start()
+            self._threads.append(t)
+        log.debug("Started %d Slack dispatch workers (queue capacity %d, overflow %s)", len(self._threads), self.capacity, self.overflow)
+
+    def stop(self, timeout=None):
+        """Stop accepting events and wait up to timeout seconds for the queues to drain
+
+        :return: number of events still queued
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for t in self._threads:
+            t.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        return self.depth()
+
+    def depth(self):
+        """Number of queued events"""
+        return len(self._queue)
+
+    def submit(self, event):
+        """Queue a CallEvent for delivery
+
+        :return: True if the event was queued, False if it was dropped
+        """
+        if not self._running:
+            log.warning("Dispatcher stopped, dropping Slack message for call %s", event.call_key)
+            self._count("dropped")
+            return False
+        q = self._queue
+        cond = self._cond
+        with cond:
+            if self.coalesce and not event.new_call:
+                entry = q.tail(event.call_key)
+                if entry is not None and not entry[0].new_call:
+                    # an older update of this call is still queued, it would be overwritten right away anyway
+                    q.replace_tail(event)
+                    self._count("coalesced")
+                    self._count("submitted")
+                    return True
+            if len(q) >= self.capacity:
+                if self.overflow == "drop_oldest":
+                    dropped = q.drop_oldest()
+                    if dropped is None:
+                        log.warning("Slack dispatch queue full, dropping message for call %s", event.call_key)
+                        self._count("dropped")
+                        return False
+                    log.warning("Slack dispatch queue full, dropping oldest message for call %s", dropped[0].call_key)
+                    self._count("dropped")
+                elif self.overflow == "block" and cond.wait_for(lambda: len(q) < self.capacity, self.block_timeout):
+                    pass
+                else:
+                    log.warning("Slack dispatch queue full, dropping message for call %s", event.call_key)
+                    self._count("dropped")
+                    return False
+            q.push([event, time.monotonic()])
+            cond.notify_all()
+        self._count("submitted")
+        return True
+
+    def _run(self):
+        q = self._queue
+        cond = self._cond
+        while True:
+            with cond:
+                cond.wait_for(lambda: q.has_ready() or not (self._running or q))
+                if not q.has_ready():
+                    return
+                event, enqueued = q.take()
+                cond.notify_all()
+            waited = time.monotonic() - enqueued
+            self._waited(waited)
+            now = time.perf_counter()
+            tracing.TRACER.span(event.call_key, "dispatch.queue", now - waited, now)
+            log.debug("Dispatching Slack message for call %s after %.3fs in queue", event.call_key, waited)
+            try:
+                deliver(self.slack_client, self.config, event, self.templates)
+                self._count("sent")
+                if event.new_call and self.on_posted is not None:
+                    self.on_posted(event)
+            except Exception as e:
+                self._count("failed")
+                log.exception("Sending Slack message for call %s failed with message %s", event.call_key, e)
+            finally:
+                with cond:
+                    q.done(event.call_key)
+                    cond.notify_all()
+
+
+def create_dispatcher(slack_client, config, on_posted=None, templates=None):
+    """Create and start a SlackDispatcher from the [dispatch] section, None if workers = 0
+
+    slack_client should already be wrapped by :func:`ratelimit.create_client`.
+    """
+    dc = config["dispatch"]
+    if dc["workers"] == 0:
+        return None
+    dispatcher = SlackDispatcher(slack_client, config["slack"], workers=dc["workers"], queue_size=dc["queue_size"], overflow=dc["overflow"], block_timeout=dc["block_timeout"], coalesce=dc["coalesce"], on_posted=on_posted, templates=templates)
+    dispatcher.start()
+    return dispatcher
@@ -55,3 +55,8 @@ class AGIUsageError(AGIError):
 class AGIInvalidCommand(AGIError):
 	"""AGI Invalid Command Error"""
 	pass
+
+
+class AMIError(Exception):
+	"""AMI login or protocol error"""
+	pass
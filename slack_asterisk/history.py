@@ -0,0 +1,323 @@
+# coding=utf-8
+"""History of finished calls.
+
+With ``[history] enabled = true`` a record of every finished call (numbers
+and names, direction, DIALSTATUS, dialed and answered time, the channel and
+ts of its Slack message) is kept in memory, the last ``capacity`` calls in a
+ring buffer. The HTTP server searches it at ``/calls``:
+
+``/calls?number=4930123456``
+    calls from or to a number, newest first
+``/calls?number=4930*``
+    calls from or to numbers starting with a prefix
+``/calls?since=...&until=...``
+    calls finished in a time range (unix time, or seconds ago if negative)
+
+further filtered by ``direction``, ``dialstatus`` and ``limit``, and
+aggregates the matching calls at ``/calls/stats`` (``&by=dialstatus``,
+``direction``, ``hour`` or ``number``).
+
+Numbers are indexed by their digits only, so ``+49 30 123`` and
+``4930123`` are the same number while ``030123`` is not. The index maps each
+number to the positions of its calls, a sorted list of the distinct numbers
+answers prefix searches by bisection and the finish times, appended in
+order, answer time ranges by bisection too. Searches cost the matching
+calls, not the size of the buffer.
+
+The history is not persisted, a restart starts an empty one.
+"""
+import array
+import bisect
+import collections
+import logging
+import threading
+import time
+
+log = logging.getLogger("slack_asterisk")
+
+# calls returned by a search unless limited
+DEFAULT_LIMIT = 100
+# aggregation keys of /calls/stats
+GROUPS = ("dialstatus", "direction", "hour", "number")
+
+
+def normalize(number):
+    """Digits of a number as indexed, "" if it has none"""
+    return "".join(c for c in number if c.isdigit()) if number else ""
+
+
+class CallRecord(object):  # pylint:disable=too-many-instance-attributes
+    """A finished call"""
+    __slots__ = ("uniqueid", "start", "end", "from_num", "from_name", "to_num", "to_name", "direction", "dialstatus",
+                 "dialedtime", "answeredtime", "channel", "ts")
+
+    def __init__(self, msg_data, end):
+        self.uniqueid = msg_data.uniqueid
+        self.start = msg_data.ts_in.timestamp() if msg_data.ts_in is not None else end
+        self.end = end
+        self.from_num = msg_data.from_num
+        self.from_name = msg_data.from_name
+        self.to_num = msg_data.to_num
+        self.to_name = msg_data.to_name
+        self.direction = msg_data.direction
+        # HANGUP for calls finished by a hangup cause or expired without final event, as in the summaries
+        self.dialstatus = msg_data.dialstatus or "HANGUP"
+        self.dialedtime = msg_data.dialedtime
+        self.answeredtime = msg_data.answeredtime
+        self.channel = msg_data.channel
+        self.ts = msg_data.ts
+
+    def numbers(self):
+        """Indexed numbers of the call"""
+        numbers = {normalize(self.from_num), normalize(self.to_num)}
+        numbers.discard("")
+        return numbers
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class CallHistory(object):
+    """Ring buffer of CallRecords with a number index and a time index
+
+    :param capacity: calls kept, the oldest are dropped beyond; 0 disables the history
+    """
+
+    def __init__(self, capacity=0):
+        self._lock = threading.Lock()
+        self.stats = dict(recorded=0, dropped=0)
+        self.capacity = None
+        self.configure(capacity)
+
+    def configure(self, capacity):
+        """Set the capacity, an existing history is kept if it does not change"""
+        if capacity == self.capacity:
+            return
+        with self._lock:
+            self.capacity = capacity
+            self._records = [None] * capacity
+            # finish time of the record in each slot, never decreasing in sequence order
+            self._ends = array.array("d", bytes(8 * capacity))
+            # sequence number of the next record, record n is in slot n % capacity
+            self._next = 0
+            # number -> deque of the sequence numbers of its calls, oldest first
+            self._index = {}
+            # distinct numbers of _index, sorted for prefix searches
+            self._numbers = []
+            # hour -> (dialstatus, direction) -> totals of the records finished in that hour, see _tally
+            self._hours = {}
+
+    def __len__(self):
+        return min(self._next, self.capacity)
+
+    def add(self, msg_data):
+        """Record a finished call"""
+        if not self.capacity:
+            return
+        record = CallRecord(msg_data, time.time())
+        with self._lock:
+            seq = self._next
+            slot = seq % self.capacity
+            if seq >= self.capacity:
+                self._drop(seq - self.capacity)
+            # the time index needs ascending times, keep them so if the clock is set back
+            end = max(record.end, self._ends[(seq - 1) % self.capacity]) if seq else record.end
+            self._records[slot] = record
+            self._ends[slot] = end
+            for number in record.numbers():
+                seqs = self._index.get(number)
+                if seqs is None:
+                    seqs = self._index[number] = collections.deque()
+                    bisect.insort(self._numbers, number)
+                seqs.append(seq)
+            self._tally(self._totals(end, record), record)
+            self._next = seq + 1
+            self.stats["recorded"] += 1
+
+    def _drop(self, seq):
+        """Remove the oldest record from the number index and the hourly totals"""
+        record = self._records[seq % self.capacity]
+        hour = int(self._end(seq) // 3600)
+        self._tally(self._hours[hour][record.dialstatus, record.direction], record, -1)
+        if not self._hours[hour][record.dialstatus, record.direction][0]:
+            del self._hours[hour][record.dialstatus, record.direction]
+            if not self._hours[hour]:
+                del self._hours[hour]
+        for number in record.numbers():
+            seqs = self._index[number]
+            seqs.popleft()
+            if not seqs:
+                del self._index[number]
+                del self._numbers[bisect.bisect_left(self._numbers, number)]
+        self.stats["dropped"] += 1
+
+    def _totals(self, end, record):
+        hour = self._hours.get(int(end // 3600))
+        if hour is None:
+            hour = self._hours[int(end // 3600)] = {}
+        totals = hour.get((record.dialstatus, record.direction))
+        if totals is None:
+            totals = hour[record.dialstatus, record.direction] = [0, 0, 0, 0, 0, 0]
+        return totals
+
+    @staticmethod
+    def _tally(totals, record, sign=1):
+        """Count a record in totals: calls, dialed time sum and count, answered calls, answered time sum and count"""
+        totals[0] += sign
+        if record.dialedtime is not None:
+            totals[1] += sign * record.dialedtime
+            totals[2] += sign
+        if record.dialstatus == "ANSWER":
+            totals[3] += sign
+            if record.answeredtime is not None:
+                totals[4] += sign * record.answeredtime
+                totals[5] += sign
+
+    def _end(self, seq):
+        return self._ends[seq % self.capacity]
+
+    def _between(self, since, until):
+        """Sequence numbers of the records finished between since and until"""
+        first = max(0, self._next - self.capacity)
+        seqs = range(first, self._next)
+        lo = bisect.bisect_left(seqs, since, key=self._end) if since is not None else 0
+        hi = bisect.bisect_right(seqs, until, key=self._end) if until is not None else len(seqs)
+        return seqs[lo:hi]
+
+    def _matching(self, number):
+        """Sequence numbers of the calls from or to a number, or numbers starting with it if it ends with *"""
+        if not number.endswith("*"):
+            return list(self._index.get(normalize(number), ()))
+        prefix = normalize(number)
+        lo = bisect.bisect_left(self._numbers, prefix)
+        hi = bisect.bisect_left(self._numbers, prefix + ":") if prefix else len(self._numbers)
+        seqs = set()
+        for n in self._numbers[lo:hi]:
+            seqs.update(self._index[n])
+        return sorted(seqs)
+
+    def _select(self, number=None, since=None, until=None, direction=None, dialstatus=None):
+        """Matching records, newest first; called with the lock held"""
+        if number:
+            seqs = self._matching(number)
+            if since is not None or until is not None:
+                seqs = [seq for seq in seqs if (since is None or self._end(seq) >= since) and (until is None or self._end(seq) <= until)]
+        else:
+            seqs = self._between(since, until)
+        records = self._records
+        capacity = self.capacity
+        for seq in reversed(seqs):
+            record = records[seq % capacity]
+            if direction is not None and record.direction != direction:
+                continue
+            if dialstatus is not None and record.dialstatus != dialstatus:
+                continue
+            yield record
+
+    def search(self, number=None, since=None, until=None, direction=None, dialstatus=None, limit=DEFAULT_LIMIT):
+        """Records of the matching calls as dicts, newest first
+
+        :param number: number the calls are from or to, a prefix if it ends with *
+        :param since: unix time the calls finished at or after
+        :param until: unix time the calls finished at or before
+        """
+        if not self.capacity:
+            return []
+        with self._lock:
+            found = []
+            for record in self._select(number, since, until, direction, dialstatus):
+                if len(found) >= limit:
+                    break
+                found.append(record.as_dict())
+        return found
+
+    def aggregate(self, by="dialstatus", number=None, since=None, until=None, direction=None, dialstatus=None):
+        """Number of calls, answered calls and average dialed and answered time of the matching calls per group
+
+        Without number, the calls of the hours fully within since and until are
+        taken from hourly totals, only those of the hours at the edges are counted.
+
+        :param by: one of :data:`GROUPS`; number groups by the caller of incoming and the callee of outgoing calls
+        :param number: and the other criteria as for :meth:`search`
+        """
+        if by not in GROUPS:
+            raise ValueError("cannot group calls by %s, use one of %s" % (by, ", ".join(GROUPS)))
+        groups = {}
+        if self.capacity:
+            with self._lock:
+                if number or by == "number":
+                    records = self._select(number, since, until, direction, dialstatus)
+                else:
+                    records = self._edges(since, until, direction, dialstatus, groups, by)
+                for record in records:
+                    if by == "hour":
+                        # formatted once per group below
+                        key = int(record.end // 3600)
+                    elif by == "number":
+                        key = (record.to_num if record.direction == "out" else record.from_num) or "unknown"
+                    else:
+                        key = getattr(record, by)
+                    self._tally(self._group(groups, key), record)
+        result = []
+        for key, (calls, dialed, dialed_count, answered, answered_sum, answered_count) in groups.items():
+            if by == "hour":
+                key = time.strftime("%Y-%m-%d %H:00", time.localtime(key * 3600))
+            result.append({by: key if key is not None else "unknown", "calls": calls, "answered": answered,
+                           "avg_dialedtime": round(dialed / dialed_count, 1) if dialed_count else None,
+                           "avg_answeredtime": round(answered_sum / answered_count, 1) if answered_count else None})
+        result.sort(key=lambda group: (-group["calls"], group[by]))
+        return result
+
+    @staticmethod
+    def _group(groups, key):
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = [0, 0, 0, 0, 0, 0]
+        return group
+
+    def _edges(self, since, until, direction, dialstatus, groups, by):
+        """Add the hourly totals of the hours fully within since and until to groups, return the other records"""
+        first = max(0, self._next - self.capacity)
+        seqs = range(first, self._next)
+        # hours [lo_hour, hi_hour) are fully within the range
+        lo_hour = -int(-since // 3600) if since is not None else min(self._hours, default=0)
+        hi_hour = int(until // 3600) if until is not None else max(self._hours, default=0) + 1
+        lo = bisect.bisect_left(seqs, since, key=self._end) if since is not None else 0
+        hi = bisect.bisect_right(seqs, until, key=self._end) if until is not None else len(seqs)
+        if lo_hour >= hi_hour:
+            edges = seqs[lo:hi]
+        else:
+            lo_full = bisect.bisect_left(seqs, lo_hour * 3600, key=self._end)
+            hi_full = bisect.bisect_left(seqs, hi_hour * 3600, key=self._end)
+            edges = list(seqs[lo:max(lo, lo_full)]) + list(seqs[max(lo, hi_full):hi])
+            for hour, totals in self._hours.items():
+                if not lo_hour <= hour < hi_hour:
+                    continue
+                for (status, direct), counts in totals.items():
+                    if direction is not None and direct != direction or dialstatus is not None and status != dialstatus:
+                        continue
+                    group = self._group(groups, hour if by == "hour" else status if by == "dialstatus" else direct)
+                    for i, count in enumerate(counts):
+                        group[i] += count
+        records = self._records
+        capacity = self.capacity
+        for seq in edges:
+            record = records[seq % capacity]
+            if direction is not None and record.direction != direction or dialstatus is not None and record.dialstatus != dialstatus:
+                continue
+            yield record
+
+
+# fed by dispatch.deliver with every finished call and searched by the HTTP server, disabled until configured
+HISTORY = CallHistory()
+
+
+def configure(config):
+    """Set up HISTORY from the [history] section"""
+    hc = config["history"]
+    if not hc["enabled"]:
+        HISTORY.configure(0)
+        return HISTORY
+    HISTORY.configure(hc["capacity"])
+    log.info("Keeping the history of the last %d finished calls for /calls", hc["capacity"])
+    return HISTORY
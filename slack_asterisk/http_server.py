@@ -1,29 +1,27 @@
 """Simple Flask-based HTTP server (replacing Falcon).
 
-Exposes a single health endpoint returning "OK". Intended as a lightweight
-status/oAuth callback placeholder matching previous behavior.
+Exposes a health endpoint returning "OK" (also the placeholder for the
+oAuth callback of previous versions), ``/metrics`` with the counters and
+histograms of :mod:`metrics` in the Prometheus text format, ``/traces``
+with the call timelines of :mod:`tracing` and ``/calls`` with the finished
+calls of :mod:`history` as JSON. ``/profile`` profiles the process with
+:mod:`profiler` for clients on the loopback interface.
 """
 
 # coding=utf-8
 
+import ipaddress
 import logging
-import os
-from flask import Flask, request, Response
+import threading
+import time
+from flask import Flask, request, Response, jsonify
 
-log = logging.getLogger("slack_asterisk")
-
-
-def _init_logging_from_env():
-    level_name = os.getenv("LOG_LEVEL", os.getenv("DEBUG_LEVEL", "INFO")).upper()
-    level = getattr(logging, level_name, logging.INFO)
-    if not log.handlers:
-        ch = logging.StreamHandler()
-        ch.setLevel(level)
-        log.addHandler(ch)
-    log.setLevel(level)
+from . import history
+from . import metrics
+from . import profiler
+from . import tracing
 
-
-_init_logging_from_env()
+log = logging.getLogger("slack_asterisk")
 
 app = Flask(__name__)
 
@@ -34,6 +32,72 @@ def root_ok():  # pylint:disable=unused-variable
     return Response("OK", status=200, mimetype="text/plain")
 
 
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():  # pylint:disable=unused-variable
+    return Response(metrics.REGISTRY.render(), status=200, mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/traces", methods=["GET"])
+def traces():  # pylint:disable=unused-variable
+    limit = request.args.get("limit", 100, type=int)
+    slow = request.args.get("slow", "0") not in ("0", "false", "")
+    return jsonify(tracing.TRACER.recent(limit, slow))
+
+
+@app.route("/traces/<call>", methods=["GET"])
+def call_trace(call):  # pylint:disable=unused-variable
+    trace = tracing.TRACER.get(call)
+    if trace is None:
+        return jsonify(error="no trace for call %s" % call), 404
+    return jsonify(trace)
+
+
+def _time_arg(name):
+    """Unix time of a query parameter, negative values are seconds before now"""
+    value = request.args.get(name, type=float)
+    if value is not None and value < 0:
+        value += time.time()
+    return value
+
+
+def _call_criteria():
+    return dict(number=request.args.get("number"), since=_time_arg("since"), until=_time_arg("until"),
+                direction=request.args.get("direction"), dialstatus=request.args.get("dialstatus"))
+
+
+@app.route("/calls", methods=["GET"])
+def calls():  # pylint:disable=unused-variable
+    limit = request.args.get("limit", history.DEFAULT_LIMIT, type=int)
+    return jsonify(history.HISTORY.search(limit=limit, **_call_criteria()))
+
+
+@app.route("/calls/stats", methods=["GET"])
+def call_stats():  # pylint:disable=unused-variable
+    try:
+        return jsonify(history.HISTORY.aggregate(request.args.get("by", "dialstatus"), **_call_criteria()))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+
+@app.route("/profile", methods=["GET"])
+def profile():  # pylint:disable=unused-variable
+    if not profiler.PROFILER.enabled:
+        return jsonify(error="profiler disabled, see the [profiler] section"), 404
+    if not ipaddress.ip_address(request.remote_addr).is_loopback:
+        log.warning("Refused profile request from %s", request.remote_addr)
+        return jsonify(error="profiling is only allowed from the loopback interface"), 403
+    try:
+        result = profiler.PROFILER.profile(request.args.get("seconds", 10.0, type=float), request.args.get("rate", 100, type=int),
+                                           request.args.get("mode", "cpu"), request.args.get("thread"))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    if result is None:
+        return jsonify(error="another profile is running"), 409
+    stacks, info = result
+    headers = {"X-Profile-%s" % key.capitalize(): str(value) for key, value in info.items()}
+    return Response(stacks, status=200, mimetype="text/plain", headers=headers)
+
+
 def oauth_server(ip, port, _):
     # SECURITY NOTE: Flask's built-in development server is used here.
     # It is not suitable for production: it has no request concurrency limits,
@@ -41,3 +105,15 @@ def oauth_server(ip, port, _):
     # replace this with a WSGI server such as Gunicorn or uWSGI, e.g.:
     #   gunicorn -w 2 -b ip:port "slack_asterisk.http_server:app"
     app.run(host=ip, port=port, threaded=True)
+
+
+def start_http_server(config):
+    """Run the HTTP server of the [http] section in a daemon thread next to the AGI server, None if disabled"""
+    hc = config["http"]
+    if not hc["enabled"]:
+        return None
+    profiler.configure(config)
+    log.info("Starting HTTP server for /metrics, /traces and /calls on %s:%i", hc["ip"], hc["port"])
+    thread = threading.Thread(target=oauth_server, args=(hc["ip"], hc["port"], config), name="http-server", daemon=True)
+    thread.start()
+    return thread
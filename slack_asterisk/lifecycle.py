@@ -0,0 +1,231 @@
+# coding=utf-8
+"""Process lifecycle: systemd socket activation, graceful drain and reload.
+
+Socket activation
+    When started by ``slack-asterisk.socket``, systemd passes the listening
+    FastAGI socket (``LISTEN_FDS``/``LISTEN_PID``). The engines serve on it
+    instead of binding ``ip:port``; as systemd keeps the socket open, Asterisk's
+    connections wait in the kernel backlog during a restart instead of being
+    refused. ``READY=1``/``STOPPING=1``/``RELOADING=1`` are reported through
+    ``NOTIFY_SOCKET`` (``Type=notify``).
+SIGTERM, SIGINT
+    graceful drain: stop accepting, let the AGI sessions in progress finish
+    and flush the dispatch queue, all within ``drain_timeout`` seconds of the
+    signal, then flush the call store and exit
+SIGHUP
+    reload the config file; templates, routing, tracing, digest mode, the
+    [slack] section and var_fetch take effect for the following calls, changes of other
+    settings are logged and need a restart
+Startup
+    without socket activation, main binds the FastAGI socket right after
+    reading the config file (:func:`bind_socket`), before the engine and
+    its dependencies are imported and set up, so Asterisk's connections
+    wait in the backlog from then on instead of being refused
+"""
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from . import config
+from . import routing
+from . import summary
+from . import templates
+from . import tracing
+
+log = logging.getLogger("slack_asterisk")
+
+# first file descriptor passed by systemd
+SD_LISTEN_FDS_START = 3
+# connections waiting to be accepted, as socketserver's request_queue_size of the threaded engine
+BACKLOG = 128
+LOG_SPEC = "%(name)s[%(process)s]: %(filename)s:%(lineno)d/%(funcName)s###%(message)s"
+
+# sections applied by a reload, a change in any other section needs a restart
+RELOADABLE_SECTIONS = ("templates", "routing", "tracing", "summary", "slack")
+RELOADABLE_GENERAL = ("var_fetch",)
+# one reload at a time, SIGHUPs in a row start one thread each
+_RELOAD_LOCK = threading.Lock()
+
+
+def setup_logging():
+    """Log to stdout at LOG_LEVEL (or DEBUG_LEVEL), once per process; called by main and the engines"""
+    level_name = os.getenv("LOG_LEVEL", os.getenv("DEBUG_LEVEL", "INFO")).upper()
+    level = getattr(logging, level_name, logging.INFO)
+    if not log.handlers:
+        h = logging.StreamHandler(sys.stdout)
+        h.setFormatter(logging.Formatter("%(asctime)s.%(msecs)06d" + " " + LOG_SPEC, datefmt='%Y-%m-%dT%T'))
+        h.setLevel(level)
+        log.addHandler(h)
+    log.setLevel(level)
+
+
+def bind_socket(ip, port):
+    """Listening FastAGI socket on ip:port, to be served by an engine set up later"""
+    sock = socket.create_server((ip, port), backlog=BACKLOG)
+    log.debug("Listening on %s:%s", ip, port)
+    return sock
+
+
+def listen_socket():
+    """Listening socket passed by systemd socket activation, None if not socket activated"""
+    if os.environ.get("LISTEN_PID") != str(os.getpid()):
+        return None
+    try:
+        count = int(os.environ.get("LISTEN_FDS", "0"))
+    except ValueError:
+        count = 0
+    # not inherited by child processes
+    for name in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+        os.environ.pop(name, None)
+    if count < 1:
+        return None
+    if count > 1:
+        log.warning("systemd passed %d sockets, serving FastAGI on the first one only", count)
+    sock = socket.socket(fileno=SD_LISTEN_FDS_START)
+    sock.setblocking(True)
+    log.info("Using socket %s:%s passed by systemd", *sock.getsockname()[:2])
+    return sock
+
+
+def notify(state):
+    """Send a state like READY=1 to systemd, ignored when not running as a Type=notify service"""
+    path = os.environ.get("NOTIFY_SOCKET")
+    if not path:
+        return
+    if path.startswith("@"):
+        # abstract namespace
+        path = "\0" + path[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+            s.sendto(state.encode(), path)
+    except OSError as e:
+        log.debug("systemd notification %s failed: %s", state, e)
+
+
+def on_signals(stop, reload):
+    """Call stop on SIGTERM/SIGINT and reload on SIGHUP (see :func:`reload_in_thread`), replacing the immediate exit of main"""
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stop(signum))
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_in_thread(reload))
+
+
+def reload_in_thread(reload, *args):
+    """Run reload(*args) in a daemon thread, the signal handler runs on the thread accepting connections"""
+    threading.Thread(target=reload, args=args, name="reload", daemon=True).start()
+
+
+class ActiveSessions(object):
+    """Number of AGI sessions in progress, with a wait for all of them to finish"""
+
+    def __init__(self):
+        self.count = 0
+        self._cond = threading.Condition()
+
+    def enter(self):
+        with self._cond:
+            self.count += 1
+
+    def exit(self):
+        with self._cond:
+            self.count -= 1
+            if not self.count:
+                self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        """Wait until no session is in progress, return False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self.count, timeout)
+
+
+class Deadline(object):  # pylint:disable=too-few-public-methods
+    """Time left for the steps of a drain"""
+
+    def __init__(self, seconds):
+        self.end = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.end - time.monotonic())
+
+
+def reload_config(current):
+    """Read the config file of current again
+
+    :return: the new ConfigObj with the settings that need a restart at their current values,
+        or None if it is invalid (the error is logged)
+    """
+    try:
+        new = config.SlackAsteriskConfig(current.filename).get_configobj()
+    except Exception as e:  # pylint:disable=broad-except
+        log.error("Not reloading configuration: %s", e)
+        return None
+    for section in new:
+        if section in RELOADABLE_SECTIONS or section not in current:
+            continue
+        if section == "general":
+            changed = [k for k in new[section] if k not in RELOADABLE_GENERAL and new[section][k] != current[section].get(k)]
+        else:
+            changed = [k for k in new[section] if new[section][k] != current[section].get(k)]
+        if changed:
+            log.warning("Changes of %s in section [%s] take effect after a restart", ", ".join(changed), section)
+            # keep the running values, the next reload compares with them
+            for k in changed:
+                if k in current[section]:
+                    new[section][k] = current[section][k]
+    return new
+
+
+def reload(engine):
+    """Reload the config file on SIGHUP and apply the reloadable settings to a server engine
+
+    Reloads run one at a time, each compares the file with the configuration the previous one applied.
+
+    :param engine: agi_server.ThreadedTCPServer, aio_server.AsyncAGIServer, ami.AMIService or
+        prefork.PreforkServer, with the configuration it runs with in engine.running_config
+    """
+    with _RELOAD_LOCK:
+        _reload(engine, engine.running_config)
+
+
+def _reload(engine, current):
+    log.info("Reloading configuration from %s", current.filename)
+    notify("RELOADING=1")
+    try:
+        new = reload_config(current)
+        if new is None:
+            return
+        try:
+            new_templates = templates.create_templates(new)
+            router = routing.create_router(new)
+        except Exception as e:  # pylint:disable=broad-except
+            log.error("Not reloading configuration: %s", e)
+            return
+        engine.config = new["slack"]
+        engine.templates = new_templates
+        engine.calls.templates = new_templates
+        engine.calls.router = router
+        if hasattr(engine, "var_fetch"):
+            engine.var_fetch = new["general"]["var_fetch"]
+        if engine.dispatcher is not None:
+            engine.dispatcher.config = new["slack"]
+            engine.dispatcher.templates = new_templates
+        tracing.configure(new)
+        summary.configure(new)
+        engine.running_config = new
+        log.info("Configuration reloaded")
+    finally:
+        notify("READY=1")
+
+
+def flush(dispatcher, deadline):
+    """Send the queued Slack messages until the deadline, the last step of a drain"""
+    if dispatcher is not None:
+        left = dispatcher.stop(deadline.remaining())
+        if left:
+            log.warning("%d Slack messages not sent within the drain timeout", left)
+        else:
+            log.info("Slack dispatch queue flushed")
+    summary.SUMMARIZER.close()
@@ -4,58 +4,81 @@ import logging
 import sys
 import signal
 import os
+import threading
 
 from . import __version__
-from . import agi_server
 from . import config
+from . import lifecycle
 
 log = logging.getLogger("slack_asterisk")
 
 
-def _init_logging_from_env():
-    level_name = os.getenv("LOG_LEVEL", os.getenv("DEBUG_LEVEL", "INFO")).upper()
-    level = getattr(logging, level_name, logging.INFO)
-    if not log.handlers:
-        ch = logging.StreamHandler(sys.stdout)
-        ch.setLevel(level)
-        log.addHandler(ch)
-    log.setLevel(level)
-
-
-_init_logging_from_env()
-
-
 def _handle_stop_signal(signum, frame):  # pylint:disable=unused-argument
-    log.info("Received signal %s, stopping AGI server immediately", signum)
+    log.info("Received signal %s during startup, stopping immediately", signum)
     # Immediate stop – terminate the process
     sys.exit(0)
 
 
+def _start_http_server(c):
+    # Flask takes a while to import, the AGI server is set up meanwhile
+    from . import http_server  # pylint:disable=import-outside-toplevel
+    http_server.start_http_server(c)
+
+
 def main():
+    lifecycle.setup_logging()
     # Ensure SLACK_TOKEN is set in environment
     if not os.environ.get("SLACK_TOKEN"):
         log.error("Environment variable SLACK_TOKEN must be set before starting slack_asterisk.")
         sys.exit(1)
 
-    conf = config.SlackAsteriskConfig()
-    c = conf.get_configobj()
-
     argp = argparse.ArgumentParser()
-    argp.add_argument("-i", "--ip", help="Set bind ip", default=c["general"]["ip"])
-    argp.add_argument("-p", "--port", help="Set bind port", type=int, default=c["general"]["port"])
+    argp.add_argument("-c", "--config", help="Set config file", default="/etc/slack-asterisk.conf")
+    argp.add_argument("-i", "--ip", help="Set bind ip, default from config file")
+    argp.add_argument("-p", "--port", help="Set bind port, default from config file", type=int)
 
-    args = argp.parse_args()  # pylint: disable=W0612
+    args = argp.parse_args()
 
-    ip = args.ip
-    port = args.port
+    conf = config.SlackAsteriskConfig(args.config)
+    c = conf.get_configobj()
 
-    # Register signal handlers so external stops (SIGTERM/SIGINT) kill the server immediately
+    ip = args.ip or c["general"]["ip"]
+    port = args.port or c["general"]["port"]
+
+    # Stop immediately while starting up, the engines replace these handlers by a graceful drain (see lifecycle)
     signal.signal(signal.SIGTERM, _handle_stop_signal)
     signal.signal(signal.SIGINT, _handle_stop_signal)
 
-    log.info("slack_asterisk version %s starting AGI server on %s:%i", __version__, ip, port)
-
-    agi_server.agi_server(ip, port, c)
+    # Listen before importing and setting up the engine, Asterisk's connections wait in the backlog meanwhile.
+    # Prefork workers bind ip:port themselves (SO_REUSEPORT), a socket of the master would take a share of the connections.
+    sock = None
+    if c["general"]["engine"] != "ami" and c["general"]["processes"] == 1:
+        sock = lifecycle.listen_socket() or lifecycle.bind_socket(ip, port)
+
+    if c["general"]["engine"] == "ami":
+        log.info("slack_asterisk version %s starting AMI client for %s:%i", __version__, c["ami"]["host"], c["ami"]["port"])
+    elif c["general"]["processes"] > 1:
+        log.info("slack_asterisk version %s starting %d AGI server processes on %s:%i", __version__, c["general"]["processes"], ip, port)
+    else:
+        log.info("slack_asterisk version %s starting %s AGI server on %s:%i", __version__, c["general"]["engine"], ip, port)
+
+    if c["http"]["enabled"]:
+        threading.Thread(target=_start_http_server, args=(c,), name="http-import", daemon=True).start()
+
+    # the engine of the config only, the others are never imported
+    # pylint:disable=import-outside-toplevel
+    if c["general"]["engine"] == "ami":
+        from . import ami
+        ami.ami_server(c)
+    elif c["general"]["processes"] > 1:
+        from . import prefork
+        prefork.prefork_server(ip, port, c)
+    elif c["general"]["engine"] == "asyncio":
+        from . import aio_server
+        aio_server.aio_agi_server(ip, port, c, sock)
+    else:
+        from . import agi_server
+        agi_server.agi_server(ip, port, c, sock)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,296 @@
+# coding=utf-8
+"""Prometheus metrics.
+
+Small self-contained implementation of counters, gauges and histograms
+rendered in the Prometheus text exposition format by the ``/metrics``
+endpoint of :mod:`http_server`. Recording a value takes one uncontended
+lock and, for histograms, a bisect over the bucket bounds, so the
+instrumentation can stay enabled on the AGI hot path.
+"""
+import abc
+import bisect
+import threading
+import time
+
+# Buckets in seconds, from sub-millisecond AGI phases up to slow Slack calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _CounterValue(object):
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _HistogramValue(object):
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+class _Metric(abc.ABC):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    @abc.abstractmethod
+    def _samples(self):
+        """Lines of the samples in the text exposition format"""
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.kind)]
+        lines.extend(self._samples())
+        return lines
+
+
+class _LabelledMetric(_Metric):
+    """Metric recorded in one child per combination of label values"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    @abc.abstractmethod
+    def _new_child(self):
+        """Value of a new combination of label values"""
+
+    def labels(self, *values):
+        """Child metric for the given label values (positional, in labelnames order)"""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+
+class Counter(_LabelledMetric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            yield "%s%s %s" % (self.name, _format_labels(self.labelnames, values), _format_value(child.value))
+
+
+class Gauge(_Metric):
+    """Gauge whose value is read from a callable at scrape time
+
+    :param func: callable returning a number, or a dict label value tuple -> number
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, func, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.func = func
+
+    def _samples(self):
+        try:
+            value = self.func()
+        except Exception:  # pylint:disable=broad-except
+            return
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for values, v in items:
+            yield "%s%s %s" % (self.name, _format_labels(self.labelnames, values), _format_value(v))
+
+
+class Histogram(_LabelledMetric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            counts, total = child.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "%s_bucket%s %s" % (self.name, _format_labels(self.labelnames, values, ("le", _format_value(float(bound)))), cumulative)
+            yield "%s_sum%s %s" % (self.name, _format_labels(self.labelnames, values), _format_value(total))
+            yield "%s_count%s %s" % (self.name, _format_labels(self.labelnames, values), cumulative)
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add a metric, replacing a previously registered one of the same name"""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class CallbackCounter(Gauge):
+    """Counter read from a callable at scrape time, e.g. from the stats dict of a component"""
+    kind = "counter"
+
+
+REGISTRY = Registry()
+
+AGI_SESSIONS = REGISTRY.register(Counter("slack_asterisk_agi_sessions_total", "FastAGI sessions handled"))
+AGI_SESSION = REGISTRY.register(Histogram("slack_asterisk_agi_session_seconds", "Duration of FastAGI sessions"))
+AGI_PHASE = REGISTRY.register(Histogram("slack_asterisk_agi_phase_seconds", "Duration of the phases of FastAGI sessions (env, vars, process, and queue or slack)", ("phase",)))
+SLACK_REQUEST = REGISTRY.register(Histogram("slack_asterisk_slack_request_seconds", "Latency of Slack API requests", ("method",)))
+SLACK_ERRORS = REGISTRY.register(Counter("slack_asterisk_slack_errors_total", "Failed Slack API requests", ("method",)))
+SLACK_UPDATES_SKIPPED = REGISTRY.register(Counter("slack_asterisk_slack_updates_skipped_total", "chat.update requests skipped because the message already shows the rendered payload"))
+SUMMARIZED_CALLS = REGISTRY.register(Counter("slack_asterisk_summarized_calls_total", "Calls counted in the summary of a busy channel instead of being posted"))
+
+_active = _CounterValue()
+REGISTRY.register(Gauge("slack_asterisk_agi_sessions_active", "FastAGI sessions currently being handled", lambda: _active.value))
+REGISTRY.register(Gauge("slack_asterisk_threads", "Threads of the process (AGI handlers, dispatch workers and helpers)", threading.active_count))
+
+
+def session_started():
+    """Count a new AGI session, return its start time for :func:`observe_phase` and :func:`session_finished`"""
+    AGI_SESSIONS.inc()
+    _active.inc()
+    return time.perf_counter()
+
+
+def session_finished(started):
+    _active.inc(-1)
+    AGI_SESSION.observe(time.perf_counter() - started)
+
+
+def observe_phase(phase, started):
+    """Record the time since started for an AGI phase, return the current time as start of the next phase"""
+    now = time.perf_counter()
+    AGI_PHASE.labels(phase).observe(now - started)
+    return now
+
+
+def _stats(stats, keys):
+    return lambda: {(k,): stats[k] for k in keys}
+
+
+def watch(call_store=None, dispatcher=None, slack_client=None, phonebook=None, transport=None):
+    """Register gauges and counters reading the state of the running server components"""
+    if call_store is not None:
+        REGISTRY.register(Gauge("slack_asterisk_calls_in_flight", "Calls in progress in the call store", lambda: len(call_store)))
+        REGISTRY.register(CallbackCounter("slack_asterisk_calls_total", "Calls created, finished and evicted by the call store", _stats(call_store.stats, ("created", "finished", "evicted_ttl", "evicted_size")), ("event",)))
+    if dispatcher is not None:
+        REGISTRY.register(Gauge("slack_asterisk_dispatch_queue_depth", "Slack messages waiting in the dispatch queue", dispatcher.depth))
+        REGISTRY.register(CallbackCounter("slack_asterisk_dispatch_events_total", "Slack messages submitted, sent, failed, dropped and coalesced by the dispatcher", _stats(dispatcher.stats, ("submitted", "sent", "failed", "dropped", "coalesced")), ("result",)))
+        REGISTRY.register(CallbackCounter("slack_asterisk_dispatch_wait_seconds_total", "Time Slack messages waited in the dispatch queue", lambda: dispatcher.stats["wait_seconds_sum"]))
+    stats = getattr(slack_client, "stats", None)
+    if stats is not None and "ratelimited" in stats:
+        REGISTRY.register(CallbackCounter("slack_asterisk_slack_ratelimited_total", "Slack API requests answered with HTTP 429", lambda: stats["ratelimited"]))
+        REGISTRY.register(CallbackCounter("slack_asterisk_slack_throttled_seconds_total", "Time spent waiting for the Slack rate limit buckets", lambda: stats["throttled_seconds"]))
+    if transport is not None:
+        REGISTRY.register(Gauge("slack_asterisk_slack_connections_open", "Open keep-alive connections to the Slack API", lambda: transport.stats["open"]))
+        REGISTRY.register(CallbackCounter("slack_asterisk_slack_transport_total", "Slack HTTP requests, requests on reused connections, new connections, TLS handshakes, retries on a new connection, idle connections closed and errors",
+                                          _stats(transport.stats, ("requests", "reused", "connects", "tls_handshakes", "retries", "closed_idle", "errors")), ("event",)))
+    if phonebook is not None:
+        REGISTRY.register(Gauge("slack_asterisk_phonebook_entries", "Numbers and prefixes in the phone book", lambda: len(phonebook)))
+        REGISTRY.register(CallbackCounter("slack_asterisk_phonebook_cache_total", "Phone book lookups answered by the LRU cache (hit) or the index (miss)", lambda: dict(zip((("hit",), ("miss",)), phonebook.cache_stats())), ("result",)))
+        REGISTRY.register(CallbackCounter("slack_asterisk_phonebook_reloads_total", "Phone book reloads after the file changed", _stats(phonebook.stats, ("reloads", "reload_errors")), ("result",)))
+
+
+class InstrumentedClient(object):
+    """Records latency and errors of the Slack API calls made through a WebClient"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    @staticmethod
+    def _call(method, func, kwargs):
+        started = time.perf_counter()
+        try:
+            ret = func(**kwargs)
+        except Exception:
+            SLACK_ERRORS.labels(method).inc()
+            raise
+        finally:
+            SLACK_REQUEST.labels(method).observe(time.perf_counter() - started)
+        if ret["ok"] is not True:
+            SLACK_ERRORS.labels(method).inc()
+        return ret
+
+    def chat_postMessage(self, **kwargs):  # noqa: N802
+        return self._call("chat.postMessage", self.client.chat_postMessage, kwargs)
+
+    def chat_update(self, **kwargs):
+        return self._call("chat.update", self.client.chat_update, kwargs)
+
+
+async def observe_request(method, coro):
+    """Await a Slack API request of the async client, recording latency and errors like :class:`InstrumentedClient`"""
+    started = time.perf_counter()
+    try:
+        ret = await coro
+    except Exception:
+        SLACK_ERRORS.labels(method).inc()
+        raise
+    finally:
+        SLACK_REQUEST.labels(method).observe(time.perf_counter() - started)
+    if ret["ok"] is not True:
+        SLACK_ERRORS.labels(method).inc()
+    return ret
@@ -0,0 +1,299 @@
+# coding=utf-8
+"""Caller-ID enrichment from a phone book file.
+
+Calls without a caller name (or with an anonymous one) get the name of
+their number from the phone book configured in ``[phonebook]``. Supported
+files are CSV exports (the first field that is not a number is the name,
+all number fields are its numbers, rows without a number such as headers are
+skipped) and vCard files (FN, else ORG, with all TEL properties).
+
+Numbers are normalized to digits, a leading ``+`` becomes ``00``. Entries
+ending in ``*`` are prefixes, e.g. ``0301234*`` for the extensions behind a
+company switchboard or ``0049*`` for a country; the longest matching prefix
+is used if there is no exact entry.
+
+The entries are kept in sorted arrays of integer keys with the names in
+one string, a few ten bytes per entry, and found by binary search. Recent
+numbers are served from an LRU cache. The file is loaded in the background
+at startup, callers are not named until it is loaded. It is checked for
+changes every ``reload_interval`` seconds and reloaded in the background,
+lookups use the previous index until the new one is complete.
+"""
+import array
+import bisect
+import csv
+import functools
+import itertools
+import logging
+import os
+import re
+import threading
+import time
+
+log = logging.getLogger("slack_asterisk")
+
+FORMATS = ("auto", "csv", "vcard")
+
+# digits of a key; keys are int("1" + digits) so leading zeros are kept and fit into 64 bits
+MAX_DIGITS = 18
+
+_RE_SEPARATORS = re.compile(r"[\s\-()/.]+")
+# a CSV field holding a phone number (or prefix)
+_RE_NUMBER = re.compile(r"\s*\+?[0-9][0-9\s\-()/.]*\*?\s*$")
+
+
+def normalize(number):
+    """Digits of a phone number with + replaced by 00, None if it is not a number"""
+    if not (number.isdigit() and number.isascii()):
+        number = _RE_SEPARATORS.sub("", number)
+        if number.startswith("+"):
+            number = "00" + number[1:]
+        if not (number.isdigit() and number.isascii()):
+            return None
+    if len(number) > MAX_DIGITS:
+        return None
+    return number
+
+
+class _Table(object):
+    """Sorted integer keys with their names"""
+    __slots__ = ("keys", "offsets", "names")
+
+    def __init__(self, entries):
+        """:param entries: dict digits -> name"""
+        items = sorted((int("1" + digits), name) for digits, name in entries.items())
+        self.keys = array.array("Q", [key for key, _ in items])
+        self.offsets = array.array("L", itertools.accumulate((len(name) for _, name in items), initial=0))
+        self.names = "".join(name for _, name in items)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, digits):
+        key = int("1" + digits)
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.names[self.offsets[i]:self.offsets[i + 1]]
+        return None
+
+
+class PhonebookIndex(object):
+    """Exact and longest-prefix lookup of names by phone number
+
+    :param entries: iterable of (number, name); numbers ending in * are prefixes
+    """
+
+    def __init__(self, entries):
+        exact = {}
+        prefixes = {}
+        for number, name in entries:
+            name = name.strip()
+            if not name:
+                continue
+            number = number.strip()
+            table = exact
+            if number.endswith("*"):
+                table = prefixes
+                number = number[:-1]
+            digits = normalize(number)
+            # the first entry of a number wins, like in most phone book exports
+            if digits is not None and digits not in table:
+                table[digits] = name
+        self.exact = _Table(exact)
+        self.prefixes = _Table(prefixes)
+        # only prefix lengths that exist are tried, longest first
+        self.prefix_lengths = sorted({len(digits) for digits in prefixes}, reverse=True)
+
+    def __len__(self):
+        return len(self.exact) + len(self.prefixes)
+
+    def lookup(self, number):
+        """Name for a number or None"""
+        digits = normalize(number)
+        if digits is None:
+            return None
+        name = self.exact.get(digits)
+        if name is not None:
+            return name
+        for length in self.prefix_lengths:
+            if length <= len(digits):
+                name = self.prefixes.get(digits[:length])
+                if name is not None:
+                    return name
+        return None
+
+
+def read_csv(f):
+    """Yield (number, name) of a CSV phone book"""
+    sample = f.read(65536)
+    f.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t|")
+    except csv.Error:
+        dialect = csv.excel
+    for row in csv.reader(f, dialect):
+        numbers = []
+        name = None
+        for field in row:
+            if _RE_NUMBER.match(field):
+                numbers.append(field)
+            elif name is None and field.strip():
+                name = field
+        if name is not None:
+            for number in numbers:
+                yield number, name
+
+
+def read_vcard(f):
+    """Yield (number, name) of a vCard file"""
+    def properties():
+        prop = None
+        for line in f:
+            line = line.rstrip("\r\n")
+            if line[:1] in (" ", "\t") and prop is not None:
+                # folded line
+                prop += line[1:]
+                continue
+            if prop is not None:
+                yield prop
+            prop = line
+        if prop is not None:
+            yield prop
+
+    name = org = None
+    numbers = []
+    for prop in properties():
+        head, _, value = prop.partition(":")
+        key = head.split(";", 1)[0].upper().rpartition(".")[2]
+        if key == "BEGIN":
+            name = org = None
+            numbers = []
+        elif key == "FN":
+            name = value.replace("\\,", ",")
+        elif key == "ORG":
+            org = value.split(";", 1)[0].replace("\\,", ",")
+        elif key == "TEL":
+            numbers.append(value[4:] if value.lower().startswith("tel:") else value)
+        elif key == "END":
+            for number in numbers:
+                if name or org:
+                    yield number, name or org
+
+
+def read_phonebook(path, fmt="auto"):
+    """Read a phone book file into a PhonebookIndex"""
+    if fmt == "auto":
+        fmt = "vcard" if os.path.splitext(path)[1].lower() in (".vcf", ".vcard") else "csv"
+    with open(path, encoding="utf-8-sig", errors="replace", newline="") as f:
+        return PhonebookIndex(read_vcard(f) if fmt == "vcard" else read_csv(f))
+
+
+class Phonebook(object):
+    """Phone book file with LRU cached lookups and reload on change
+
+    :param path: CSV or vCard file
+    :param fmt: one of :data:`FORMATS`
+    :param cache_size: numbers kept in the LRU cache, 0 disables the cache
+    :param load: load the file now, else :meth:`start_reloader` loads it
+    """
+
+    def __init__(self, path, fmt="auto", cache_size=10000, load=True):
+        self.path = path
+        self.format = fmt
+        self.cache_size = cache_size
+        self.stats = dict(reloads=0, reload_errors=0)
+        self.index = None
+        self._lookup = None
+        self._cache_base = (0, 0)
+        self._signature = None
+        self._stop = threading.Event()
+        self._reloader = None
+        if load:
+            self.load()
+
+    def __len__(self):
+        return len(self.index) if self.index is not None else 0
+
+    def _file_signature(self):
+        st = os.stat(self.path)
+        return st.st_mtime_ns, st.st_size
+
+    def load(self):
+        """(Re)load the phone book file, the current index is kept on errors"""
+        signature = self._file_signature()
+        started = time.monotonic()
+        index = read_phonebook(self.path, self.format)
+        lookup = index.lookup
+        if self.cache_size:
+            lookup = functools.lru_cache(maxsize=self.cache_size)(lookup)
+        self._count_cache()
+        # a single attribute swap, lookups in progress finish on the previous index
+        self.index, self._lookup = index, lookup
+        self._signature = signature
+        log.info("Loaded %d phone book entries from %s in %.2fs", len(index), self.path, time.monotonic() - started)
+
+    def _count_cache(self):
+        info = self._cache_info()
+        if info is not None:
+            self._cache_base = (self._cache_base[0] + info.hits, self._cache_base[1] + info.misses)
+
+    def _cache_info(self):
+        return getattr(self._lookup, "cache_info", lambda: None)()
+
+    def cache_stats(self):
+        """(hits, misses) of the LRU cache since start"""
+        info = self._cache_info()
+        if info is None:
+            return self._cache_base
+        return self._cache_base[0] + info.hits, self._cache_base[1] + info.misses
+
+    def lookup(self, number):
+        """Name for a caller number or None"""
+        lookup = self._lookup
+        if not number or lookup is None:
+            return None
+        return lookup(number)
+
+    def reload_if_changed(self):
+        try:
+            if self._file_signature() == self._signature:
+                return False
+            self.load()
+        except Exception as e:
+            self.stats["reload_errors"] += 1
+            log.error("Reloading phone book %s failed, keeping %d entries: %s", self.path, len(self), e)
+            return False
+        self.stats["reloads"] += 1
+        return True
+
+    def start_reloader(self, interval=60):
+        """Load the file if not loaded yet, then call :meth:`reload_if_changed` every interval seconds (0: never) in a daemon thread"""
+        def run():
+            if self.index is None:
+                try:
+                    self.load()
+                except Exception as e:
+                    # retried by reload_if_changed
+                    log.error("Loading phone book %s failed, callers are not named: %s", self.path, e)
+            while interval and not self._stop.wait(interval):
+                self.reload_if_changed()
+        self._reloader = threading.Thread(target=run, name="phonebook-reloader", daemon=True)
+        self._reloader.start()
+
+    def close(self):
+        self._stop.set()
+
+
+def create_phonebook(config):
+    """Phonebook from the [phonebook] section loading in the background, None if no file is configured"""
+    pc = config["phonebook"]
+    if not pc["path"]:
+        return None
+    phonebook = Phonebook(pc["path"], pc["format"], pc["cache_size"], load=False)
+    try:
+        # a missing file still stops the startup, reading a large one does not delay serving
+        phonebook._file_signature()  # pylint:disable=protected-access
+    except OSError as e:
+        raise RuntimeError("Failed to load phone book %s: %s" % (pc["path"], e)) from e
+    phonebook.start_reloader(pc["reload_interval"])
+    return phonebook
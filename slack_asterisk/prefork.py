@@ -0,0 +1,443 @@
+# coding=utf-8
+"""Prefork mode: several worker processes serving FastAGI on the same port.
+
+With ``[general] processes`` above 1 the threaded engine runs in that many
+worker processes, each binding ``ip:port`` with SO_REUSEPORT, so the kernel
+spreads the AGI connections over them and reading sessions, the call state
+machine and the AGI replies use more than one CPU core.
+
+The sessions of one call (the new call, the dial macro with ARG1, the h
+extension) may be accepted by different workers. The call state is
+therefore kept in the SQLite database at ``[store] path``, read and written
+by all workers (:class:`sqlite_store.SharedSQLiteCallStore`), and the
+sessions of a call are serialized across the processes
+(:class:`sequencer.ProcessKeyedLock`).
+
+With socket activation, the workers accept on the socket passed by systemd
+instead.
+
+The workers don't call Slack. They pass their CallEvents through a pipe to
+the master process, which sends them with its dispatch workers, so the
+Slack rate limits hold for all workers together. The master also expires
+stale calls, serves HTTP (/metrics shows the Slack side only) and restarts
+workers that died. Events of one call passed by different workers may
+arrive out of order: the master orders them by the version of the call
+state, drops updates superseded by a newer one and holds back updates
+that arrive before the post of their call.
+"""
+import collections
+import dataclasses
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+
+from . import agi_server
+from . import call_store
+from . import calls
+from . import capture
+from . import config as slack_asterisk_config
+from . import dispatch
+from . import history
+from . import lifecycle
+from . import metrics
+from . import phonebook
+from . import ratelimit
+from . import routing
+from . import sequencer
+from . import sqlite_store
+from . import summary
+from . import templates
+from . import tracing
+from . import transport
+
+log = logging.getLogger("slack_asterisk")
+
+# seconds an update waits for the post of its call before it is dropped
+PARK_TIMEOUT = 30.0
+# seconds the master waits for all workers to listen before reporting READY anyway
+START_TIMEOUT = 30.0
+# message of a worker listening on the FastAGI port
+WORKER_READY = "ready"
+
+# fields of the call state taken from the events of the workers, the Slack messages posted and sent are known to the master
+_COPIED = tuple(f.name for f in dataclasses.fields(call_store.CallState) if f.name not in ("ts", "channel", "messages", "summary", "digests", "expires"))
+
+
+def create_shared_store(config, on_expire=None):
+    """SharedSQLiteCallStore at [store] path, without reaper
+
+    :param on_expire: callable(CallState) for the calls expired by the master, whether or not stale_update is enabled
+    """
+    sc = config["store"]
+    return sqlite_store.SharedSQLiteCallStore(sc["path"], max_size=sc["max_calls"], ttl=sc["ttl"], on_expire=on_expire)
+
+
+def create_sequencer(config):
+    """ProcessKeyedLock next to the shared call store"""
+    return sequencer.ProcessKeyedLock(config["store"]["path"] + ".lock")
+
+
+class EventOutbox(object):
+    """Dispatcher of a worker process, passing its CallEvents to the master process
+
+    :param conn: write end of the pipe to the master
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._lock = threading.Lock()
+        self.stats = dict(submitted=0, failed=0)
+
+    def submit(self, event):
+        """Pass a CallEvent to the master, return False if the pipe is broken"""
+        with self._lock:
+            try:
+                self.conn.send(event)
+            except (OSError, ValueError) as e:
+                self.stats["failed"] += 1
+                log.error("Passing the Slack message for call %s to the master process failed with message %s", event.call_key, e)
+                return False
+            self.stats["submitted"] += 1
+        return True
+
+    def depth(self):
+        return 0
+
+    def stop(self, timeout=None):  # pylint:disable=unused-argument
+        """Close the pipe, the master sends what it received"""
+        with self._lock:
+            self.conn.close()
+        return 0
+
+
+class EventCollector(object):
+    """Orders the CallEvents passed by the workers per call and submits them to the dispatcher
+
+    The dispatcher renders and records the posted messages in one CallState
+    per call kept here; the state of later events is copied into it. Calls
+    are remembered after their final event, so a late update is still
+    recognized as superseded.
+
+    :param dispatcher: dispatch.SlackDispatcher of the master
+    :param max_calls: calls remembered, the least recently active are forgotten beyond
+    """
+
+    def __init__(self, dispatcher, max_calls=10000):
+        self.dispatcher = dispatcher
+        self.max_calls = max_calls
+        # call_key -> CallState
+        self._calls = collections.OrderedDict()
+        # call_key -> (CallEvent, monotonic time) of the newest update waiting for the post of its call
+        self._parked = {}
+        self._last_purge = time.monotonic()
+        # held while submitting, so the dispatcher queues the events of a call in the order decided here
+        self._lock = threading.Lock()
+        self.stats = dict(received=0, superseded=0, parked=0, expired=0)
+
+    def __len__(self):
+        return len(self._calls)
+
+    def submit(self, event):
+        with self._lock:
+            self.stats["received"] += 1
+            for ready in self._order(event):
+                self.dispatcher.submit(ready)
+            if self._parked and time.monotonic() - self._last_purge > 1.0:
+                self._purge()
+
+    def stale(self, event):
+        """Submit the stale update of a call expired from the call store"""
+        with self._lock:
+            self._parked.pop(event.call_key, None)
+            state = self._calls.get(event.call_key)
+            if state is not None:
+                self._copy(event, state)
+            self.dispatcher.submit(event)
+
+    def expired(self, msg_data):
+        """Count a call expired from the call store as finished, its Slack messages stay as they are"""
+        with self._lock:
+            self._parked.pop(msg_data.uniqueid, None)
+            state = self._calls.get(msg_data.uniqueid)
+            if state is not None:
+                # the summarized channels are known to the master only
+                for name in _COPIED:
+                    setattr(state, name, getattr(msg_data, name))
+                msg_data = state
+        dispatch.finished(msg_data.uniqueid, msg_data)
+
+    def _remember(self, key, state):
+        self._calls[key] = state
+        self._calls.move_to_end(key)
+        while len(self._calls) > self.max_calls:
+            self._calls.popitem(last=False)
+
+    @staticmethod
+    def _copy(event, state):
+        for name in _COPIED:
+            setattr(state, name, getattr(event.msg_data, name))
+        event.msg_data = state
+
+    def _order(self, event):
+        """CallEvents to submit now for an event received from a worker"""
+        key = event.call_key
+        state = self._calls.get(key)
+        if event.new_call:
+            self._remember(key, event.msg_data)
+            ready = [event]
+            parked = self._parked.pop(key, None)
+            if parked is not None:
+                ready += self._update(event.msg_data, parked[0])
+            return ready
+        if state is None:
+            if not dispatch.messages(event.msg_data):
+                # the post of the call is still on its way from another worker
+                held = self._parked.get(key)
+                if held is not None and held[0].msg_data.version >= event.msg_data.version:
+                    self.stats["superseded"] += 1
+                    return []
+                self._parked[key] = (event, time.monotonic())
+                self.stats["parked"] += 1
+                return []
+            # posted before the master started
+            self._remember(key, event.msg_data)
+            return [event]
+        return self._update(state, event)
+
+    def _update(self, state, event):
+        if event.msg_data.version <= state.version:
+            self.stats["superseded"] += 1
+            return []
+        self._copy(event, state)
+        self._calls.move_to_end(event.call_key)
+        return [event]
+
+    def _purge(self):
+        now = self._last_purge = time.monotonic()
+        for key, (_, parked) in list(self._parked.items()):
+            if now - parked > PARK_TIMEOUT:
+                del self._parked[key]
+                self.stats["expired"] += 1
+                log.warning("No Slack message posted for call %s within %.0fs, dropping its update", key, PARK_TIMEOUT)
+
+
+def worker_main(index, ip, port, config_file, conn, sock=None):  # pylint:disable=too-many-arguments
+    """Entry point of a worker process: serve FastAGI on ip:port until SIGTERM
+
+    :param index: number of the worker, appended to the capture file
+    :param config_file: configuration file of the master
+    :param conn: write end of the pipe to the master
+    :param sock: listening socket passed by systemd to the master, shared by all workers, or None to bind ip:port
+    """
+    lifecycle.setup_logging()
+    # the master reports to systemd
+    os.environ.pop("NOTIFY_SOCKET", None)
+    config = slack_asterisk_config.SlackAsteriskConfig(config_file).get_configobj()
+    server = agi_server.ThreadedTCPServer((ip, port), agi_server.SlackAsterisk, bind_and_activate=False)
+    if sock is not None:
+        server.socket.close()
+        server.socket = sock
+        server.server_address = sock.getsockname()
+    else:
+        server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server.server_bind()
+        server.server_activate()
+    server.running_config = config
+    server.config = config["slack"]
+    server.var_fetch = config["general"]["var_fetch"]
+    if config["capture"]["enabled"]:
+        server.capture = capture.CaptureLog("%s.%d" % (config["capture"]["path"], index))
+    server.templates = templates.create_templates(config)
+    server.phonebook = phonebook.create_phonebook(config)
+    server.call_store = create_shared_store(config)
+    server.sequencer = create_sequencer(config)
+    server.calls = calls.CallStateMachine(server.call_store, server.templates, routing.create_router(config), server.phonebook)
+    server.dispatcher = EventOutbox(conn)
+
+    def stop(signum):
+        log.debug("Worker %d received signal %s, draining", index, signum)
+        threading.Thread(target=server.shutdown, name="shutdown", daemon=True).start()
+
+    lifecycle.on_signals(stop, lambda: lifecycle.reload(server))
+    try:
+        conn.send(WORKER_READY)
+        server.serve_forever()
+        server.drain(config["general"]["drain_timeout"])
+    finally:
+        server.call_store.close()
+        if server.capture is not None:
+            server.capture.close()
+        if server.phonebook is not None:
+            server.phonebook.close()
+
+
+class PreforkServer(object):  # pylint:disable=too-many-instance-attributes
+    """Master process: starts and supervises the workers and sends their Slack messages
+
+    :param ip: FastAGI address bound by every worker
+    :param port: FastAGI port bound by every worker
+    :param config: full configuration (ConfigObj)
+    """
+
+    def __init__(self, ip, port, config):
+        self.ip = ip
+        self.port = port
+        self.startup_config = config
+        # changed by reloads
+        self.running_config = config
+        client = transport.create_client(config, os.environ["SLACK_TOKEN"])
+        self.slack_client = ratelimit.create_client(metrics.InstrumentedClient(client), config)
+        transport.warm_up(client, config)
+        self.config = config["slack"]
+        self.templates = templates.create_templates(config)
+        self.call_store = create_shared_store(config, self.send_stale)
+        self.sequencer = create_sequencer(config)
+        self.calls = calls.CallStateMachine(self.call_store, self.templates, routing.create_router(config))
+        self._posted = queue.Queue()
+        self._recorder = threading.Thread(target=self._record_posted, name="prefork-record-posted", daemon=True)
+        self._recorder.start()
+        self.dispatcher = dispatch.create_dispatcher(self.slack_client, config, on_posted=self.posted, templates=self.templates)
+        self.collector = EventCollector(self.dispatcher, config["store"]["max_calls"])
+        tracing.configure(config)
+        history.configure(config)
+        summary.configure(config, self.slack_client)
+        metrics.watch(self.call_store, self.dispatcher, self.slack_client, None, getattr(client, "pool", None))
+        # a fresh interpreter per worker, forking would copy the threads of the dispatcher and the HTTP server
+        self.context = multiprocessing.get_context("spawn")
+        self.socket = lifecycle.listen_socket()
+        self.workers = {}
+        self._receivers = []
+        self._ready = threading.Semaphore(0)
+        self._stopping = threading.Event()
+
+    def send_stale(self, msg_data):
+        """Expiry handler of the call store: mark the Slack message of an abandoned call if stale_update is enabled"""
+        if self.startup_config["store"]["stale_update"]:
+            self.collector.stale(self.calls.stale_event(msg_data))
+        else:
+            self.collector.expired(msg_data)
+
+    def posted(self, event):
+        """Queue the Slack messages posted for a new call to be recorded in the shared call store
+
+        A dispatch worker must not wait for the lock of the call: a worker
+        process holding it may be waiting for the master to read its pipe.
+        """
+        self._posted.put((event.call_key, event.msg_data.ts, event.msg_data.channel, event.msg_data.messages))
+
+    def _record_posted(self):
+        while True:
+            item = self._posted.get()
+            if item is None:
+                return
+            key, ts, channel, messages = item
+            try:
+                with self.sequencer.hold(key):
+                    state = self.call_store.get(key)
+                    if state is None:
+                        # finished meanwhile
+                        continue
+                    state.ts, state.channel, state.messages = ts, channel, messages
+                    self.call_store.save(state)
+            except Exception as e:
+                log.exception("Recording the Slack message of call %s failed with message %s", key, e)
+
+    def _start_worker(self, index):
+        reader, writer = self.context.Pipe(duplex=False)
+        proc = self.context.Process(target=worker_main, args=(index, self.ip, self.port, self.startup_config.filename, writer, self.socket), name="slack-asterisk-worker-%d" % index)
+        proc.start()
+        writer.close()
+        self.workers[index] = proc
+        t = threading.Thread(target=self._receive, args=(index, reader), name="prefork-receive-%d" % index, daemon=True)
+        t.start()
+        self._receivers.append(t)
+        log.debug("Started worker %d (pid %d)", index, proc.pid)
+
+    def _receive(self, index, conn):
+        """Submit the CallEvents of a worker until it closes its pipe"""
+        while True:
+            try:
+                event = conn.recv()
+            except (EOFError, OSError):
+                break
+            if event == WORKER_READY:
+                self._ready.release()
+                continue
+            try:
+                self.collector.submit(event)
+            except Exception as e:
+                log.exception("Dispatching the Slack message for call %s of worker %d failed with message %s", event.call_key, index, e)
+        conn.close()
+
+    def stop(self, signum):
+        log.info("Received signal %s, draining within %.1fs", signum, self.startup_config["general"]["drain_timeout"])
+        self._stopping.set()
+
+    def reload(self):
+        for proc in self.workers.values():
+            if proc.pid is not None:
+                os.kill(proc.pid, signal.SIGHUP)
+        lifecycle.reload(self)
+
+    def run(self):
+        """Start the workers, restart them if they die and drain on SIGTERM"""
+        lifecycle.on_signals(self.stop, self.reload)
+        processes = self.startup_config["general"]["processes"]
+        for index in range(processes):
+            self._start_worker(index)
+        deadline = lifecycle.Deadline(START_TIMEOUT)
+        for _ in range(processes):
+            if not self._ready.acquire(timeout=deadline.remaining()):
+                log.warning("Not all workers listen on %s:%d after %.0fs", self.ip, self.port, START_TIMEOUT)
+                break
+        self.call_store.start_reaper(self.startup_config["store"]["reap_interval"])
+        log.info("Serving FastAGI on %s:%d with %d worker processes", self.ip, self.port, processes)
+        lifecycle.notify("READY=1")
+        while not self._stopping.wait(1.0):
+            for index, proc in list(self.workers.items()):
+                if not proc.is_alive() and not self._stopping.is_set():
+                    log.error("Worker %d (pid %d) exited with status %s, restarting it", index, proc.pid, proc.exitcode)
+                    self._start_worker(index)
+        self.drain(self.startup_config["general"]["drain_timeout"])
+
+    def drain(self, timeout):
+        """Let the workers finish their sessions, then flush the dispatch queue within timeout seconds"""
+        deadline = lifecycle.Deadline(timeout)
+        lifecycle.notify("STOPPING=1")
+        for proc in self.workers.values():
+            proc.terminate()
+        for index, proc in self.workers.items():
+            proc.join(deadline.remaining())
+            if proc.is_alive():
+                log.warning("Worker %d still running after the drain timeout, killing it", index)
+                proc.kill()
+        for t in self._receivers:
+            t.join(deadline.remaining())
+        lifecycle.flush(self.dispatcher, deadline)
+        self._posted.put(None)
+        self._recorder.join(deadline.remaining())
+
+
+def prefork_server(ip, port, config):
+    # SECURITY NOTE: as agi_server, the FastAGI port has no authentication, keep it bound to a trusted address.
+    lifecycle.setup_logging()
+    if config["general"]["engine"] != "threaded":
+        log.error("processes > 1 requires engine = threaded, not %s", config["general"]["engine"])
+        sys.exit(1)
+    if config["dispatch"]["workers"] == 0:
+        log.error("processes > 1 requires [dispatch] workers > 0, the master process sends all Slack messages")
+        sys.exit(1)
+    server = PreforkServer(ip, port, config)
+    try:
+        server.run()
+    except Exception as e:
+        log.exception("Unknown Exception %s occurred", e)
+        sys.exit(1)
+    finally:
+        server.call_store.close()
@@ -0,0 +1,159 @@
+# coding=utf-8
+"""On-demand sampling profiler of the running process.
+
+With ``[profiler] enabled = true`` the HTTP server profiles the process at
+``/profile?seconds=10&rate=100`` (loopback clients only). For the given
+number of seconds the stacks of all threads are taken from
+``sys._current_frames()`` ``rate`` times per second, and returned as
+collapsed stacks, one ``thread;outer frame;...;inner frame count`` line per
+distinct stack, ready for ``flamegraph.pl`` or speedscope.
+
+mode=cpu (default)
+    only threads that used CPU time since the previous sample are counted
+    (``pthread_getcpuclockid``, Linux), so AGI handler threads waiting for
+    Asterisk or Slack do not hide the ones burning CPU
+mode=wall
+    all threads are counted in every sample
+
+``thread=name`` restricts the profile to threads whose name contains
+``name``, e.g. ``process_request`` for the AGI handler threads of the
+threaded engine. Thread names are shown without their number, so the
+handler threads are merged into one tree.
+
+The overhead is bounded: duration and rate are capped by ``max_duration``
+and ``max_rate``, only one profile runs at a time, and the sampler backs
+off when taking samples costs more than :data:`MAX_OVERHEAD` of the time
+of one CPU core. Nothing runs outside of a profile request.
+"""
+import collections
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+log = logging.getLogger("slack_asterisk")
+
+# fraction of one CPU core the sampler may use, the interval is stretched beyond
+MAX_OVERHEAD = 0.05
+# frames kept per stack, the innermost ones
+MAX_DEPTH = 64
+MODES = ("cpu", "wall")
+
+_THREAD_NUMBER = re.compile(r"-\d+")
+
+
+def _frame_name(code, names={}):  # pylint:disable=dangerous-default-value
+    """function (file:line) of a code object, cached per code object"""
+    name = names.get(code)
+    if name is None:
+        name = names[code] = "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+    return name
+
+
+def _cpu_time(ident):
+    """CPU seconds used by a thread, None if not available on this platform"""
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+
+class Profiler(object):
+    """Sampler of the stacks of all threads, one profile at a time
+
+    :param max_duration: seconds a profile may take at most
+    :param max_rate: samples per second at most
+    """
+
+    def __init__(self, max_duration=0.0, max_rate=100):
+        self._lock = threading.Lock()
+        self.stats = dict(profiles=0, samples=0)
+        self.configure(max_duration, max_rate)
+
+    def configure(self, max_duration, max_rate):
+        self.max_duration = max_duration
+        self.max_rate = max_rate
+
+    @property
+    def enabled(self):
+        return self.max_duration > 0
+
+    def profile(self, seconds, rate, mode="cpu", thread=None):
+        """Sample the threads of the process, return (collapsed stacks, info dict), None if a profile is running
+
+        :param seconds: duration, capped by max_duration
+        :param rate: samples per second, capped by max_rate
+        :param thread: substring of the names of the threads sampled, all if None
+        """
+        if mode not in MODES:
+            raise ValueError("unknown profile mode %s, use one of %s" % (mode, ", ".join(MODES)))
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            seconds = min(max(seconds, 0.1), self.max_duration)
+            rate = min(max(rate, 1), self.max_rate)
+            log.info("Profiling %s for %.1fs at %d samples per second (%s time)", "threads matching " + thread if thread else "all threads", seconds, rate, mode)
+            stacks, info = self._sample(seconds, rate, mode == "cpu", thread)
+            self.stats["profiles"] += 1
+            self.stats["samples"] += info["samples"]
+        finally:
+            self._lock.release()
+        lines = ["%s %d" % (stack, count) for stack, count in stacks.most_common()]
+        return "\n".join(lines) + "\n" if lines else "", info
+
+    def _sample(self, seconds, rate, cpu, thread):  # pylint:disable=too-many-locals
+        own = threading.get_ident()
+        interval = 1.0 / rate
+        stacks = collections.Counter()
+        cpu_times = {}
+        samples = 0
+        busy = 0.0
+        started = time.perf_counter()
+        deadline = started + seconds
+        now = started
+        while now < deadline:
+            names = {t.ident: _THREAD_NUMBER.sub("", t.name) for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():  # pylint:disable=protected-access
+                name = names.get(ident, "unknown")
+                if ident == own or thread and thread not in name:
+                    continue
+                if cpu:
+                    used = _cpu_time(ident)
+                    last = cpu_times.get(ident)
+                    cpu_times[ident] = used
+                    # the first sample of a thread only sets its baseline
+                    if used is not None and (last is None or used <= last):
+                        continue
+                frames = []
+                while frame is not None and len(frames) < MAX_DEPTH:
+                    frames.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                frames.append(name)
+                frames.reverse()
+                stacks[";".join(frames)] += 1
+            samples += 1
+            taken = time.perf_counter() - now
+            busy += taken
+            # stretch the interval so sampling takes at most MAX_OVERHEAD of a core
+            time.sleep(max(interval - taken, taken / MAX_OVERHEAD - taken, 0.0))
+            now = time.perf_counter()
+        elapsed = now - started
+        info = dict(seconds=round(elapsed, 3), samples=samples, rate=round(samples / elapsed, 1), overhead=round(busy / elapsed, 4))
+        return stacks, info
+
+
+# used by the HTTP server, disabled until configured
+PROFILER = Profiler()
+
+
+def configure(config):
+    """Set up PROFILER from the [profiler] section"""
+    pc = config["profiler"]
+    if not pc["enabled"]:
+        PROFILER.configure(0.0, pc["max_rate"])
+        return PROFILER
+    PROFILER.configure(pc["max_duration"], pc["max_rate"])
+    log.info("Profiler enabled at /profile for loopback clients, up to %.0fs at %d samples per second", pc["max_duration"], pc["max_rate"])
+    return PROFILER
@@ -0,0 +1,180 @@
+# coding=utf-8
+"""Slack rate limiting.
+
+:class:`RateLimitedClient` sits in front of the ``WebClient`` and paces
+``chat_postMessage`` / ``chat_update`` calls with token buckets per API
+method and per channel. A HTTP 429 answer pauses the method bucket for the
+``Retry-After`` interval announced by Slack, then the call is retried.
+:class:`AsyncRateLimitedClient` does the same for the ``AsyncWebClient`` of
+the asyncio engine without dispatch workers.
+"""
+import asyncio
+import logging
+import threading
+import time
+
+log = logging.getLogger("slack_asterisk")
+
+POST = "chat.postMessage"
+UPDATE = "chat.update"
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket
+
+    :param rate: tokens added per second
+    :param burst: bucket capacity
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = float(burst)
+        self._stamp = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, return the seconds to wait before it may be used"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= 1.0
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(delay, self._paused_until - now)
+
+    def pause(self, seconds):
+        """Hand out no tokens for the given number of seconds"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def retry_after(exc):
+    """Return the Retry-After seconds if exc is a Slack rate limit error, else None"""
+    response = getattr(exc, "response", None)
+    if response is None or getattr(response, "status_code", None) != 429:
+        return None
+    try:
+        return float(response.headers.get("Retry-After", 1))
+    except (AttributeError, TypeError, ValueError):
+        return 1.0
+
+
+class RateLimitedClient(object):  # pylint:disable=too-many-instance-attributes
+    """Paces Slack API calls of a WebClient, other attributes are passed through
+
+    :param client: slack_sdk WebClient
+    :param method_limits: dict method -> (rate, burst)
+    :param channel_limit: (rate, burst) applied per channel to all methods
+    :param max_retries: retries of a call answered with 429
+    """
+
+    def __init__(self, client, method_limits, channel_limit, max_retries=3):
+        self.client = client
+        self.method_buckets = {m: TokenBucket(rate, burst) for m, (rate, burst) in method_limits.items()}
+        self.channel_limit = channel_limit
+        self.channel_buckets = {}
+        # channel name used for posting -> channel ID returned by Slack, so both share one bucket
+        self.channel_ids = {}
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self.stats = dict(ratelimited=0, throttled_seconds=0.0)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _channel_bucket(self, channel):
+        channel = self.channel_ids.get(channel, channel)
+        with self._lock:
+            bucket = self.channel_buckets.get(channel)
+            if bucket is None:
+                bucket = self.channel_buckets[channel] = TokenBucket(*self.channel_limit)
+            return bucket
+
+    def _delay(self, method, channel):
+        """Take the tokens of a call, return the seconds to wait before it"""
+        delay = self.method_buckets[method].reserve() if method in self.method_buckets else 0.0
+        delay = max(delay, self._channel_bucket(channel).reserve())
+        if delay > 0:
+            with self._lock:
+                self.stats["throttled_seconds"] += delay
+            log.debug("Throttling %s to channel %s for %.3fs", method, channel, delay)
+        return delay
+
+    def _ratelimited(self, method, channel, exc, attempt):
+        """Pause the buckets of a call answered with 429, return the seconds until the retry or None to raise exc"""
+        delay = retry_after(exc)
+        if delay is None or attempt >= self.max_retries:
+            return None
+        with self._lock:
+            self.stats["ratelimited"] += 1
+        log.warning("Slack rate limit hit on %s, retrying in %.1fs (attempt %d)", method, delay, attempt + 1)
+        if method in self.method_buckets:
+            self.method_buckets[method].pause(delay)
+        self._channel_bucket(channel).pause(delay)
+        return delay
+
+    def _posted(self, kwargs, ret):
+        if ret.get("channel") and kwargs.get("channel") not in self.channel_ids:
+            with self._lock:
+                self.channel_ids[kwargs.get("channel")] = ret["channel"]
+
+    def _call(self, method, func, kwargs):
+        channel = kwargs.get("channel")
+        attempt = 0
+        while True:
+            delay = self._delay(method, channel)
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                return func(**kwargs)
+            except Exception as e:
+                if self._ratelimited(method, channel, e, attempt) is None:
+                    raise
+                attempt += 1
+
+    def chat_postMessage(self, **kwargs):  # noqa: N802 (slack_sdk method name)
+        ret = self._call(POST, self.client.chat_postMessage, kwargs)
+        self._posted(kwargs, ret)
+        return ret
+
+    def chat_update(self, **kwargs):
+        return self._call(UPDATE, self.client.chat_update, kwargs)
+
+
+class AsyncRateLimitedClient(RateLimitedClient):
+    """:class:`RateLimitedClient` of an AsyncWebClient, waits without blocking the event loop"""
+
+    async def _call(self, method, func, kwargs):
+        channel = kwargs.get("channel")
+        attempt = 0
+        while True:
+            delay = self._delay(method, channel)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                return await func(**kwargs)
+            except Exception as e:
+                if self._ratelimited(method, channel, e, attempt) is None:
+                    raise
+                attempt += 1
+
+    async def chat_postMessage(self, **kwargs):  # noqa: N802 (slack_sdk method name)
+        ret = await self._call(POST, self.client.chat_postMessage, kwargs)
+        self._posted(kwargs, ret)
+        return ret
+
+    async def chat_update(self, **kwargs):
+        return await self._call(UPDATE, self.client.chat_update, kwargs)
+
+
+def create_client(slack_client, config, client_class=RateLimitedClient):
+    """Wrap slack_client according to the [ratelimit] section, unchanged if disabled
+
+    :param client_class: AsyncRateLimitedClient for an AsyncWebClient
+    """
+    rc = config["ratelimit"]
+    if not rc["enabled"]:
+        return slack_client
+    return client_class(slack_client, {POST: (rc["post_rate"], rc["post_burst"]), UPDATE: (rc["update_rate"], rc["update_burst"])}, (rc["channel_rate"], rc["channel_burst"]), rc["max_retries"])
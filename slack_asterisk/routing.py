@@ -0,0 +1,275 @@
+# coding=utf-8
+"""Routing of calls to Slack channels.
+
+Rules are configured as subsections of ``[routing]``; a call is posted to
+the channels of every rule it matches (fan-out), or to the ``channel`` of
+the ``[slack]`` section if no rule matches::
+
+    [routing]
+    [[support]]
+    exten = 100, 101, 2*, _3XX
+    channels = support, telefon
+    [[vip]]
+    type = VIP
+    direction = in
+    time = 08:00-18:00
+    days = mon-fri
+    channels = vip
+
+``exten`` and ``callerid`` take exact numbers, prefixes ending in ``*`` and
+Asterisk extension patterns starting with ``_`` (X, Z, N, ``[...]``, ``.``
+and ``!``). ``direction`` and ``type`` (SLACK_ASTERISK_DIRECTION /
+SLACK_ASTERISK_TYPE) take exact values, ``time`` local time windows and
+``days`` weekdays or weekday ranges. All conditions of a rule must match,
+an empty condition matches everything.
+
+Rules are compiled into one index per condition: a dict for exact values, a
+prefix trie for prefixes and a combined regular expression as prefilter for
+the extension patterns. Each index returns the set of rules matching a value
+as an integer bit mask, the matching rules are the intersection of the masks,
+so the cost of a lookup depends on the length of the numbers and not on the
+number of rules.
+"""
+import datetime
+import logging
+import re
+
+log = logging.getLogger("slack_asterisk")
+
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+
+class RoutingError(ValueError):
+    pass
+
+
+def pattern_regex(pattern):
+    """Translate an Asterisk extension pattern (with leading _) into a regular expression"""
+    out = []
+    i = 1
+    while i < len(pattern):
+        c = pattern[i]
+        if c in "Xx":
+            out.append("[0-9]")
+        elif c in "Zz":
+            out.append("[1-9]")
+        elif c in "Nn":
+            out.append("[2-9]")
+        elif c == ".":
+            out.append(".+")
+        elif c == "!":
+            out.append(".*")
+        elif c == "[":
+            end = pattern.find("]", i)
+            if end < 0:
+                raise RoutingError("Unterminated [ in pattern %s" % pattern)
+            out.append("[%s]" % "".join(ch if ch == "-" else re.escape(ch) for ch in pattern[i + 1:end]))
+            i = end
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+class NumberIndex(object):
+    """Rules by exact number, prefix (trie) and extension pattern, as bit masks"""
+
+    def __init__(self):
+        self.any = 0
+        self.exact = {}
+        # trie node: [mask of rules with the prefix ending here, {char: node}]
+        self.trie = [0, {}]
+        self.patterns = []
+        self._prefilter = None
+
+    def add(self, value, bit):
+        if value in ("", "*"):
+            self.any |= bit
+        elif value.startswith("_"):
+            self.patterns.append((re.compile(pattern_regex(value)), bit))
+        elif value.endswith("*"):
+            node = self.trie
+            for c in value[:-1]:
+                node = node[1].setdefault(c, [0, {}])
+            node[0] |= bit
+        else:
+            self.exact[value] = self.exact.get(value, 0) | bit
+
+    def finish(self):
+        if self.patterns:
+            self._prefilter = re.compile("|".join("(?:%s)" % regex.pattern for regex, _ in self.patterns))
+
+    def lookup(self, value):
+        mask = self.any
+        if value is None:
+            return mask
+        mask |= self.exact.get(value, 0)
+        node = self.trie
+        mask |= node[0]
+        for c in value:
+            node = node[1].get(c)
+            if node is None:
+                break
+            mask |= node[0]
+        if self._prefilter is not None and self._prefilter.fullmatch(value):
+            for regex, bit in self.patterns:
+                if regex.fullmatch(value):
+                    mask |= bit
+        return mask
+
+
+class ValueIndex(object):
+    """Rules by exact value, as bit masks"""
+
+    def __init__(self):
+        self.any = 0
+        self.exact = {}
+
+    def add(self, value, bit):
+        self.exact[value] = self.exact.get(value, 0) | bit
+
+    def lookup(self, value):
+        return self.any | self.exact.get(value, 0)
+
+
+def parse_days(values):
+    days = set()
+    for value in values:
+        first, _, last = value.strip().lower().partition("-")
+        try:
+            start = DAYS.index(first[:3])
+            end = DAYS.index(last[:3]) if last else start
+        except ValueError as e:
+            raise RoutingError("Unknown weekday in %s" % value) from e
+        i = start
+        while True:
+            days.add(i)
+            if i == end:
+                break
+            i = (i + 1) % 7
+    return days
+
+
+def parse_times(values):
+    """Parse HH:MM-HH:MM windows into (start, end) minutes of the day, end exclusive, may wrap midnight"""
+    windows = []
+    for value in values:
+        try:
+            start, end = [datetime.datetime.strptime(v.strip(), "%H:%M") for v in value.split("-")]
+        except ValueError as e:
+            raise RoutingError("Invalid time window %s, expected HH:MM-HH:MM" % value) from e
+        windows.append((start.hour * 60 + start.minute, end.hour * 60 + end.minute))
+    return windows
+
+
+class Rule(object):  # pylint:disable=too-few-public-methods
+    __slots__ = ("name", "channels", "days", "times")
+
+    def __init__(self, name, channels, days=None, times=None):
+        self.name = name
+        self.channels = channels
+        self.days = days
+        self.times = times
+
+    def active(self, weekday, minute):
+        if self.days and weekday not in self.days:
+            return False
+        if not self.times:
+            return True
+        for start, end in self.times:
+            if start <= end and start <= minute < end or start > end and (minute >= start or minute < end):
+                return True
+        return False
+
+
+class Router(object):
+    """Compiled routing rules
+
+    :param rules: dict rule name -> dict of conditions and channels, in priority order
+    :param default_channel: channel for calls matching no rule
+    """
+
+    def __init__(self, rules, default_channel):
+        self.default = [default_channel]
+        self.rules = []
+        self.exten = NumberIndex()
+        self.callerid = NumberIndex()
+        self.direction = ValueIndex()
+        self.type = ValueIndex()
+        self.timed = 0
+        for n, (name, spec) in enumerate(rules.items()):
+            bit = 1 << n
+            channels = [c for c in spec.get("channels", []) if c]
+            if not channels:
+                raise RoutingError("Routing rule %s has no channels" % name)
+            for key, index in (("exten", self.exten), ("callerid", self.callerid)):
+                values = spec.get(key) or [""]
+                for value in values:
+                    index.add(value.strip(), bit)
+            for key, index in (("direction", self.direction), ("type", self.type)):
+                values = spec.get(key) or []
+                if not values:
+                    index.any |= bit
+                for value in values:
+                    index.add(value.strip(), bit)
+            days = parse_days(spec.get("days") or [])
+            times = parse_times(spec.get("time") or [])
+            if days or times:
+                self.timed |= bit
+            self.rules.append(Rule(name, channels, days, times))
+        self.exten.finish()
+        self.callerid.finish()
+        self.all = (1 << len(self.rules)) - 1
+        # (weekday, minute) -> mask of rules active then
+        self._clock = (None, self.all)
+
+    def _active(self, now):
+        key = (now.weekday(), now.hour * 60 + now.minute)
+        if self._clock[0] == key:
+            return self._clock[1]
+        mask = self.all & ~self.timed
+        timed = self.timed
+        while timed:
+            low = timed & -timed
+            if self.rules[low.bit_length() - 1].active(*key):
+                mask |= low
+            timed ^= low
+        self._clock = (key, mask)
+        return mask
+
+    def match(self, exten=None, callerid=None, direction=None, type=None, now=None):  # pylint:disable=redefined-builtin
+        """Return the matching Rules in priority order"""
+        mask = self.exten.lookup(exten) & self.callerid.lookup(callerid) & self.direction.lookup(direction) & self.type.lookup(type)
+        if mask & self.timed:
+            mask &= self._active(now or datetime.datetime.now())
+        rules = []
+        while mask:
+            low = mask & -mask
+            rules.append(self.rules[low.bit_length() - 1])
+            mask ^= low
+        return rules
+
+    def route(self, exten=None, callerid=None, direction=None, type=None, now=None):  # pylint:disable=redefined-builtin
+        """Return the channels for a call, without duplicates"""
+        rules = self.match(exten, callerid, direction, type, now)
+        if not rules:
+            return self.default
+        if len(rules) == 1:
+            return rules[0].channels
+        channels = []
+        for rule in rules:
+            channels.extend(c for c in rule.channels if c not in channels)
+        return channels
+
+
+def create_router(config):
+    """Router from the [routing] section, None if no rules are configured"""
+    rules = config["routing"] if "routing" in config else {}
+    if not rules:
+        return None
+    try:
+        router = Router(rules, config["slack"]["channel"])
+    except RoutingError as e:
+        raise RuntimeError("Failed to compile routing rules: %s" % e) from e
+    log.info("Loaded %d routing rules", len(router.rules))
+    return router
@@ -0,0 +1,109 @@
+# coding=utf-8
+"""Per-call serialization of state transitions.
+
+:class:`KeyedLock` hands out one lock per key (the call's uniqueid), created
+on first use and dropped again when nobody holds or waits for it. AGI
+sessions of the same call are serialized, sessions of different calls never
+contend on anything but a short dictionary update.
+
+:class:`ProcessKeyedLock` serializes the sessions of a call across the
+worker processes of a prefork server, which may each receive a part of them.
+"""
+import contextlib
+import fcntl
+import os
+import struct
+import threading
+import zlib
+
+# struct flock: l_type, l_whence, l_start, l_len, l_pid
+_FLOCK = "hhqqi"
+
+
+class KeyedLock(object):
+    """Lazily created lock per key"""
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        # key -> [lock, number of holders and waiters]
+        self._locks = {}
+
+    def __len__(self):
+        with self._mutex:
+            return len(self._locks)
+
+    @contextlib.contextmanager
+    def hold(self, key):
+        with self._mutex:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._mutex:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+
+class AsyncKeyedLock(object):
+    """Lazily created asyncio lock per key, for coroutines on a single event loop"""
+
+    def __init__(self):
+        # imported here, the threaded engines do not need asyncio
+        import asyncio  # pylint:disable=import-outside-toplevel
+        self._lock_type = asyncio.Lock
+        # key -> [lock, number of holders and waiters]
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [self._lock_type(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+
+class ProcessKeyedLock(object):
+    """Lock per key shared by all processes using the same lock file
+
+    Keys are hashed onto ``stripes`` bytes of the lock file, each locked with
+    an open file description lock (Linux). Calls sharing a stripe wait for
+    each other briefly, but a holder locks one stripe only, so they never
+    deadlock.
+
+    :param path: lock file, created if missing
+    :param stripes: number of byte ranges the keys are spread over
+    """
+
+    def __init__(self, path, stripes=4096):
+        if not hasattr(fcntl, "F_OFD_SETLKW"):
+            raise RuntimeError("Locking calls across processes needs open file description locks (Linux 3.15 or later)")
+        self.path = path
+        self.stripes = stripes
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+
+    @contextlib.contextmanager
+    def hold(self, key):
+        # a descriptor per holder, threads sharing one would not exclude each other
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            stripe = zlib.crc32(str(key).encode()) % self.stripes
+            fcntl.fcntl(fd, fcntl.F_OFD_SETLKW, struct.pack(_FLOCK, fcntl.F_WRLCK, os.SEEK_SET, stripe, 1, 0))
+            yield
+        finally:
+            # closing the descriptor releases the lock
+            os.close(fd)
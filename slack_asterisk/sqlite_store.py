@@ -0,0 +1,278 @@
+# coding=utf-8
+"""Crash-safe call state backend on SQLite.
+
+:class:`SQLiteCallStore` keeps the in-memory CallStore as the source for
+all lookups and journals modified and finished calls to a SQLite database
+in WAL mode. Writes are collected in memory and committed by a background
+thread every ``commit_interval`` seconds in one transaction, so the AGI hot
+path never waits for SQLite or an fsync. On startup the calls still in
+progress are loaded again, rows older than the TTL are pruned.
+
+A crash loses at most the events of the last commit interval.
+
+:class:`SharedSQLiteCallStore` caches nothing and reads and writes every
+call in the database, so the worker processes of a prefork server see the
+state written by each other.
+"""
+import dataclasses
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from . import call_store
+
+log = logging.getLogger("slack_asterisk")
+
+UPSERT = "INSERT INTO calls (uniqueid, state, updated) VALUES (?, ?, ?) ON CONFLICT(uniqueid) DO UPDATE SET state = excluded.state, updated = excluded.updated"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS calls (
+    uniqueid TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    updated REAL NOT NULL
+)
+"""
+
+# CallState fields stored in the journal, expires is a monotonic timestamp and meaningless after restart,
+# digests describe what this process sent and are rebuilt by the next update
+_FIELDS = tuple(f.name for f in dataclasses.fields(call_store.CallState) if f.name not in ("expires", "digests"))
+
+
+def dump_state(state):
+    data = {name: getattr(state, name) for name in _FIELDS}
+    for name in ("ts_in", "ts_connected"):
+        if data[name] is not None:
+            data[name] = data[name].isoformat()
+    return json.dumps(data, separators=(",", ":"))
+
+
+def load_state(text):
+    data = json.loads(text)
+    for name in ("ts_in", "ts_connected"):
+        if data.get(name) is not None:
+            data[name] = datetime.datetime.fromisoformat(data[name])
+    return call_store.CallState(**{k: v for k, v in data.items() if k in _FIELDS})
+
+
+def connect(path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    # WAL with synchronous=NORMAL is consistent after a crash, only the last commits may be lost on power failure
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(SCHEMA)
+    return db
+
+
+class SQLiteCallStore(call_store.CallStore):
+    """CallStore journaling to SQLite with grouped commits
+
+    :param path: database file
+    :param commit_interval: seconds between grouped commits
+    """
+
+    def __init__(self, path, commit_interval=0.5, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.commit_interval = commit_interval
+        self._db = connect(path)
+        # uniqueid -> CallState to upsert or None to delete
+        self._dirty = {}
+        self._dirty_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.stats.update(commits=0, rows_written=0, rows_deleted=0, restored=0)
+        self._restore()
+        self._flusher = threading.Thread(target=self._run_flusher, name="call-store-flusher", daemon=True)
+        self._flusher.start()
+
+    def _restore(self):
+        cutoff = time.time() - self.ttl
+        self._db.execute("DELETE FROM calls WHERE updated < ?", (cutoff,))
+        now = time.monotonic()
+        rows = self._db.execute("SELECT state FROM calls ORDER BY updated DESC LIMIT ?", (self.max_size,)).fetchall()
+        with self.lock:
+            for (text,) in rows:
+                try:
+                    state = load_state(text)
+                except (ValueError, TypeError) as e:
+                    log.warning("Skipping unreadable call state in %s: %s", self.path, e)
+                    continue
+                self._calls[state.uniqueid] = state
+                self._touch(state, now)
+            self.stats["restored"] = len(self._calls)
+        if rows:
+            log.info("Restored %d calls in progress from %s", len(self._calls), self.path)
+
+    def save(self, state):
+        # a call finished or expired meanwhile (e.g. before the dispatcher recorded its post) must stay deleted
+        with self.lock:
+            if state.uniqueid not in self._calls:
+                return
+            with self._dirty_lock:
+                self._dirty[state.uniqueid] = state
+
+    def _forget(self, uniqueid):
+        with self._dirty_lock:
+            self._dirty[uniqueid] = None
+
+    def pop(self, uniqueid):
+        state = super().pop(uniqueid)
+        self._forget(uniqueid)
+        return state
+
+    def _expired(self, state):
+        self._forget(state.uniqueid)
+        super()._expired(state)
+
+    def flush(self):
+        """Commit all pending changes in one transaction, return the number of rows touched"""
+        with self._flush_lock:
+            with self._dirty_lock:
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return 0
+            now = time.time()
+            upserts = [(k, dump_state(v), now) for k, v in dirty.items() if v is not None]
+            deletes = [(k,) for k, v in dirty.items() if v is None]
+            try:
+                self._db.execute("BEGIN")
+                self._db.executemany(UPSERT, upserts)
+                self._db.executemany("DELETE FROM calls WHERE uniqueid = ?", deletes)
+                self._db.execute("COMMIT")
+            except sqlite3.Error as e:
+                log.error("Writing call state to %s failed with message %s", self.path, e)
+                try:
+                    self._db.execute("ROLLBACK")
+                except sqlite3.Error:
+                    pass
+                # keep the changes for the next attempt unless newer ones arrived meanwhile
+                with self._dirty_lock:
+                    for k, v in dirty.items():
+                        self._dirty.setdefault(k, v)
+                return 0
+            self.stats["commits"] += 1
+            self.stats["rows_written"] += len(upserts)
+            self.stats["rows_deleted"] += len(deletes)
+            return len(dirty)
+
+    def prune(self):
+        """Delete rows not updated within the TTL, e.g. left over by calls evicted while the process was down"""
+        with self._flush_lock:
+            return self._db.execute("DELETE FROM calls WHERE updated < ?", (time.time() - self.ttl,)).rowcount
+
+    def _run_flusher(self):
+        last_prune = time.monotonic()
+        while not self._stop.wait(self.commit_interval):
+            self.flush()
+            if time.monotonic() - last_prune > 60:
+                self.prune()
+                last_prune = time.monotonic()
+
+    def close(self):
+        super().close()
+        self._flusher.join(self.commit_interval * 2 + 1)
+        self.flush()
+        self._db.close()
+
+
+class SharedSQLiteCallStore(call_store.CallStore):
+    """CallStore kept in SQLite only, shared by the processes using the same database
+
+    Every lookup reads the state last written by any process. The lookup and
+    save of one call must be serialized across the processes by the caller,
+    e.g. with a sequencer.ProcessKeyedLock. TTL and size limit are enforced
+    by :meth:`expire` only, so the reaper should run in one process.
+
+    :param path: database file
+    """
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._db = connect(path)
+
+    def __len__(self):
+        with self.lock:
+            return self._db.execute("SELECT count(*) FROM calls").fetchone()[0]
+
+    def __contains__(self, uniqueid):
+        return self.get(uniqueid) is not None
+
+    def get(self, uniqueid):
+        with self.lock:
+            row = self._db.execute("SELECT state FROM calls WHERE uniqueid = ?", (uniqueid,)).fetchone()
+        if row is None:
+            return None
+        try:
+            return load_state(row[0])
+        except (ValueError, TypeError) as e:
+            log.warning("Unreadable state of call %s in %s: %s", uniqueid, self.path, e)
+            return None
+
+    def get_or_create(self, uniqueid):
+        state = self.get(uniqueid)
+        if state is not None:
+            return state, False
+        with self.lock:
+            self.stats["created"] += 1
+        # written by the save after the state transition
+        return call_store.CallState(uniqueid), True
+
+    def save(self, state):
+        with self.lock:
+            self._db.execute(UPSERT, (state.uniqueid, dump_state(state), time.time()))
+
+    def pop(self, uniqueid):
+        state = self.get(uniqueid)
+        with self.lock:
+            if self._db.execute("DELETE FROM calls WHERE uniqueid = ?", (uniqueid,)).rowcount:
+                self.stats["finished"] += 1
+        return state
+
+    def _take(self, query, *params):
+        """Delete and return the calls selected by a query of uniqueid and state"""
+        with self.lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(query, params).fetchall()
+                self._db.executemany("DELETE FROM calls WHERE uniqueid = ?", [(k,) for k, _ in rows])
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                self._db.execute("ROLLBACK")
+                raise
+        states = []
+        for uniqueid, text in rows:
+            try:
+                states.append(load_state(text))
+            except (ValueError, TypeError) as e:
+                log.warning("Dropping unreadable state of call %s in %s: %s", uniqueid, self.path, e)
+        return states
+
+    def expire(self):
+        try:
+            expired = self._take("SELECT uniqueid, state FROM calls WHERE updated < ?", time.time() - self.ttl)
+            evicted = self._take("SELECT uniqueid, state FROM calls ORDER BY updated DESC LIMIT -1 OFFSET ?", self.max_size)
+        except sqlite3.Error as e:
+            log.error("Expiring calls in %s failed with message %s", self.path, e)
+            return 0
+        with self.lock:
+            self.stats["evicted_ttl"] += len(expired)
+            self.stats["evicted_size"] += len(evicted)
+        for state in expired:
+            log.info("Call %s expired without final event", state.uniqueid)
+            self._expired(state)
+        if evicted:
+            log.warning("Call store full (%d calls), evicted %d calls", self.max_size, len(evicted))
+        for state in evicted:
+            self._expired(state)
+        return len(expired) + len(evicted)
+
+    def close(self):
+        super().close()
+        with self.lock:
+            self._db.close()
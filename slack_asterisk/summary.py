@@ -0,0 +1,261 @@
+# coding=utf-8
+"""Digest mode: summary messages instead of one message per call in busy channels.
+
+With ``[summary] enabled = true`` the new calls routed to each channel are
+counted over the last minute. Once a channel receives ``threshold`` calls
+per minute or more, its new calls are no longer posted one by one. They
+are summarized in one message per channel, posted and then updated every
+``interval`` seconds, with
+
+- the number of calls since digest mode started and how many are in progress,
+- the finished calls by DIALSTATUS (HANGUP for calls finished by a hangup
+  cause or expired without final event),
+- the average answered time of answered calls,
+- the callers of the calls not answered.
+
+A channel leaves digest mode when its rate falls below half the threshold.
+Its summary is published a last time once its summarized calls are
+finished, the next busy period starts a new summary message. Calls routed to
+several channels are only summarized in the busy ones.
+
+The summaries are kept in memory, a restart starts new ones.
+"""
+import collections
+import logging
+import threading
+import time
+
+from . import metrics
+
+log = logging.getLogger("slack_asterisk")
+
+# seconds the call rate of a channel is measured over
+RATE_WINDOW = 60.0
+# callers of missed calls listed in a summary, the rest are counted
+MAX_MISSED = 20
+
+
+def _check(ret):
+    if ret["ok"] is not True:
+        raise RuntimeError("Cannot post message with error %s" % ret["error"])
+    return ret
+
+
+def _duration(seconds):
+    seconds = int(round(seconds))
+    return "%d:%02d" % divmod(seconds, 60)
+
+
+class ChannelSummary(object):  # pylint:disable=too-many-instance-attributes
+    """Summary message of one busy period of a channel"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.since = time.time()
+        self.active = True
+        self.calls = 0
+        self.finished = 0
+        self.outcomes = collections.Counter()
+        self.missed = []
+        self.missed_more = 0
+        self.answered_sum = 0
+        self.answered_count = 0
+        # channel ID and ts of the summary message once posted, digest of its last payload
+        self.channel_id = None
+        self.ts = None
+        self.sent = None
+
+    @property
+    def in_progress(self):
+        return self.calls - self.finished
+
+    def add(self, msg_data):
+        self.finished += 1
+        outcome = msg_data.dialstatus or "HANGUP"
+        self.outcomes[outcome] += 1
+        if outcome == "ANSWER" and msg_data.answeredtime is not None:
+            self.answered_sum += msg_data.answeredtime
+            self.answered_count += 1
+        elif outcome != "ANSWER" and msg_data.direction != "out":
+            if len(self.missed) < MAX_MISSED:
+                caller = msg_data.from_num or "unknown"
+                self.missed.append("%s (%s)" % (msg_data.from_name, caller) if msg_data.from_name else caller)
+            else:
+                self.missed_more += 1
+
+    def payload(self):
+        """Keyword arguments for chat_postMessage / chat_update"""
+        title = "%d calls since %s" % (self.calls, time.strftime("%H:%M", time.localtime(self.since)))
+        if self.in_progress:
+            title += ", %d in progress" % self.in_progress
+        lines = [", ".join("%s %d" % kv for kv in sorted(self.outcomes.items(), key=lambda kv: (-kv[1], kv[0])))] if self.outcomes else []
+        if self.answered_count:
+            lines.append("Average answered time %s" % _duration(self.answered_sum / self.answered_count))
+        if self.missed:
+            lines.append("Missed: %s%s" % (", ".join(self.missed), " and %d more" % self.missed_more if self.missed_more else ""))
+        footer = "Summary of a busy period, calls are no longer posted one by one" if self.active else "Summary of a busy period, calls are posted one by one again"
+        return {"text": title, "attachments": [{"color": "#439FE0", "title": title, "text": "\n".join(lines), "fallback": title, "footer": footer}]}
+
+
+class Summarizer(object):
+    """Switches channels to digest mode by call rate and publishes their summaries
+
+    :param threshold: new calls per minute to a channel that switch it to digest mode, 0 disables digest mode
+    :param interval: seconds between updates of the summary messages
+    """
+
+    def __init__(self, threshold=0.0, interval=60.0):
+        self.slack_client = None
+        self._lock = threading.Lock()
+        # one publish at a time, the last one on drain may overlap the publisher thread
+        self._publish_lock = threading.Lock()
+        # channel -> deque of monotonic arrival times of new calls within RATE_WINDOW
+        self._arrivals = {}
+        # channel -> ChannelSummary of channels in digest mode or with summarized calls in progress
+        self._summaries = {}
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats = dict(summarized=0, published=0, failed=0)
+        self.configure(threshold, interval)
+
+    def configure(self, threshold, interval):
+        self.threshold = threshold
+        self.interval = interval
+
+    def start(self):
+        """Publish the summaries with slack_client every interval seconds in a daemon thread, once started it keeps running"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="summary-publisher", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.publish()
+
+    def _rate(self, channel, now):
+        """Record a new call to channel, return the calls per minute over the last RATE_WINDOW seconds"""
+        arrivals = self._arrivals.get(channel)
+        if arrivals is None:
+            arrivals = self._arrivals[channel] = collections.deque()
+        arrivals.append(now)
+        while arrivals[0] < now - RATE_WINDOW:
+            arrivals.popleft()
+        return len(arrivals) * 60.0 / RATE_WINDOW
+
+    def route(self, msg_data, channels):
+        """Channels a new call is posted to, the call is summarized in the channels in digest mode
+
+        The summarized channels are recorded in msg_data.summary.
+        """
+        if not self.threshold or self.slack_client is None:
+            return channels
+        now = time.monotonic()
+        posted = []
+        summarized = []
+        with self._lock:
+            for channel in channels:
+                rate = self._rate(channel, now)
+                summary = self._summaries.get(channel)
+                if summary is None or not summary.active:
+                    if rate < self.threshold:
+                        posted.append(channel)
+                        continue
+                    log.info("%.0f calls per minute to channel %s, summarizing its calls every %.0fs", rate, channel, self.interval)
+                    if summary is None:
+                        summary = self._summaries[channel] = ChannelSummary(channel)
+                    else:
+                        # busy again before the summarized calls finished, the busy period continues
+                        summary.active = True
+                summary.calls += 1
+                summarized.append(channel)
+            if summarized:
+                self.stats["summarized"] += 1
+        if summarized:
+            msg_data.summary = summarized
+            metrics.SUMMARIZED_CALLS.inc()
+        return posted
+
+    def finish(self, msg_data):
+        """Count a finished call in the summaries of its channels"""
+        if not msg_data.summary:
+            return
+        with self._lock:
+            for channel in msg_data.summary:
+                summary = self._summaries.get(channel)
+                if summary is not None:
+                    summary.add(msg_data)
+
+    def publish(self):
+        """Post or update the summary of every channel that changed, end the busy periods that are over"""
+        if self.slack_client is None:
+            return
+        with self._publish_lock:
+            self._publish(time.monotonic())
+
+    def _publish(self, now):
+        with self._lock:
+            summaries = list(self._summaries.values())
+            for summary in summaries:
+                arrivals = self._arrivals.get(summary.channel)
+                while arrivals and arrivals[0] < now - RATE_WINDOW:
+                    arrivals.popleft()
+                rate = len(arrivals or ()) * 60.0 / RATE_WINDOW
+                if summary.active and (not self.threshold or rate < self.threshold / 2):
+                    log.info("%.0f calls per minute to channel %s, posting its calls one by one again", rate, summary.channel)
+                    summary.active = False
+            payloads = [(summary, summary.payload()) for summary in summaries]
+        for summary, payload in payloads:
+            self._send(summary, payload)
+            if not summary.active and not summary.in_progress:
+                with self._lock:
+                    if self._summaries.get(summary.channel) is summary and not summary.in_progress:
+                        del self._summaries[summary.channel]
+
+    def _send(self, summary, payload):
+        # imported here, dispatch uses this module for every Slack message it sends
+        from . import dispatch  # pylint:disable=import-outside-toplevel
+        sent = dispatch.digest(payload)
+        if sent == summary.sent:
+            return
+        try:
+            if summary.ts is None:
+                ret = _check(self.slack_client.chat_postMessage(channel=summary.channel, **payload))
+                summary.channel_id, summary.ts = ret["channel"], ret["ts"]
+            else:
+                _check(self.slack_client.chat_update(channel=summary.channel_id, ts=summary.ts, **payload))
+            summary.sent = sent
+            self.stats["published"] += 1
+        except Exception as e:
+            self.stats["failed"] += 1
+            log.error("Publishing the call summary of channel %s failed with message %s", summary.channel, e)
+
+    def close(self):
+        """Publish the summaries a last time and stop the publisher"""
+        self._stop.set()
+        self.publish()
+
+
+# used by dispatch.deliver for every new and finished call, disabled until configured
+SUMMARIZER = Summarizer()
+
+
+def configure(config, slack_client=None):
+    """Set up SUMMARIZER from the [summary] section, start publishing the first time it is enabled
+
+    :param slack_client: WebClient for the summary messages, passed by the engines at startup whether or not
+        digest mode is enabled, so a reload can enable it; None keeps the one of an earlier call
+    """
+    if slack_client is not None:
+        SUMMARIZER.slack_client = slack_client
+    sc = config["summary"]
+    if not sc["enabled"]:
+        SUMMARIZER.configure(0.0, sc["interval"])
+        return SUMMARIZER
+    SUMMARIZER.configure(sc["threshold"], sc["interval"])
+    if SUMMARIZER.slack_client is None:
+        log.warning("Digest mode needs a synchronous Slack client, the asyncio engine needs dispatch workers for it, summaries disabled")
+    else:
+        SUMMARIZER.start()
+        log.info("Summarizing the calls of channels with %.0f calls per minute or more every %.0fs", sc["threshold"], sc["interval"])
+    return SUMMARIZER
@@ -0,0 +1,259 @@
+# coding=utf-8
+"""Message templates.
+
+All texts and colors of the Slack messages come from the ``[templates]``
+section of the config file. Templates use ``$name`` / ``${name}``
+placeholders (``$$`` for a literal dollar sign). At startup every template
+is checked against the placeholders available for it and compiled into a
+``%``-format string with an ``itemgetter`` of the placeholder values,
+templates without placeholders into a constant. Rendering an event is a
+table lookup and one call per message part; title, fallback and footer
+only change with the call data and are cached.
+
+States and their placeholders:
+
+ringing_in, ringing_out
+    ``$exten``, ``$info`` (the ``info`` template if SLACK_ASTERISK_INFO_TEXT is set)
+established, hangup
+    ``$dest``
+finished_in, finished_out
+    ``$status`` (``status_<dialstatus>`` of the DIALSTATUS), ``$dest``
+hangup_unknown
+    ``$hangupcause``
+unknown, stale
+    none
+
+The message parts ``typed`` (``$type``, ``$text``), ``title_in`` /
+``title_out`` / ``fallback`` (``$from_num``, ``$from_name``, ``$title_text``,
+each optional part rendered by its own template), ``footer`` (``$time``,
+``$dialed``, ``$answered``) and ``dialed`` / ``answered`` (``$duration``)
+make up the attachment. With ``format = blocks`` the message is sent as
+Block Kit blocks inside a colored attachment.
+"""
+import datetime
+import operator
+import string
+
+# template name -> (default, placeholders)
+TEMPLATES = {
+    "ringing_in": ("📞 Incoming call (ringing)$info", ("exten", "info")),
+    "ringing_out": ("📞 Outgoing call (ringing) to $exten$info", ("exten", "info")),
+    "info": (" ($info_text)", ("info_text",)),
+    "established": ("☑️ Call established with $dest", ("dest",)),
+    "finished_in": ("$status from $dest", ("status", "dest")),
+    "finished_out": ("$status to $dest", ("status", "dest")),
+    "hangup": ("Call hung up by $dest", ("dest",)),
+    "hangup_unknown": ("Unknown call state (hangupcause $hangupcause)", ("hangupcause",)),
+    "unknown": ("Unknown call state", ()),
+    "stale": ("⚠️ Call state unknown (no final event received)", ()),
+    "typed": ("$type: $text", ("type", "text")),
+    "title_in": ("⬅️ Call from $from_num$from_name$title_text", ("from_num", "from_name", "title_text")),
+    "title_out": ("➡️ Call from $from_num$from_name$title_text", ("from_num", "from_name", "title_text")),
+    "fallback": ("Call from $from_num$from_name$title_text", ("from_num", "from_name", "title_text")),
+    "from_name": (" ($from_name) ", ("from_name",)),
+    "title_text": (" - $title_text", ("title_text",)),
+    "footer": ("Time: $time$dialed$answered", ("time", "dialed", "answered")),
+    "dialed": (" - Dialed for $duration", ("duration",)),
+    "answered": (" - Answered for $duration", ("duration",)),
+}
+
+# DIALSTATUS -> (status text, color); "other" is used for unknown values
+STATUS = {
+    "answer": ("✅ Call ended", "good"),
+    "busy": ("⭕ Busy", "warning"),
+    "noanswer": ("❌️ Not answered", "warning"),
+    "cancel": ("❌ Canceled", "warning"),
+    "congestion": ("❌ Congestion", "#9400D3"),
+    "chanunavail": ("❌ Channel unavailable", "#9400D3"),
+    "dontcall": ("❌ Reject (don't call)", "#A9A9A9"),
+    "torture": ("❌ Reject (torture)", "#A9A9A9"),
+    "other": ("Unknown", "#333333"),
+}
+
+COLORS = {
+    "default": "good",
+    "stale": "#333333",
+}
+
+FORMATS = ("attachments", "blocks")
+
+# entries of the title and footer caches, cleared when full
+_CACHE_SIZE = 4096
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def compile_template(name, text, placeholders=()):
+    """Compile a $-template into a callable taking all placeholders as keyword arguments
+
+    :raises TemplateError: on syntax errors or unknown placeholders
+    """
+    fmt = []
+    keys = []
+    pos = 0
+    for m in string.Template.pattern.finditer(text):
+        if m.group("invalid") is not None:
+            raise TemplateError("Invalid placeholder in template %s at position %d: %r" % (name, m.start(), text))
+        fmt.append(text[pos:m.start()])
+        key = m.group("named") or m.group("braced")
+        if key is None:
+            # $$
+            fmt.append("$")
+        elif key not in placeholders:
+            raise TemplateError("Unknown placeholder $%s in template %s, available: %s" % (key, name, ", ".join(placeholders) or "none"))
+        else:
+            keys.append(key)
+            fmt.append(None)
+        pos = m.end()
+    fmt.append(text[pos:])
+    if not keys:
+        constant = "".join(fmt)
+        return lambda **_: constant
+    # the template becomes a %-format string, the placeholder values are taken in its order by one itemgetter
+    fmt = "".join("%s" if part is None else part.replace("%", "%%") for part in fmt)
+    values = operator.itemgetter(*keys)
+    if len(keys) == 1:
+        return lambda **kwargs: fmt % (values(kwargs),)
+    return lambda **kwargs: fmt % values(kwargs)
+
+
+_durations = {}
+
+
+def _duration(seconds):
+    """Rendered duration, cached as dialed and answered times repeat a lot"""
+    text = _durations.get(seconds)
+    if text is None:
+        if len(_durations) >= _CACHE_SIZE:
+            _durations.clear()
+        text = _durations[seconds] = str(datetime.timedelta(seconds=seconds))
+    return text
+
+
+class MessageTemplates(object):  # pylint:disable=too-many-instance-attributes
+    """Compiled templates and the dispatch tables of the message texts
+
+    :param section: [templates] section of the configuration, defaults if None
+    :param slack_config: [slack] section (username and emoji of attachments)
+    """
+
+    def __init__(self, section=None, slack_config=None):
+        section = section or {}
+        slack_config = slack_config or {}
+        self.format = section.get("format", "attachments")
+        if self.format not in FORMATS:
+            raise TemplateError("Unknown message format %s" % self.format)
+        self.time_format = section.get("time_format", "%A %d.%m.%Y %H:%M:%S")
+        self.username = slack_config.get("username", "User")
+        self.emoji = slack_config.get("emoji", ":telephone_receiver:")
+        self.t = {name: compile_template(name, section.get(name, default), placeholders) for name, (default, placeholders) in TEMPLATES.items()}
+        # an empty color selects the default, "#" cannot be used in the defaults of the config spec
+        self.colors = {name: section.get("color_" + name) or default for name, default in COLORS.items()}
+        # DIALSTATUS value -> (status text, color)
+        self.status = {}
+        for name, (default, color) in STATUS.items():
+            self.status[name.upper()] = (section.get("status_" + name, default), section.get("color_" + name) or color)
+        self._other = self.status.pop("OTHER")
+        # rendered title/fallback and footer by the call data they depend on
+        self._heads = {}
+        self._footers = {}
+        self._times = {}
+
+    # --- event texts, used by calls.CallStateMachine ---
+
+    def ringing(self, direction, exten, info_text=None):
+        info = self.t["info"](info_text=info_text) if info_text is not None else ""
+        return self.t["ringing_in" if direction == "in" else "ringing_out"](exten=exten, info=info)
+
+    def established(self, dest):
+        return self.t["established"](dest=dest)
+
+    def finished(self, dialstatus, direction, dest):
+        """Text and color for the final DIALSTATUS of a call"""
+        status, color = self.status.get(dialstatus, self._other)
+        return self.t["finished_in" if direction == "in" else "finished_out"](status=status, dest=dest), color
+
+    def hangup(self, dest):
+        return self.t["hangup"](dest=dest)
+
+    def hangup_unknown(self, hangupcause):
+        return self.t["hangup_unknown"](hangupcause=hangupcause)
+
+    def unknown(self):
+        return self.t["unknown"]()
+
+    def stale(self):
+        return self.t["stale"](), self.colors["stale"]
+
+    # --- message rendering ---
+
+    def _head(self, msg_data):
+        """Title and fallback of a call, cached as they only change with the caller"""
+        key = (msg_data.direction, msg_data.from_num, msg_data.from_name, msg_data.title_text)
+        head = self._heads.get(key)
+        if head is None:
+            t = self.t
+            from_name = t["from_name"](from_name=msg_data.from_name) if msg_data.from_name and msg_data.from_name != "anonymous" else ""
+            title_text = t["title_text"](title_text=msg_data.title_text) if msg_data.title_text is not None else ""
+            title = t["title_out" if msg_data.direction == "out" else "title_in"](from_num=msg_data.from_num, from_name=from_name, title_text=title_text)
+            head = (title, t["fallback"](from_num=msg_data.from_num, from_name=from_name, title_text=title_text))
+            if len(self._heads) >= _CACHE_SIZE:
+                self._heads.clear()
+            self._heads[key] = head
+        return head
+
+    def _footer(self, msg_data):
+        key = (msg_data.ts_in, msg_data.dialedtime, msg_data.answeredtime)
+        footer = self._footers.get(key)
+        if footer is None:
+            t = self.t
+            time = self._times.get(msg_data.ts_in)
+            if time is None:
+                if len(self._times) >= _CACHE_SIZE:
+                    self._times.clear()
+                time = self._times[msg_data.ts_in] = msg_data.ts_in.strftime(self.time_format)
+            footer = t["footer"](time=time,
+                                 dialed=t["dialed"](duration=_duration(msg_data.dialedtime)) if msg_data.dialedtime is not None else "",
+                                 answered=t["answered"](duration=_duration(msg_data.answeredtime)) if msg_data.answeredtime is not None else "")
+            if len(self._footers) >= _CACHE_SIZE:
+                self._footers.clear()
+            self._footers[key] = footer
+        return footer
+
+    def parts(self, msg, msg_data, color="good"):
+        """Return (title, text, fallback, footer, color) of the message for a call"""
+        title, fallback = self._head(msg_data)
+        if msg_data.color is not None:
+            color = msg_data.color
+        if msg_data.type is not None:
+            msg = self.t["typed"](type=msg_data.type, text=msg)
+        return title, msg, fallback, self._footer(msg_data), color
+
+    def attachment(self, msg, msg_data, color="good"):
+        """Render the legacy Slack attachment for a call"""
+        title, text, fallback, footer, color = self.parts(msg, msg_data, color)
+        return {"color": color, "title": title, "text": text, "fallback": fallback, "username": self.username, "icon_emoji": self.emoji, "actions": None, "footer": footer}
+
+    def payload(self, msg, msg_data, color="good"):
+        """Keyword arguments for chat_postMessage / chat_update with the message for a call"""
+        if self.format == "attachments":
+            return {"attachments": [self.attachment(msg, msg_data, color)]}
+        title, text, fallback, footer, color = self.parts(msg, msg_data, color)
+        blocks = [
+            {"type": "section", "text": {"type": "mrkdwn", "text": "*%s*\n%s" % (title, text)}},
+            {"type": "context", "elements": [{"type": "mrkdwn", "text": footer}]},
+        ]
+        return {"text": fallback, "attachments": [{"color": color, "fallback": fallback, "blocks": blocks}]}
+
+
+DEFAULT = MessageTemplates()
+
+
+def create_templates(config):
+    """MessageTemplates from the [templates] and [slack] sections, config errors raise RuntimeError"""
+    try:
+        return MessageTemplates(config["templates"], config["slack"])
+    except TemplateError as e:
+        raise RuntimeError("Failed to compile message templates: %s" % e) from e
@@ -0,0 +1,181 @@
+# coding=utf-8
+"""Per-call tracing.
+
+With ``[tracing] enabled = true`` a timeline of spans is recorded for every
+sampled call, keyed by the uniqueid of the call:
+
+agi.session, agi.env, agi.vars
+    each FastAGI session of the call, reading its environment and the
+    variable fetch (with strategy and number of variables)
+state
+    the state transition of the call state machine (ringing, update, finished)
+    with the message text
+dispatch.queue
+    the time the Slack message waited for a dispatch worker
+slack.chat.postMessage, slack.chat.update
+    each Slack API request with channel and error, including the wait for
+    the rate limit buckets
+
+The timelines of the last ``capacity`` calls are kept in memory and served
+as JSON by the HTTP server at ``/traces`` (``?slow=1`` for slow calls only,
+``?limit=n``) and ``/traces/<uniqueid>``. A call is slow if one of its spans
+took at least ``slow_threshold`` seconds; its whole timeline is logged when
+its final Slack update was sent, or when it is dropped from the buffer.
+
+Whether a call is sampled is derived from a hash of its uniqueid, so all
+sessions of a call are traced or none, without any shared state. Calls not
+sampled cost one dict lookup per traced step.
+"""
+import collections
+import json
+import logging
+import threading
+import time
+import zlib
+
+log = logging.getLogger("slack_asterisk")
+
+# spans kept per call, a call with more (e.g. a stuck AGI loop) keeps its first ones
+MAX_SPANS = 200
+
+
+class CallTrace(object):
+    """Timeline of one call
+
+    :param key: uniqueid of the call
+    :param start: time.perf_counter() of the first span
+    :param threshold: seconds a span must take to mark the call slow, 0 to never mark it
+    """
+    __slots__ = ("key", "start", "threshold", "wall", "spans", "slow", "finished", "logged")
+
+    def __init__(self, key, start, threshold=0.0):
+        self.key = key
+        self.start = start
+        self.threshold = threshold
+        self.wall = time.time() - (time.perf_counter() - start)
+        # (start, end, name, attrs)
+        self.spans = []
+        self.slow = False
+        self.finished = False
+        self.logged = False
+
+    def span(self, name, start, end, **attrs):
+        """Record a span between two time.perf_counter() values"""
+        if len(self.spans) < MAX_SPANS:
+            self.spans.append((start, end, name, attrs))
+        if self.threshold and end - start >= self.threshold:
+            self.slow = True
+
+    def as_dict(self):
+        spans = sorted(self.spans, key=lambda s: s[0])
+        end = max((s[1] for s in spans), default=self.start)
+        return {
+            "call": self.key,
+            "start": round(self.wall, 6),
+            "duration_ms": round((end - self.start) * 1000, 3),
+            "finished": self.finished,
+            "slow": self.slow,
+            "spans": [dict(name=name, offset_ms=round((start - self.start) * 1000, 3), duration_ms=round((stop - start) * 1000, 3), **attrs)
+                      for start, stop, name, attrs in spans],
+        }
+
+
+class Tracer(object):
+    """Bounded ring buffer of CallTraces
+
+    :param capacity: calls kept, the oldest are dropped beyond; 0 disables tracing
+    :param sample_rate: fraction of calls traced
+    :param slow_threshold: seconds a span must take to mark its call slow, 0 to never log timelines
+    """
+
+    def __init__(self, capacity=0, sample_rate=1.0, slow_threshold=0.0):
+        self._traces = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = dict(traced=0, slow=0)
+        self.configure(capacity, sample_rate, slow_threshold)
+
+    def configure(self, capacity, sample_rate, slow_threshold):
+        self.capacity = capacity
+        self.sample_rate = sample_rate if capacity else 0.0
+        self.slow_threshold = slow_threshold
+        self._sample_below = int(sample_rate * 10000)
+
+    def __len__(self):
+        return len(self._traces)
+
+    def sampled(self, key):
+        if self._sample_below >= 10000:
+            return True
+        return zlib.crc32(key.encode()) % 10000 < self._sample_below
+
+    def trace(self, key, start=None):
+        """CallTrace of a call, created if the call is sampled, else None
+
+        :param start: time.perf_counter() the trace starts at if it is created, now if None
+        """
+        if not self.sample_rate or not key:
+            return None
+        trace = self._traces.get(key)
+        if trace is not None or not self.sampled(key):
+            return trace
+        with self._lock:
+            trace = self._traces.get(key)
+            if trace is not None:
+                return trace
+            trace = self._traces[key] = CallTrace(key, time.perf_counter() if start is None else start, self.slow_threshold)
+            self.stats["traced"] += 1
+            dropped = self._traces.popitem(last=False)[1] if len(self._traces) > self.capacity else None
+        if dropped is not None and dropped.slow:
+            self._log(dropped)
+        return trace
+
+    def span(self, key, name, start, end, **attrs):
+        """Record a span for a call if it is sampled"""
+        trace = self.trace(key, start)
+        if trace is not None:
+            trace.span(name, start, end, **attrs)
+
+    def finish(self, key):
+        """The final Slack update of a call was sent, log its timeline if it was slow"""
+        trace = self._traces.get(key) if self.sample_rate else None
+        if trace is None:
+            return
+        trace.finished = True
+        if trace.slow:
+            self._log(trace)
+
+    def _log(self, trace):
+        if trace.logged:
+            return
+        trace.logged = True
+        self.stats["slow"] += 1
+        log.warning("Slow call %s: %s", trace.key, json.dumps(trace.as_dict(), ensure_ascii=False))
+
+    def get(self, key):
+        """Timeline of a call as dict, None if it is not in the buffer"""
+        trace = self._traces.get(key)
+        return trace.as_dict() if trace is not None else None
+
+    def recent(self, limit=100, slow=False):
+        """Timelines of the most recent calls, newest first"""
+        with self._lock:
+            traces = list(self._traces.values())
+        traces.reverse()
+        if slow:
+            traces = [t for t in traces if t.slow]
+        return [t.as_dict() for t in traces[:limit]]
+
+
+# shared by the server engines, the dispatcher and the HTTP server, disabled until configured
+TRACER = Tracer()
+
+
+def configure(config):
+    """Set up TRACER from the [tracing] section"""
+    tc = config["tracing"]
+    if not tc["enabled"]:
+        TRACER.configure(0, 0.0, 0.0)
+        return TRACER
+    TRACER.configure(tc["capacity"], tc["sample_rate"], tc["slow_threshold"])
+    log.info("Tracing %.0f%% of calls, keeping the last %d (slow threshold %.1fs)", tc["sample_rate"] * 100, tc["capacity"], tc["slow_threshold"])
+    return TRACER
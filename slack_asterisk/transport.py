@@ -0,0 +1,264 @@
+# coding=utf-8
+"""HTTP transport for the Slack Web API.
+
+slack_sdk's ``WebClient`` opens a new connection (and TLS session) with
+urllib for every request. :class:`PooledWebClient` implements the part of
+the WebClient API used here on a :class:`ConnectionPool` of persistent
+HTTP/1.1 keep-alive connections instead:
+
+- at most ``pool_size`` connections, by default one per dispatch worker;
+  requests beyond that wait for a free connection
+- separate connect and read timeouts
+- idle connections are reused most recently used first and closed after
+  ``idle_timeout`` seconds, before Slack drops them; a request failing on a
+  reused connection before any answer arrived is retried once on a new one
+- optional HTTP(S) proxy, tunneled with CONNECT
+
+Answers are returned as ``SlackResponse`` and errors raised as
+``SlackApiError`` like the WebClient does, so rate limiting and
+instrumentation work the same with both transports. ``type = urllib`` in
+the ``[transport]`` section selects the WebClient again.
+
+slack_sdk is imported on first use. :func:`warm_up` does so in the
+background at startup and calls ``auth.test``, which checks the token and
+leaves a connection in the pool for the first message.
+"""
+import base64
+import collections
+import http.client
+import json
+import logging
+import ssl
+import threading
+import time
+import urllib.parse
+
+log = logging.getLogger("slack_asterisk")
+
+TYPES = ("pooled", "urllib")
+
+# pool size when Slack is called inline by the AGI handlers
+INLINE_POOL_SIZE = 10
+
+
+class PoolTimeout(TimeoutError):
+    """No connection became free in time"""
+
+
+class ConnectionPool(object):  # pylint:disable=too-many-instance-attributes
+    """Bounded LIFO pool of keep-alive connections to one host
+
+    :param url: base URL, only scheme, host and port are used
+    :param size: maximum number of connections
+    :param connect_timeout: seconds for TCP connect, proxy tunnel and TLS handshake
+    :param read_timeout: seconds to wait for (each part of) an answer, also the wait for a free connection
+    :param idle_timeout: idle connections older than this are closed instead of reused
+    :param proxy: optional proxy URL, http://[user:password@]host:port
+    """
+
+    def __init__(self, url, size=4, connect_timeout=3.0, read_timeout=10.0, idle_timeout=50.0, proxy=None):  # pylint:disable=too-many-arguments
+        parts = urllib.parse.urlsplit(url)
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+        self.proxy = urllib.parse.urlsplit(proxy) if proxy else None
+        # created with the first connection, loading the CA certificates takes a while
+        self._ssl_context = None
+        # (connection, idle since)
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self.stats = dict(requests=0, reused=0, connects=0, tls_handshakes=0, retries=0, closed_idle=0, errors=0, open=0)
+
+    @property
+    def ssl_context(self):
+        if self._ssl_context is None:
+            with self._lock:
+                if self._ssl_context is None:
+                    self._ssl_context = ssl.create_default_context()
+        return self._ssl_context
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def _connect(self):
+        if self.proxy is not None:
+            host, port = self.proxy.hostname, self.proxy.port or 8080
+        else:
+            host, port = self.host, self.port
+        if self.https:
+            conn = http.client.HTTPSConnection(host, port, timeout=self.connect_timeout, context=self.ssl_context)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.connect_timeout)
+        if self.proxy is not None:
+            headers = {}
+            if self.proxy.username:
+                credentials = "%s:%s" % (urllib.parse.unquote(self.proxy.username), urllib.parse.unquote(self.proxy.password or ""))
+                headers["Proxy-Authorization"] = "Basic " + base64.b64encode(credentials.encode()).decode()
+            conn.set_tunnel(self.host, self.port, headers)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        self._count("connects")
+        if self.https:
+            self._count("tls_handshakes")
+        self._count("open")
+        return conn
+
+    def _close(self, conn):
+        conn.close()
+        self._count("open", -1)
+
+    def _get(self):
+        """An idle connection that is not too old, or None"""
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                conn, since = self._idle.pop()
+            if now - since < self.idle_timeout:
+                return conn
+            self._count("closed_idle")
+            self._close(conn)
+
+    def request(self, method, path, body, headers):
+        """Send a request, return (status, headers (case-insensitive), body)"""
+        if not self._slots.acquire(timeout=self.read_timeout):  # pylint:disable=consider-using-with
+            self._count("errors")
+            raise PoolTimeout("No free Slack connection within %.1fs (pool size %d)" % (self.read_timeout, self.size))
+        try:
+            self._count("requests")
+            conn = self._get()
+            if conn is not None:
+                self._count("reused")
+                try:
+                    return self._send(conn, method, path, body, headers)
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                    # the server closed the idle connection before it got the request
+                    log.debug("Reused Slack connection failed with %r, retrying on a new connection", e)
+                    self._count("retries")
+            return self._send(self._connect(), method, path, body, headers)
+        except Exception:
+            self._count("errors")
+            raise
+        finally:
+            self._slots.release()
+
+    def _send(self, conn, method, path, body, headers):
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            data = response.read()
+        except Exception:
+            self._close(conn)
+            raise
+        if response.will_close:
+            self._close(conn)
+        else:
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        return response.status, response.headers, data
+
+    def close(self):
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _ in idle:
+            self._close(conn)
+
+
+class PooledWebClient(object):
+    """Slack Web API client on a ConnectionPool, with the WebClient methods used by slack_asterisk
+
+    :param token: bot token
+    :param base_url: Slack Web API URL
+    :param pool: ConnectionPool for the host of base_url
+    """
+
+    def __init__(self, token, base_url, pool):
+        self.token = token
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        self.path = urllib.parse.urlsplit(self.base_url).path
+        self.pool = pool
+        self.headers = {
+            "Authorization": "Bearer %s" % token,
+            "Content-Type": "application/json;charset=utf-8",
+            "User-Agent": "slack_asterisk",
+        }
+
+    def api_call(self, api_method, json_data=None):
+        body = json.dumps(json_data or {}, separators=(",", ":")).encode()
+        status, headers, data = self.pool.request("POST", self.path + api_method, body, self.headers)
+        try:
+            data = json.loads(data)
+        except ValueError:
+            pass
+        from slack_sdk.web.slack_response import SlackResponse  # pylint:disable=import-outside-toplevel
+        return SlackResponse(client=self, http_verb="POST", api_url=self.base_url + api_method, req_args={"json": json_data},
+                             data=data, headers=headers, status_code=status).validate()
+
+    def chat_postMessage(self, **kwargs):  # noqa: N802 (slack_sdk method name)
+        return self.api_call("chat.postMessage", kwargs)
+
+    def chat_update(self, **kwargs):
+        return self.api_call("chat.update", kwargs)
+
+    def auth_test(self):
+        return self.api_call("auth.test")
+
+
+def pool_size(config):
+    """Configured pool size, 0 sizes the pool to the dispatch workers"""
+    size = config["transport"]["pool_size"]
+    if size:
+        return size
+    return config["dispatch"]["workers"] or INLINE_POOL_SIZE
+
+
+def create_client(config, token):
+    """Synchronous Slack client for the [transport] and [slack] sections
+
+    :return: PooledWebClient, or slack_sdk's WebClient with type = urllib
+    """
+    tc = config["transport"]
+    base_url = config["slack"]["base_url"]
+    if tc["type"] == "urllib":
+        from slack_sdk import WebClient  # pylint:disable=import-outside-toplevel
+        return WebClient(token, base_url=base_url, timeout=max(tc["connect_timeout"], tc["read_timeout"]), proxy=tc["proxy"] or None)
+    pool = ConnectionPool(base_url, pool_size(config), tc["connect_timeout"], tc["read_timeout"], tc["idle_timeout"], tc["proxy"] or None)
+    log.debug("Slack connection pool for %s:%d with %d connections", pool.host, pool.port, pool.size)
+    return PooledWebClient(token, base_url, pool)
+
+
+def warm_up(client, config):
+    """Call auth.test with a synchronous client in a daemon thread if enabled in the [transport] section
+
+    Failures are logged only, the first message connects again.
+    """
+    if not config["transport"]["warm_up"]:
+        return None
+
+    def run():
+        started = time.perf_counter()
+        try:
+            ret = client.auth_test()
+        except Exception as e:  # pylint:disable=broad-except
+            log.warning("Slack auth.test at startup failed with message %s", e)
+            return
+        log.info("Connected to Slack as %s of team %s in %.0f ms", ret.get("user"), ret.get("team"), (time.perf_counter() - started) * 1000)
+
+    thread = threading.Thread(target=run, name="slack-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def create_async_client(config, token):
+    """AsyncWebClient (aiohttp keeps its own keep-alive connection pool) with the [transport] timeout and proxy"""
+    from slack_sdk.web.async_client import AsyncWebClient  # pylint:disable=import-outside-toplevel
+    tc = config["transport"]
+    return AsyncWebClient(token, base_url=config["slack"]["base_url"], timeout=max(tc["connect_timeout"], tc["read_timeout"]), proxy=tc["proxy"] or None)